@@ -0,0 +1,81 @@
+#!/usr/bin/env python2.7
+
+import falcon
+import logging
+import sqlalchemy
+import sqlalchemy.orm
+
+import modelstatus.utils
+import modelstatus.api
+import modelstatus.orm
+
+# Default and maximum number of events returned by a single request
+DEFAULT_LIMIT = 100
+MAX_LIMIT = 1000
+
+
+class CollectionResource(modelstatus.api.BaseResource):
+    """
+    Replays ZeroMQ events that have been published earlier, so that
+    subscribers can recover events they did not receive.
+    """
+    orm_class = modelstatus.orm.Event
+
+    @falcon.after(modelstatus.utils.serialize)
+    def on_get(self, req, resp):
+        """
+        List published messages in order of their sequence numbers.
+
+        The query string may contain `after` and `before`, returning only
+        events with sequence numbers in between, `data_provider`, and `limit`.
+        If any event following the one given by `after` has been deleted,
+        410 Gone is returned, telling the subscriber to resynchronize instead.
+        """
+        try:
+            after = int(req.get_param('after') or 0)
+            before = req.get_param('before')
+            limit = int(req.get_param('limit') or DEFAULT_LIMIT)
+            if limit < 1:
+                raise ValueError("Limit must be a positive integer and non-zero")
+            limit = min(limit, MAX_LIMIT)
+
+            query_set = self.orm.query(self.orm_class).filter(self.orm_class.id > after)
+            if before is not None:
+                query_set = query_set.filter(self.orm_class.id < int(before))
+            data_provider = req.get_param('data_provider')
+            if data_provider is not None:
+                query_set = query_set.filter(self.orm_class.data_provider == data_provider)
+            query_set = query_set.order_by(self.orm_class.id.asc()).limit(limit)
+
+        except ValueError, e:
+            raise falcon.HTTPError(falcon.HTTP_400, 'Invalid query string', unicode(e))
+
+        if after > 0 and self.is_pruned(after, data_provider):
+            raise falcon.HTTPError(falcon.HTTP_410, 'Gap too old',
+                                   "Events after sequence number %d are no longer kept, resynchronize instead" % after)
+
+        try:
+            dataset = [object_.serialize() for object_ in query_set]
+        except Exception, e:
+            self.orm.rollback()
+            logging.error("Database transaction failed: %s" % unicode(e))
+            raise falcon.HTTPError(falcon.HTTP_500, 'Internal server error', 'Uncaught exception during SQL query')
+
+        resp.body = dataset
+        resp.status = falcon.HTTP_200
+
+    def is_pruned(self, after, data_provider=None):
+        """
+        Returns True if events with sequence numbers above `after`, optionally
+        about a specific data provider, have been deleted. Events about a data
+        provider are deleted oldest first, and the latest one is always kept,
+        so this is the case if a kept event refers to a deleted previous event
+        above `after`.
+        """
+        previous = sqlalchemy.orm.aliased(self.orm_class)
+        query_set = self.orm.query(self.orm_class.id) \
+                            .filter(self.orm_class.previous_id > after) \
+                            .filter(~sqlalchemy.exists().where(previous.id == self.orm_class.previous_id))
+        if data_provider is not None:
+            query_set = query_set.filter(self.orm_class.data_provider == data_provider)
+        return query_set.first() is not None
@@ -9,9 +9,11 @@ import logging.config
 
 import modelstatus.orm
 import modelstatus.zeromq
+import modelstatus.codec
 import modelstatus.api.helloworld
 import modelstatus.api.modelrun
 import modelstatus.api.data
+import modelstatus.api.event
 
 DEFAULT_CONFIG_PATH = '/etc/modelstatus.ini'
 DEFAULT_LOG_LEVEL = 'DEBUG'
@@ -45,7 +47,23 @@ def start_api(config_parser):
 
     # instantiate ZeroMQ publisher
     logging.info("Publishing ZeroMQ events on socket %s" % zmq_socket)
-    zeromq = modelstatus.zeromq.ZMQPublisher(zmq_socket)
+    codecs = modelstatus.codec.DEFAULT_CODECS
+    if config_parser.has_option('zeromq', 'codecs'):
+        codecs = config_parser.get('zeromq', 'codecs')
+    event_retention = modelstatus.zeromq.DEFAULT_EVENT_RETENTION
+    if config_parser.has_option('zeromq', 'event_retention'):
+        event_retention = config_parser.getint('zeromq', 'event_retention')
+    event_max_age = modelstatus.zeromq.DEFAULT_EVENT_MAX_AGE
+    if config_parser.has_option('zeromq', 'event_max_age'):
+        event_max_age = config_parser.getint('zeromq', 'event_max_age')
+    zeromq = modelstatus.zeromq.ZMQPublisher(zmq_socket, orm_session, codecs, event_retention, event_max_age)
+    logging.info("Publishing ZeroMQ events encoded as %s" % ', '.join(['json'] + [codec.name for codec in zeromq.codecs]))
+    heartbeat_interval = modelstatus.zeromq.DEFAULT_HEARTBEAT_INTERVAL
+    if config_parser.has_option('zeromq', 'heartbeat_interval'):
+        heartbeat_interval = config_parser.getint('zeromq', 'heartbeat_interval')
+    if heartbeat_interval > 0:
+        logging.info("Publishing ZeroMQ heartbeats every %d seconds" % heartbeat_interval)
+        zeromq.start_heartbeat(heartbeat_interval)
 
     # instantiate resources - the API end point, where the application logic happens
     common_args = (api_base_url, orm_session, zeromq)
@@ -54,6 +72,7 @@ def start_api(config_parser):
     modelrun_item = modelstatus.api.modelrun.ItemResource(*common_args)
     data_collection = modelstatus.api.data.CollectionResource(*common_args)
     data_item = modelstatus.api.data.ItemResource(*common_args)
+    event_collection = modelstatus.api.event.CollectionResource(*common_args)
 
     # set up routes
     application.add_route(api_base_url + '/helloworld', helloworld)
@@ -61,6 +80,7 @@ def start_api(config_parser):
     application.add_route(api_base_url + '/model_run/{id}', modelrun_item)
     application.add_route(api_base_url + '/data', data_collection)
     application.add_route(api_base_url + '/data/{id}', data_item)
+    application.add_route(api_base_url + '/event', event_collection)
 
     # WSGI application object
     logging.info("Modelstatus startup complete, ready to serve requests.")
@@ -0,0 +1,76 @@
+"""
+Message encodings for the ZeroMQ publisher.
+
+JSON is always published. Binary codecs are more compact; each of them
+prefixes its messages with a single marker byte, so that subscribers can
+decode any message without knowing in advance how it was encoded.
+
+MessagePack is an optional dependency, which is only used if the `msgpack`
+module is installed.
+"""
+
+import json
+import zlib
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+# Binary codecs published in addition to JSON by default, if available
+DEFAULT_CODECS = ['msgpack', 'zlib']
+
+
+class JSONCodec(object):
+    name = 'json'
+    marker = None
+
+    def available(self):
+        return True
+
+    def encode(self, obj):
+        return json.dumps(obj)
+
+
+class ZlibCodec(JSONCodec):
+    """
+    Compact JSON compressed with zlib.
+    """
+    name = 'zlib'
+    marker = b'\x01'
+
+    def encode(self, obj):
+        return self.marker + zlib.compress(json.dumps(obj, separators=(',', ':')), 1)
+
+
+class MsgpackCodec(JSONCodec):
+    """
+    MessagePack, if installed.
+    """
+    name = 'msgpack'
+    marker = b'\x02'
+
+    def available(self):
+        return msgpack is not None
+
+    def encode(self, obj):
+        return self.marker + msgpack.packb(obj, use_bin_type=True)
+
+
+CODECS = dict([(codec.name, codec) for codec in [JSONCodec(), ZlibCodec(), MsgpackCodec()]])
+
+
+def get_codecs(names):
+    """
+    Return the available binary codecs among `names`, which may be a comma
+    separated string. Raises ValueError for unknown codecs.
+    """
+    if isinstance(names, basestring):
+        names = [name.strip() for name in names.split(',') if name.strip()]
+    codecs = []
+    for name in names:
+        if name not in CODECS:
+            raise ValueError("Unknown message codec '%s'" % name)
+        if CODECS[name].marker is not None and CODECS[name].available():
+            codecs += [CODECS[name]]
+    return codecs
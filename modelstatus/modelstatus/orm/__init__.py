@@ -3,6 +3,7 @@ import sqlalchemy.ext.declarative
 import sqlalchemy.orm
 import sqlalchemy.engine
 import sqlalchemy.event
+import json
 import datetime
 import dateutil.tz
 
@@ -78,6 +79,29 @@ class Data(Base, SerializeBase):
         return self._serialize_datetime(value)
 
 
+class Event(Base, SerializeBase):
+    """
+    A message published through ZeroMQ. The id is the sequence number of the
+    event, and `previous_id` is the sequence number of the previous event
+    about the same data provider, so that subscribers can detect lost events.
+    """
+    __tablename__ = 'event'
+
+    id = sqlalchemy.Column(sqlalchemy.Integer, primary_key=True)
+    data_provider = sqlalchemy.Column(sqlalchemy.String, nullable=False, index=True)
+    previous_id = sqlalchemy.Column(sqlalchemy.Integer)
+    message = sqlalchemy.Column(sqlalchemy.Text, nullable=False)
+    created_time = sqlalchemy.Column(sqlalchemy.DateTime(timezone=True),
+                                     nullable=False,
+                                     default=datetime.datetime.utcnow)
+
+    def serialize(self):
+        """
+        Events are serialized as the message that was published.
+        """
+        return json.loads(self.message)
+
+
 def get_sqlite_memory_session():
     return get_database_session('sqlite://')
 
@@ -0,0 +1,85 @@
+import falcon
+import falcon.testing
+import unittest
+
+import modelstatus.orm
+import modelstatus.api.event
+import modelstatus.tests.test_utils
+
+
+class TestEventCollectionResource(modelstatus.tests.test_utils.TestBase):
+
+    def before(self):
+
+        self.setup_zmq()
+        self.api_base_url = modelstatus.tests.test_utils.get_api_base_url()
+        self.url = self.api_base_url + '/event'
+        self.orm = modelstatus.orm.get_sqlite_memory_session()
+        self.zmq.orm = self.orm
+        self.resource = modelstatus.api.event.CollectionResource(self.api_base_url,
+                                                                 self.orm,
+                                                                 self.zmq)
+        self.setup_database_fixture()
+        self.api.add_route(self.url, self.resource)
+        for model_run in self.orm.query(modelstatus.orm.ModelRun).order_by(modelstatus.orm.ModelRun.id):
+            self.zmq.publish_resource(model_run)
+
+    def test_get(self):
+        """
+        Test that a GET request returns all published messages in order.
+        """
+        body = self.simulate_request(self.url, method='GET')
+        self.assertEqual(self.srmock.status, falcon.HTTP_200)
+        body_content = self.decode_body(body)
+        self.assertEqual([x['sequence'] for x in body_content], [1, 2, 3, 4])
+        self.assertEqual(body_content[0]['resource'], 'model_run')
+        self.assertEqual(body_content[0]['id'], 1)
+
+    def test_get_after_before(self):
+        """
+        Test that only events between two sequence numbers are replayed.
+        """
+        body = self.simulate_request(self.url, method='GET', query_string='after=1&before=4')
+        self.assertEqual(self.srmock.status, falcon.HTTP_200)
+        self.assertEqual([x['sequence'] for x in self.decode_body(body)], [2, 3])
+
+    def test_get_data_provider(self):
+        """
+        Test that events can be filtered by data provider.
+        """
+        body = self.simulate_request(self.url, method='GET', query_string='after=1&data_provider=ecdet')
+        self.assertEqual(self.srmock.status, falcon.HTTP_200)
+        body_content = self.decode_body(body)
+        self.assertEqual([x['sequence'] for x in body_content], [3, 4])
+        self.assertEqual(body_content[1]['previous_sequence'], 3)
+
+    def test_get_limit(self):
+        body = self.simulate_request(self.url, method='GET', query_string='limit=1')
+        self.assertEqual(self.srmock.status, falcon.HTTP_200)
+        self.assertEqual([x['sequence'] for x in self.decode_body(body)], [1])
+
+    def test_get_gap_too_old(self):
+        """
+        Test that replaying events after a deleted event is refused.
+        """
+        self.zmq.event_retention = 1
+        self.zmq.prune_events()
+        self.orm.commit()
+        self.simulate_request(self.url, method='GET', query_string='after=1&data_provider=ecdet')
+        self.assertEqual(self.srmock.status, falcon.HTTP_410)
+        self.simulate_request(self.url, method='GET', query_string='after=1')
+        self.assertEqual(self.srmock.status, falcon.HTTP_410)
+        body = self.simulate_request(self.url, method='GET', query_string='after=3&data_provider=ecdet')
+        self.assertEqual(self.srmock.status, falcon.HTTP_200)
+        self.assertEqual([x['sequence'] for x in self.decode_body(body)], [4])
+        body = self.simulate_request(self.url, method='GET', query_string='after=1&data_provider=arome25')
+        self.assertEqual(self.srmock.status, falcon.HTTP_200)
+        self.assertEqual([x['sequence'] for x in self.decode_body(body)], [2])
+
+    def test_get_invalid_after(self):
+        self.simulate_request(self.url, method='GET', query_string='after=foo')
+        self.assertEqual(self.srmock.status, falcon.HTTP_400)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -3,10 +3,14 @@ Tests for the ZeroMQ implementation.
 """
 
 import zmq
+import json
+import zlib
+import datetime
 
 import modelstatus.tests
 import modelstatus.orm
 import modelstatus.zeromq
+import modelstatus.codec
 import modelstatus.tests.test_utils
 
 
@@ -29,9 +33,182 @@ class TestZmq(modelstatus.tests.test_utils.TestBase):
         object_ = self.orm.query(modelstatus.orm.ModelRun).get(1)
         zmq_msg = self.zmq.message_from_resource(object_)
         target_msg = {
-            'version': [1, 1, 0],
+            'version': [1, 6, 0],
             'type': 'resource',
             'resource': 'model_run',
             'id': 1,
+            'model_run': object_.serialize(),
         }
         self.assertEqual(zmq_msg, target_msg)
+
+    def test_topic_from_resource(self):
+        model_run = self.orm.query(modelstatus.orm.ModelRun).get(1)
+        self.assertEqual(self.zmq.topic_from_resource(model_run), b'model_run arome25\0')
+        data = self.orm.query(modelstatus.orm.Data).get(2)
+        self.assertEqual(self.zmq.topic_from_resource(data), b'data %s\0' % data.model_run.data_provider)
+
+    def test_publish_resource(self):
+        """
+        Test that a subscriber filtering on a data provider receives the topic
+        and the message.
+        """
+        addr = 'ipc://test_publish'
+        self.zmq = modelstatus.zeromq.ZMQPublisher(addr)
+        sock = self.zmq.context.socket(zmq.SUB)
+        sock.setsockopt(zmq.SUBSCRIBE, modelstatus.zeromq.make_topic('model_run', 'arome25'))
+        sock.connect(addr)
+        model_run = self.orm.query(modelstatus.orm.ModelRun).get(1)
+        other = self.orm.query(modelstatus.orm.ModelRun).filter_by(data_provider='ecdet').first()
+        for _ in range(50):
+            self.zmq.publish_resource(other)
+            self.zmq.publish_resource(model_run)
+            if sock.poll(100):
+                break
+        topic, msg = sock.recv_multipart()
+        self.assertEqual(topic, b'model_run arome25\0')
+        self.assertEqual(json.loads(msg)['id'], 1)
+        sock.close()
+
+    def test_message_from_data_resource(self):
+        object_ = self.orm.query(modelstatus.orm.Data).get(2)
+        zmq_msg = self.zmq.message_from_resource(object_)
+        self.assertEqual(zmq_msg['resource'], 'data')
+        self.assertEqual(zmq_msg['id'], 2)
+        self.assertEqual(zmq_msg['model_run_id'], object_.model_run_id)
+        self.assertEqual(zmq_msg['model_run']['id'], object_.model_run_id)
+        self.assertEqual(zmq_msg['model_run']['data_provider'], object_.model_run.data_provider)
+        self.assertEqual(zmq_msg['model_run']['version'], object_.model_run.version)
+        self.assertIn(object_.serialize(), zmq_msg['model_run']['data'])
+
+    def test_record_event(self):
+        """
+        Test that published messages are recorded as events, with a sequence
+        number and the sequence number of the previous event about the same
+        data provider.
+        """
+        self.zmq.orm = self.orm
+        arome = self.orm.query(modelstatus.orm.ModelRun).get(1)
+        ecdet = self.orm.query(modelstatus.orm.ModelRun).filter_by(data_provider='ecdet').first()
+        first = self.zmq.record_event(arome, self.zmq.message_from_resource(arome))
+        second = self.zmq.record_event(ecdet, self.zmq.message_from_resource(ecdet))
+        third = self.zmq.record_event(arome, self.zmq.message_from_resource(arome))
+        self.assertEqual([first.id, second.id, third.id], [1, 2, 3])
+        self.assertEqual([first.previous_id, second.previous_id, third.previous_id], [None, None, 1])
+        msg = self.orm.query(modelstatus.orm.Event).get(3).serialize()
+        self.assertEqual(msg['sequence'], 3)
+        self.assertEqual(msg['previous_sequence'], 1)
+        self.assertEqual(msg['model_run']['id'], 1)
+
+    def get_event_ids(self):
+        return [x.id for x in self.orm.query(modelstatus.orm.Event).order_by(modelstatus.orm.Event.id)]
+
+    def test_prune_events_by_count(self):
+        """
+        Test that only the most recent events are kept, and the latest event
+        about each data provider.
+        """
+        self.zmq.orm = self.orm
+        self.zmq.event_retention = 2
+        arome = self.orm.query(modelstatus.orm.ModelRun).get(1)
+        ecdet = self.orm.query(modelstatus.orm.ModelRun).filter_by(data_provider='ecdet').first()
+        for resource in [arome, ecdet, arome, arome, arome]:
+            event = self.zmq.record_event(resource, self.zmq.message_from_resource(resource))
+        self.assertEqual(self.get_event_ids(), [2, 4, 5])
+        self.assertEqual(event.previous_id, 4)
+        self.assertEqual(self.zmq.get_sequences(), {'arome25': 5, 'ecdet': 2})
+
+    def test_prune_events_by_age(self):
+        """
+        Test that old events are deleted, except the latest event about each
+        data provider.
+        """
+        self.zmq.orm = self.orm
+        self.zmq.event_retention = 0
+        self.zmq.event_max_age = 3600
+        arome = self.orm.query(modelstatus.orm.ModelRun).get(1)
+        ecdet = self.orm.query(modelstatus.orm.ModelRun).filter_by(data_provider='ecdet').first()
+        for resource in [arome, ecdet]:
+            self.zmq.record_event(resource, self.zmq.message_from_resource(resource))
+        for event in self.orm.query(modelstatus.orm.Event):
+            event.created_time = datetime.datetime.utcnow() - datetime.timedelta(days=1)
+        self.orm.commit()
+        self.zmq.record_event(arome, self.zmq.message_from_resource(arome))
+        self.assertEqual(self.get_event_ids(), [2, 3])
+
+    def test_prune_events_disabled(self):
+        self.zmq.orm = self.orm
+        self.zmq.event_retention = 0
+        self.zmq.event_max_age = 0
+        arome = self.orm.query(modelstatus.orm.ModelRun).get(1)
+        for x in range(3):
+            self.zmq.record_event(arome, self.zmq.message_from_resource(arome))
+        self.assertEqual(self.zmq.prune_events(), 0)
+        self.assertEqual(self.get_event_ids(), [1, 2, 3])
+
+    def test_make_heartbeat(self):
+        """
+        Test that heartbeats carry the start time of the publisher, and the
+        last sequence number published about each data provider.
+        """
+        self.zmq.orm = self.orm
+        arome = self.orm.query(modelstatus.orm.ModelRun).get(1)
+        ecdet = self.orm.query(modelstatus.orm.ModelRun).filter_by(data_provider='ecdet').first()
+        self.zmq.publish_resource(arome)
+        self.zmq.publish_resource(ecdet)
+        self.zmq.publish_resource(arome)
+        heartbeat = self.zmq.make_heartbeat()
+        self.assertEqual(heartbeat['type'], 'heartbeat')
+        self.assertEqual(heartbeat['epoch'], self.zmq.epoch)
+        self.assertEqual(heartbeat['sequence'], 3)
+        self.assertEqual(heartbeat['sequences'], {'arome25': 3, 'ecdet': 2})
+        self.assertEqual(heartbeat['codecs'], ['json'] + [codec.name for codec in self.zmq.codecs])
+
+        # a restarted publisher continues from the database
+        self.zmq.sock.close()
+        publisher = modelstatus.zeromq.ZMQPublisher('ipc://null', self.orm)
+        self.assertEqual(publisher.make_heartbeat()['sequences'], {'arome25': 3, 'ecdet': 2})
+        publisher.sock.close()
+
+    def test_start_heartbeat(self):
+        addr = 'ipc://test_heartbeat'
+        self.zmq = modelstatus.zeromq.ZMQPublisher(addr)
+        sock = self.zmq.context.socket(zmq.SUB)
+        sock.setsockopt(zmq.SUBSCRIBE, modelstatus.zeromq.HEARTBEAT_TOPIC)
+        sock.connect(addr)
+        self.zmq.start_heartbeat(0.01)
+        try:
+            self.assertTrue(sock.poll(5000))
+            topic, msg = sock.recv_multipart()
+            self.assertEqual(topic, modelstatus.zeromq.HEARTBEAT_TOPIC)
+            self.assertEqual(json.loads(msg)['epoch'], self.zmq.epoch)
+            self.assertIsNone(json.loads(msg)['sequence'])
+        finally:
+            self.zmq.stop_heartbeat()
+            sock.close()
+
+    def test_publish_resource_codec(self):
+        """
+        Test that messages are published once more for each binary codec,
+        under topics prefixed with the name of the codec.
+        """
+        addr = 'ipc://test_publish_codec'
+        self.zmq = modelstatus.zeromq.ZMQPublisher(addr, codecs='zlib')
+        codec = modelstatus.codec.CODECS['zlib']
+        sock = self.zmq.context.socket(zmq.SUB)
+        sock.setsockopt(zmq.SUBSCRIBE, modelstatus.zeromq.make_topic('model_run', 'arome25', codec))
+        sock.connect(addr)
+        model_run = self.orm.query(modelstatus.orm.ModelRun).get(1)
+        for _ in range(50):
+            self.zmq.publish_resource(model_run)
+            if sock.poll(100):
+                break
+        topic, msg = sock.recv_multipart()
+        self.assertEqual(topic, b'zlib:model_run arome25\0')
+        self.assertEqual(msg[:1], codec.marker)
+        self.assertEqual(json.loads(zlib.decompress(msg[1:])), self.zmq.message_from_resource(model_run))
+        sock.close()
+
+    def test_get_codecs(self):
+        self.assertEqual([codec.name for codec in modelstatus.codec.get_codecs('zlib, json')], ['zlib'])
+        with self.assertRaises(ValueError):
+            modelstatus.codec.get_codecs('xml')
@@ -5,8 +5,17 @@ Modelstatus runs a ZMQ publisher that notifies clients about interesting data se
 """
 
 import zmq
+import json
+import time
 import errno
+import datetime
 import logging
+import threading
+import sqlalchemy
+import sqlalchemy.exc
+
+import modelstatus.orm
+import modelstatus.codec
 
 #
 # Version for the ZeroMQ **message format**.
@@ -15,20 +24,97 @@ import logging
 #
 # Follows Semantic Versioning 2.0.0: http://semver.org/spec/v2.0.0.html
 #
-MESSAGE_PROTOCOL_VERSION = [1, 1, 0]
+MESSAGE_PROTOCOL_VERSION = [1, 6, 0]
+
+#
+# Messages are sent as two frames: a topic, followed by the JSON encoded
+# message. The topic consists of the resource type and the data provider,
+# terminated by a NUL character so that subscribers can filter on exact data
+# provider names by prefix matching.
+#
+TOPIC_FORMAT = u'%s %s\0'
+
+#
+# Messages encoded with a binary codec are published once more, with the name
+# of the codec prefixed to the topic. Heartbeats list the available codecs,
+# and are always encoded as JSON.
+#
+CODEC_TOPIC_FORMAT = u'%s:'
+
+# Topic of heartbeat messages, which are not about any data provider
+HEARTBEAT_TOPIC = b'heartbeat\0'
+
+# Default number of seconds between heartbeat messages
+DEFAULT_HEARTBEAT_INTERVAL = 10
+
+# Default number of most recent events kept in the database, and the default
+# maximum age of kept events, in seconds
+DEFAULT_EVENT_RETENTION = 10000
+DEFAULT_EVENT_MAX_AGE = 7 * 86400
+
+
+def make_topic(resource, data_provider, codec=None):
+    """
+    Return the topic frame for a message about a resource belonging to a
+    specific data provider, encoded with a codec, or JSON by default.
+    """
+    topic = TOPIC_FORMAT % (resource, data_provider)
+    if codec is not None and codec.marker is not None:
+        topic = CODEC_TOPIC_FORMAT % codec.name + topic
+    return topic.encode('utf-8')
 
 
 class ZMQPublisher(object):
-    def __init__(self, addr):
+    """
+    Publishes messages about created resources. If an ORM session is given,
+    each message is recorded as an event in the database before it is sent,
+    and carries the sequence number of the event.
+
+    Once started, heartbeat messages are published periodically from a
+    background thread. They carry the time the publisher was started, and the
+    last sequence number published about each data provider, so that
+    subscribers can detect a dead or restarted publisher and lost events.
+
+    Every message is published as JSON, and once more for each of the
+    available binary `codecs`.
+
+    Only the `event_retention` most recent events, no older than
+    `event_max_age` seconds, are kept in the database. Zero disables either
+    limit.
+    """
+    def __init__(self, addr, orm=None, codecs=modelstatus.codec.DEFAULT_CODECS,
+                 event_retention=DEFAULT_EVENT_RETENTION, event_max_age=DEFAULT_EVENT_MAX_AGE):
         self.context = zmq.Context()
         self.sock = self.context.socket(zmq.PUB)
         self.sock.bind(addr)
+        self.orm = orm
+        self.codecs = modelstatus.codec.get_codecs(codecs)
+        self.event_retention = event_retention
+        self.event_max_age = event_max_age
+        self.epoch = time.time()
+        self.lock = threading.Lock()
+        self.stopped = threading.Event()
+        self.heartbeat_thread = None
+        self.sequences = {}
+        if self.orm is not None:
+            self.sequences = self.get_sequences()
 
-    def publish_resource(self, resource):
-        msg = self.message_from_resource(resource)
+    def get_sequences(self):
+        """
+        Return the sequence number of the last recorded event about each data
+        provider.
+        """
+        query = self.orm.query(modelstatus.orm.Event.data_provider, sqlalchemy.func.max(modelstatus.orm.Event.id)) \
+                        .group_by(modelstatus.orm.Event.data_provider)
+        return dict(query.all())
+
+    def send(self, frames):
+        """
+        Send a multipart message, retrying if interrupted.
+        """
         while True:
             try:
-                self.sock.send_json(msg)
+                self.sock.send_multipart(frames)
                 break
             except zmq.ZMQError, e:
                 if e.errno == errno.EINTR:
@@ -36,12 +122,144 @@ class ZMQPublisher(object):
                     continue
                 else:
                     raise
+
+    def publish_resource(self, resource):
+        msg = self.message_from_resource(resource)
+        if self.orm is not None:
+            try:
+                self.record_event(resource, msg)
+            except sqlalchemy.exc.SQLAlchemyError, e:
+                self.orm.rollback()
+                logging.error("Could not record event in database, publishing message without sequence number: %s" % unicode(e))
+        messages = [[self.topic_from_resource(resource), json.dumps(msg)]]
+        for codec in self.codecs:
+            messages += [[self.topic_from_resource(resource, codec), codec.encode(msg)]]
+
+        # Heartbeats must not announce a sequence number before its message
+        # has been sent
+        with self.lock:
+            for frames in messages:
+                self.send(frames)
+            if msg.get('sequence') is not None:
+                self.sequences[self.data_provider_from_resource(resource)] = msg['sequence']
         logging.info("Published ZeroMQ message: %s" % msg)
 
-    def message_from_resource(self, resource):
+    def make_heartbeat(self):
+        """
+        Return a heartbeat message.
+        """
         return {
+            'version': MESSAGE_PROTOCOL_VERSION,
+            'type': 'heartbeat',
+            'epoch': self.epoch,
+            'sequence': max(self.sequences.values()) if self.sequences else None,
+            'sequences': dict(self.sequences),
+            'codecs': ['json'] + [codec.name for codec in self.codecs],
+        }
+
+    def publish_heartbeat(self):
+        with self.lock:
+            self.send([HEARTBEAT_TOPIC, json.dumps(self.make_heartbeat())])
+
+    def start_heartbeat(self, interval=DEFAULT_HEARTBEAT_INTERVAL):
+        """
+        Publish a heartbeat message every `interval` seconds in a background
+        thread.
+        """
+        def run():
+            while not self.stopped.wait(interval):
+                try:
+                    self.publish_heartbeat()
+                except zmq.ZMQError, e:
+                    logging.error("Could not publish ZeroMQ heartbeat: %s" % unicode(e))
+
+        self.heartbeat_thread = threading.Thread(target=run, name='ZMQHeartbeat')
+        self.heartbeat_thread.daemon = True
+        self.heartbeat_thread.start()
+
+    def stop_heartbeat(self):
+        """
+        Stop publishing heartbeat messages.
+        """
+        self.stopped.set()
+        if self.heartbeat_thread is not None:
+            self.heartbeat_thread.join()
+
+    def record_event(self, resource, msg):
+        """
+        Store a message as an event in the database, and add the sequence
+        number of the event, and that of the previous event about the same
+        data provider, to the message.
+        """
+        data_provider = self.data_provider_from_resource(resource)
+        previous_id = self.orm.query(sqlalchemy.func.max(modelstatus.orm.Event.id)) \
+                              .filter(modelstatus.orm.Event.data_provider == data_provider) \
+                              .scalar()
+        event = modelstatus.orm.Event(data_provider=data_provider, previous_id=previous_id, message='')
+        self.orm.add(event)
+        self.orm.flush()
+        msg['sequence'] = event.id
+        msg['previous_sequence'] = previous_id
+        event.message = json.dumps(msg)
+        self.prune_events()
+        self.orm.commit()
+        return event
+
+    def prune_events(self):
+        """
+        Delete events beyond the retention limits. The latest event about
+        each data provider is always kept, so that new events can refer to
+        it, and so that the events kept about a data provider are always its
+        most recent ones. Returns the number of deleted events.
+        """
+        Event = modelstatus.orm.Event
+        conditions = []
+        if self.event_retention:
+            newest = self.orm.query(sqlalchemy.func.max(Event.id)).scalar() or 0
+            conditions += [Event.id <= newest - self.event_retention]
+        if self.event_max_age:
+            conditions += [Event.created_time < datetime.datetime.utcnow() - datetime.timedelta(seconds=self.event_max_age)]
+        if not conditions:
+            return 0
+        latest = self.orm.query(sqlalchemy.func.max(Event.id)).group_by(Event.data_provider)
+        count = self.orm.query(Event) \
+                        .filter(sqlalchemy.or_(*conditions)) \
+                        .filter(~Event.id.in_(latest.subquery())) \
+                        .delete(synchronize_session=False)
+        if count:
+            logging.info("Deleted %d events beyond the retention limits" % count)
+        return count
+
+    def data_provider_from_resource(self, resource):
+        """
+        Return the data provider a resource belongs to.
+        """
+        if isinstance(resource, modelstatus.orm.Data):
+            return resource.model_run.data_provider
+        return resource.data_provider
+
+    def topic_from_resource(self, resource, codec=None):
+        """
+        Return the topic frame of a message about a resource.
+        """
+        return make_topic(unicode(resource.__table__), self.data_provider_from_resource(resource), codec)
+
+    def message_from_resource(self, resource):
+        """
+        Return a message describing a created resource. Since version 1.2,
+        the message carries the complete serialized model run the resource
+        belongs to, and messages about data resources carry the id of their
+        model run, so that subscribers do not need to query the REST API.
+        """
+        msg = {
             'version': MESSAGE_PROTOCOL_VERSION,
             'type': 'resource',
             'resource': unicode(resource.__table__),
             'id': resource.id,
         }
+        if isinstance(resource, modelstatus.orm.Data):
+            msg['model_run_id'] = resource.model_run_id
+            msg['model_run'] = resource.model_run.serialize()
+        elif isinstance(resource, modelstatus.orm.ModelRun):
+            msg['model_run'] = resource.serialize()
+        return msg
@@ -4,17 +4,27 @@ import traceback
 import multiprocessing
 import logging
 import logging.config
-import os
 import re
 import sys
-import zmq
-import json
+import time
 import argparse
+import datetime
 import ConfigParser
+import dateutil.parser
 
 import syncer.wdb
+import syncer.agent
+import syncer.database
 import syncer.wdb2ts
 import syncer.utils
+import syncer.worker
+import syncer.maintenance
+import syncer.metrics
+import syncer.warmer
+import syncer.state
+import syncer.coalescer
+import syncer.replay
+import syncer.codec
 import syncer.zeromq
 
 import modelstatus
@@ -23,6 +33,23 @@ DEFAULT_CONFIG_PATH = '/etc/syncer.ini'
 DEFAULT_LOG_FILE_PATH = '/var/log/syncer.log'
 DEFAULT_LOG_LEVEL = 'DEBUG'
 DEFAULT_LOG_FORMAT = '%(asctime)s (%(levelname)s) %(message)s'
+DEFAULT_WORKERS = 4
+DEFAULT_AGENT_TIMEOUT = 3600
+DEFAULT_DATABASE_CONNECTIONS = 1
+DEFAULT_STATEMENT_TIMEOUT = 1800
+DEFAULT_ANALYZE_INTERVAL = 300
+DEFAULT_LOAD_TIMEOUT = 3600
+DEFAULT_PLACE_GRID = 'default'
+DEFAULT_MODEL_RUN_VERSION_RETENTION = 10080
+DEFAULT_EVENT_WINDOW = 5
+
+# How often to check for finished jobs while the worker pool is busy, in seconds
+JOB_POLL_INTERVAL = 1
+
+JOB_WDB_LOAD = 'wdb_load'
+JOB_WDB2TS_UPDATE = 'wdb2ts_update'
+JOB_ANALYZE = 'analyze'
+JOB_WDB2TS_WARMUP = 'wdb2ts_warmup'
 
 EXIT_SUCCESS = 0
 EXIT_CONFIG = 1
@@ -68,6 +95,12 @@ class Configuration(object):
     def get(self, section, key):
         return self.config_parser.get(section, key)
 
+    def get_optional(self, section, key, default=None):
+        """Return a configuration value, or `default` if the option is not set"""
+        if not self.config_parser.has_option(section, key):
+            return default
+        return self.get(section, key)
+
     def section_keys(self, section_name):
         return [x[0] for x in self.config_parser.items(section_name)]
 
@@ -75,11 +108,38 @@ class Configuration(object):
         return dict(self.config_parser.items(section_name))
 
 
+class DataReference(modelstatus.Data):
+    """
+    A data file in a ModelRunReference. Only the location of the file is known.
+    """
+    required_parameters = ['href']
+    id = None
+    model_run_id = None
+    format = None
+
+    def __repr__(self):
+        return "Data href=%s" % self.href
+
+
+class ModelRunReference(modelstatus.ModelRun):
+    """
+    A model run restored from the compact state format, containing the id,
+    reference time, version and the files matched by a model.
+    """
+    required_parameters = ['id', 'data_provider', 'reference_time', 'version', 'data']
+
+    def initialize(self):
+        self.reference_time = dateutil.parser.parse(self.reference_time)
+        self.created_date = None
+        self.data = [DataReference(x) for x in self.data]
+
+
 class Model(modelstatus.utils.SerializeBase):
     __serializable__ = ['data_provider', 'model_run_age_warning', 'model_run_age_critical',
                         'available_model_run', 'wdb_model_run', 'wdb2ts_model_run',
                         'available_updated', 'wdb_updated', 'wdb2ts_updated',
                         'model_run_version', '_available_model_run_initialized',
+                        'place_definitions', 'load_checkpoint', 'wdb2ts_host_model_run',
                         ]
 
     def __init__(self, data):
@@ -92,9 +152,12 @@ class Model(modelstatus.utils.SerializeBase):
         # Model run loaded into WDB
         self.wdb_model_run = None
 
-        # Model run used to update WDB2TS
+        # Model run used to update all WDB2TS hosts
         self.wdb2ts_model_run = None
 
+        # Model run used to update each WDB2TS host, keyed by base URL
+        self.wdb2ts_host_model_run = {}
+
         # Updated timestamps
         self.available_updated = None
         self.wdb_updated = None
@@ -104,9 +167,23 @@ class Model(modelstatus.utils.SerializeBase):
         self.must_update_wdb = False
         self.must_update_wdb2ts = False
 
+        # A --force which has not yet been applied, because a job was in flight
+        self.force_pending = False
+
+        # Model runs whose internal version has not yet been incremented,
+        # because a job using the current version was in flight
+        self.version_pending = []
+
         # Internal version increments of datasets
         self.model_run_version = {}
 
+        # Place names, of this data provider and a grid, whose place
+        # definitions have been loaded into WDB under that name
+        self.place_definitions = []
+
+        # Per-file load outcomes of the model run most recently loaded into WDB
+        self.load_checkpoint = None
+
     @staticmethod
     def data_from_config_section(config, section_name):
         """Return config options for a model. Raise exception if mandatory config option is missing"""
@@ -122,7 +199,7 @@ class Model(modelstatus.utils.SerializeBase):
         data = config.section_options(section_name)
         data['data_file_count'] = int(data['data_file_count'])
 
-        for param in ['model_run_age_warning', 'model_run_age_critical']:
+        for param in ['model_run_age_warning', 'model_run_age_critical', 'load_concurrency', 'load_timeout', 'model_run_version_retention']:
             if param in data:
                 data[param] = int(data[param])
 
@@ -160,6 +237,16 @@ class Model(modelstatus.utils.SerializeBase):
         if self.available_model_run:
             logging.info("Model %s has new model run: %s" % (self, self.available_model_run))
 
+    def has_available_model_run(self, model_run):
+        """
+        Returns True if `model_run` is the same model run and version as the
+        available model run, with the same matching files.
+        """
+        if self.available_model_run is None or model_run is None:
+            return False
+        hrefs = [[data.href for data in self.get_matching_data(x.data)] for x in (self.available_model_run, model_run)]
+        return (self.available_model_run.id, self.available_model_run.version, hrefs[0]) == (model_run.id, model_run.version, hrefs[1])
+
     def model_run_initialized(self):
         """
         Return True if this Model has a ModelRun available.
@@ -200,6 +287,30 @@ class Model(modelstatus.utils.SerializeBase):
             return self.available_model_run.id != self.wdb_model_run.id
         return False
 
+    def set_wdb2ts_host_model_run(self, base_url, model_run):
+        """
+        Record the model run that has been used to update a single WDB2TS host.
+        """
+        self._validate_model_run(model_run)
+        host_model_run = dict(self.wdb2ts_host_model_run)
+        host_model_run[base_url] = model_run
+        self.wdb2ts_host_model_run = host_model_run
+        logging.info("Model %s has been updated in WDB2TS at %s, model run: %s" % (self, base_url, model_run))
+
+    def get_pending_wdb2ts_hosts(self, base_urls):
+        """
+        Return the subset of WDB2TS hosts in `base_urls` that have not yet been
+        updated with the model run loaded into WDB.
+        """
+        if self.wdb_model_run is None:
+            return []
+        pending = []
+        for base_url in base_urls:
+            model_run = self.wdb2ts_host_model_run.get(base_url)
+            if model_run is None or model_run.id != self.wdb_model_run.id:
+                pending += [base_url]
+        return pending
+
     def has_pending_wdb2ts_update(self):
         """
         Returns True if the model run loaded into WDB has not been used to update WDB2TS yet.
@@ -220,9 +331,12 @@ class Model(modelstatus.utils.SerializeBase):
 
     def set_must_update_wdb2ts(self, value):
         """
-        Override internal state of WDB2TS model run
+        Override internal state of WDB2TS model run. Forcing an update also
+        makes all WDB2TS hosts pending.
         """
         self.must_update_wdb2ts = value
+        if value:
+            self.wdb2ts_host_model_run = {}
 
     def get_matching_data(self, dataset):
         """
@@ -252,8 +366,22 @@ class Model(modelstatus.utils.SerializeBase):
         """
         Set the internal version of a model run.
         """
-        key = self.get_model_run_key(model_run)
-        self.model_run_version[key] = version
+        model_run_version = dict(self.model_run_version)
+        model_run_version[self.get_model_run_key(model_run)] = version
+        self.model_run_version = self.prune_model_run_version(model_run_version)
+
+    def prune_model_run_version(self, model_run_version):
+        """
+        Return a copy of `model_run_version` without the internal versions of
+        reference times older than `model_run_version_retention` minutes
+        before the most recent reference time.
+        """
+        if not model_run_version:
+            return {}
+        retention = datetime.timedelta(minutes=getattr(self, 'model_run_version_retention', DEFAULT_MODEL_RUN_VERSION_RETENTION))
+        reference_times = dict([(key, dateutil.parser.parse(key)) for key in model_run_version])
+        oldest = max(reference_times.values()) - retention
+        return dict([(key, value) for key, value in model_run_version.iteritems() if reference_times[key] >= oldest])
 
     def get_model_run_version(self, model_run):
         """
@@ -277,6 +405,93 @@ class Model(modelstatus.utils.SerializeBase):
         """
         self.set_model_run_version(model_run, self.get_internal_model_run_version(model_run) + 1)
 
+    def get_place_grid(self):
+        """
+        Return the name of the grid used by this model's data files, as
+        configured by the `place_grid` option.
+        """
+        return getattr(self, 'place_grid', DEFAULT_PLACE_GRID)
+
+    def get_place_name(self):
+        """
+        Return the WDB place name of this model's grid. A configured
+        `place_name` takes precedence over the generated name.
+        """
+        if hasattr(self, 'place_name'):
+            return self.place_name
+        return '%s %s' % (self.data_provider, self.get_place_grid())
+
+    def needs_place_definition(self):
+        """
+        Returns True if the place definition for this model's data provider
+        and grid must be loaded into WDB together with the next data file.
+        """
+        if hasattr(self, 'place_name'):
+            return False
+        return self.get_place_name() not in self.place_definitions
+
+    def set_place_definition_loaded(self):
+        """
+        Remember that the place definition for this model's data provider and
+        grid has been loaded into WDB under its place name.
+        """
+        if self.get_place_name() not in self.place_definitions:
+            self.place_definitions = self.place_definitions + [self.get_place_name()]
+            logging.info("Place definition '%s' has been loaded into WDB" % self.get_place_name())
+
+    def reset_place_definition(self):
+        """
+        Forget that the place definition for this model's data provider and
+        grid has been loaded, so that it is loaded again with the next file.
+        """
+        if self.get_place_name() in self.place_definitions:
+            self.place_definitions = [x for x in self.place_definitions if x != self.get_place_name()]
+            logging.info("Place definition '%s' will be loaded into WDB again" % self.get_place_name())
+
+    def _load_checkpoint_matches(self, model_run):
+        """
+        Returns True if the load checkpoint belongs to the specified model run
+        and its current version.
+        """
+        if self.load_checkpoint is None:
+            return False
+        key = (self.load_checkpoint['model_run_id'], self.load_checkpoint['version'])
+        return key == (model_run.id, self.get_model_run_version(model_run))
+
+    def get_loaded_files(self, model_run):
+        """
+        Return a list of files from the specified model run and version that
+        have already been loaded successfully into WDB.
+        """
+        if not self._load_checkpoint_matches(model_run):
+            return []
+        return sorted([key for key, value in self.load_checkpoint['files'].iteritems() if value])
+
+    def set_load_results(self, model_run, results):
+        """
+        Record the outcome of loading files from a model run into WDB.
+        `results` is a list of WDBLoadResult objects.
+        """
+        files = {}
+        if self._load_checkpoint_matches(model_run):
+            files.update(self.load_checkpoint['files'])
+        for result in results:
+            files[result.modelfile] = result.success()
+
+        # Replaced instead of updated, since the model may be serialized from
+        # the main thread at the same time.
+        self.load_checkpoint = {
+            'model_run_id': model_run.id,
+            'version': self.get_model_run_version(model_run),
+            'files': files,
+        }
+
+    def reset_load_checkpoint(self):
+        """
+        Forget all recorded file load outcomes, so that the next load starts over.
+        """
+        self.load_checkpoint = None
+
     def get_monitoring_state(self):
         """
         Return monitoring state: OK, WARNING or CRITICAL
@@ -290,8 +505,21 @@ class Model(modelstatus.utils.SerializeBase):
             return MONITORING_WARNING
         return MONITORING_OK
 
-    def _serialize_model_run(self, value):
-        return value.serialize() if self._valid_model_run(value) else None
+    def _serialize_model_run(self, value, data=True):
+        """
+        Return the compact representation of a model run: its id, reference
+        time, version, and optionally the data files matched by this model.
+        """
+        if not self._valid_model_run(value):
+            return None
+        serialized = {
+            'id': value.id,
+            'reference_time': value.serialize_reference_time(value.reference_time),
+            'version': value.version,
+        }
+        if data:
+            serialized['data'] = [{'href': x.href} for x in self.get_matching_data(value.data)]
+        return serialized
 
     def serialize_available_model_run(self, value):
         return self._serialize_model_run(value)
@@ -302,6 +530,9 @@ class Model(modelstatus.utils.SerializeBase):
     def serialize_wdb2ts_model_run(self, value):
         return self._serialize_model_run(value)
 
+    def serialize_wdb2ts_host_model_run(self, value):
+        return dict([(key, self._serialize_model_run(model_run, False)) for key, model_run in value.iteritems()])
+
     def serialize_available_updated(self, value):
         return self._serialize_datetime(value) if value else None
 
@@ -312,7 +543,17 @@ class Model(modelstatus.utils.SerializeBase):
         return self._serialize_datetime(value) if value else None
 
     def _unserialize_model_run(self, value):
-        return modelstatus.ModelRun(value) if value else None
+        """
+        Restore a model run from its compact representation. Full model run
+        documents written by earlier versions of Syncer are still accepted.
+        """
+        if not value:
+            return None
+        if 'created_date' in value:
+            return modelstatus.ModelRun(value)
+        reference = {'data_provider': self.data_provider, 'data': []}
+        reference.update(value)
+        return ModelRunReference(reference)
 
     def unserialize_available_model_run(self, value):
         return self._unserialize_model_run(value)
@@ -323,6 +564,9 @@ class Model(modelstatus.utils.SerializeBase):
     def unserialize_wdb2ts_model_run(self, value):
         return self._unserialize_model_run(value)
 
+    def unserialize_wdb2ts_host_model_run(self, value):
+        return dict([(key, self._unserialize_model_run(model_run)) for key, model_run in value.iteritems()])
+
     def unserialize_available_updated(self, value):
         return self._unserialize_datetime(value) if value else None
 
@@ -332,12 +576,23 @@ class Model(modelstatus.utils.SerializeBase):
     def unserialize_wdb2ts_updated(self, value):
         return self._unserialize_datetime(value) if value else None
 
+    def unserialize(self, data):
+        """
+        Load internal data structure from JSON decoded dictionary. Keys
+        missing from state files written by earlier versions of Syncer keep
+        their default values.
+        """
+        defaults = self.serialize()
+        defaults.update(data)
+        super(Model, self).unserialize(defaults)
+        self.model_run_version = self.prune_model_run_version(self.model_run_version)
+
     def __repr__(self):
         return self.data_provider
 
 
 class Daemon(object):
-    def __init__(self, config, models, zmq_subscriber, zmq_agent, wdb, wdb2ts, model_run_collection, data_collection, tick, state_file):
+    def __init__(self, config, models, zmq_subscriber, zmq_agent, wdb, wdb2ts, model_run_collection, data_collection, tick, state_file, worker_pool, analyze_scheduler, metrics, warmer, zmq_ingress, event_coalescer, event_replay):
         self.config = config
         self.models = models
         self.zmq_subscriber = zmq_subscriber
@@ -348,11 +603,22 @@ class Daemon(object):
         self.data_collection = data_collection
         self.tick = tick
         self.state_file = state_file
-
-        # Set up polling on the ZeroMQ sockets
-        self.zmq_poller = zmq.Poller()
-        self.zmq_poller.register(self.zmq_subscriber.sock, zmq.POLLIN)
-        self.zmq_poller.register(self.zmq_agent.sub, zmq.POLLIN)
+        self.state_store = syncer.state.StateStore(state_file)
+        self.state_dirty = False
+        self.worker_pool = worker_pool
+        self.analyze_scheduler = analyze_scheduler
+        self.metrics = metrics
+        self.warmer = warmer
+        self.zmq_ingress = zmq_ingress
+        self.event_coalescer = event_coalescer
+        self.event_replay = event_replay
+        self.next_poll = 0
+
+        # Models covered by the WDB2TS update jobs in flight, keyed by base URL
+        self.wdb2ts_host_models = {}
+
+        # Services waiting for a cache warm-up, keyed by base URL
+        self.warm_pending = {}
 
         if not isinstance(models, set):
             raise TypeError("'models' must be a set of models")
@@ -365,6 +631,9 @@ class Daemon(object):
         for num, model in enumerate(self.models):
             logging.info(" %2d of %2d: %s" % (num + 1, num_models, model.data_provider))
         logging.info("Main loop interval set to %d seconds.", self.tick)
+        logging.info("Running WDB loads and WDB2TS updates in %d worker threads.", self.worker_pool.num_workers)
+        if self.analyze_scheduler:
+            logging.info("Running ANALYZE at most once every %d seconds after loading models.", self.analyze_scheduler.interval)
 
         state = self.read_state_file()
         try:
@@ -375,33 +644,24 @@ class Daemon(object):
 
     def read_state_file(self):
         """
-        Read JSON state information from a file into a dictionary.
+        Read JSON state information from the state file and its journal into
+        a dictionary.
         """
         logging.info("Loading state information from %s" % self.state_file)
         try:
-            with open(self.state_file, 'r') as f:
-                contents = f.read().strip()
-            if not contents:
-                return {}
-            return json.loads(contents)
+            return self.state_store.read()
         except ValueError:
             logging.critical("Syntax error in state file, expecting valid JSON")
             raise
-        except IOError:
-            if os.path.isfile(self.state_file):
-                raise
-            logging.info("File does not exist, continuing with blank slate.")
-        return {}
 
     def write_state_file(self, state):
         """
-        Write JSON state information into a file.
+        Write JSON state information into the state file journal.
         """
-        logging.info("Writing state information to %s" % self.state_file)
+        logging.debug("Writing state information to %s" % self.state_file)
         try:
-            with open(self.state_file, 'w') as f:
-                json.dump(state, f, sort_keys=True, indent=4)
-        except IOError, e:
+            self.state_store.write(state)
+        except (IOError, OSError), e:
             logging.error("Error writing state file: %s" % unicode(e))
 
     def load_state(self, state):
@@ -426,8 +686,18 @@ class Daemon(object):
 
     def write_state(self):
         """
-        Shortcut to make_state and write_state_file.
+        Mark the state as changed. The state is written once per main loop
+        iteration, by flush_state.
+        """
+        self.state_dirty = True
+
+    def flush_state(self):
+        """
+        Shortcut to make_state and write_state_file, if the state has changed.
         """
+        if not self.state_dirty:
+            return
+        self.state_dirty = False
         state = self.make_state()
         return self.write_state_file(state)
 
@@ -437,7 +707,11 @@ class Daemon(object):
         """
         logging.debug("Synchronizing model status with ZeroMQ controller.")
         model_list = [model.serialize() for model in self.models]
-        self.zmq_agent.sync_status({'models': model_list})
+        publisher = {
+            'epoch': self.zmq_subscriber.epoch,
+            'last_heartbeat': self.zmq_subscriber.last_heartbeat,
+        }
+        self.zmq_agent.sync_status({'models': model_list, 'metrics': self.metrics.serialize(), 'publisher': publisher})
 
     def get_latest_model_run(self, model):
         """Fetch the latest model run from REST API, and assign it to the provided Model."""
@@ -468,44 +742,152 @@ class Daemon(object):
             logging.error("REST API threw up with an exception: %s" % e)
 
     def handle_zmq_event(self, event):
+        """
+        Collect a Modelstatus event, to be handled together with other events
+        arriving within the event coalescing window.
+        """
         logging.info("Received %s" % unicode(event))
-        if event.resource == 'model_run':
-            id = event.id
-        elif event.resource == 'data':
-            try:
-                data_object = self.data_collection.get_object(event.id)
-            except syncer.exceptions.RESTException, e:
-                logging.error("Server returned invalid resource: %s" % e)
-                return
-            id = data_object.model_run_id
-        else:
+        if event.resource not in ('model_run', 'data'):
             logging.info("Nothing to do with this kind of event; no action taken.")
             return
+        self.event_coalescer.add(event.resource, event.id, event.model_run_id, event.get_model_run())
+        if self.event_coalescer.is_due():
+            self.main_loop_events()
 
-        self.load_model_run(id, False)
+    def handle_zmq_heartbeat(self, heartbeat):
+        """
+        Replay any events announced by a heartbeat from the Modelstatus
+        publisher that have not been received, and pass the time of the
+        heartbeat on to the ZeroMQ controller.
+        """
+        logging.debug("Received %s" % unicode(heartbeat))
+        for data_provider, after, before in self.zmq_subscriber.check_heartbeat(heartbeat):
+            self.replay_events(data_provider, after, before)
+        self.sync_zmq_status()
 
-    def load_model_run(self, id, forced):
+    def replay_events(self, data_provider, after, before):
         """
-        Download model run information from Modelstatus, and set it as an available model run
+        Fetch events about a data provider that were published, but never
+        received, from the REST API, and handle them as if they had arrived
+        through ZeroMQ. If the events cannot be fetched, the latest model run
+        of the data provider is fetched instead.
+        """
+        logging.warning("Missed ZeroMQ events about %s between sequence numbers %d and %d, replaying them from the REST API..." % (data_provider, after, before))
+        try:
+            messages = self.event_replay.get_events(data_provider, after, before)
+        except syncer.exceptions.RESTException, e:
+            if isinstance(e, syncer.exceptions.EventReplayGapTooOld):
+                logging.error("Missed events are no longer kept by Modelstatus, fetching latest model run instead: %s" % e)
+                self.metrics.increment('zmq_replay_gaps_too_old')
+            else:
+                logging.error("Could not replay missed events, fetching latest model run instead: %s" % e)
+            for model in self.models:
+                if model.data_provider == data_provider:
+                    self.get_latest_model_run(model)
+            return
+        self.metrics.increment('zmq_events_replayed', len(messages))
+        for msg in messages:
+            zmq_event = self.zmq_subscriber.parse_event(msg)
+            if zmq_event:
+                self.handle_zmq_event(zmq_event)
+
+    def main_loop_events(self):
+        """
+        Handle the Modelstatus events collected during the last coalescing
+        window. Model runs embedded in the events are used directly, and other
+        model runs are fetched at most once. Data events without a model run
+        id are only resolved through the REST API if their model run has not
+        been fetched already.
+        """
+        if not self.event_coalescer.is_due():
+            return
+        model_run_ids, data_ids, payloads = self.event_coalescer.take()
+        data_ids = set(data_ids)
+        fetched = set()
+
+        def load(id):
+            fetched.add(id)
+            model_run_object = payloads.get(id) or self.get_model_run(id)
+            if model_run_object is not None:
+                data_ids.difference_update([data.id for data in model_run_object.data])
+                self.set_model_run(model_run_object, False)
+
+        for id in model_run_ids:
+            load(id)
+
+        while data_ids:
+            try:
+                data_object = self.data_collection.get_object(data_ids.pop())
+            except syncer.exceptions.RESTException, e:
+                logging.error("Server returned invalid resource: %s" % e)
+                continue
+            if data_object.model_run_id not in fetched:
+                load(data_object.model_run_id)
+
+    def get_model_run(self, id):
+        """
+        Download model run information from Modelstatus. Returns None if the
+        model run could not be fetched.
         """
         try:
-            model_run_object = self.model_run_collection.get_object(id)
+            return self.model_run_collection.get_object(id)
         except syncer.exceptions.RESTException, e:
             logging.error("Server returned invalid resource: %s" % e)
+            return None
+
+    def load_model_run(self, id, forced):
+        """
+        Download model run information from Modelstatus, and set it as an available model run
+        """
+        model_run_object = self.get_model_run(id)
+        if model_run_object is None:
             return False
+        return self.set_model_run(model_run_object, forced)
 
+    def set_model_run(self, model_run_object, forced):
+        """
+        Set a model run from Modelstatus as the available model run of the
+        model it belongs to. Returns False if no such model is configured.
+        """
         for model in self.models:
             if model.data_provider == model_run_object.data_provider:
                 self.set_available_model_run(model, model_run_object, forced)
                 if forced:
-                    logging.warning("Forcing WDB load and WDB2TS update for model run %d" % id)
-                    model.set_must_update_wdb(True)
-                    model.set_must_update_wdb2ts(True)
+                    logging.warning("Forcing WDB load and WDB2TS update for model run %d" % model_run_object.id)
+                    model.force_pending = True
+                    self.apply_force(model)
                 return True
 
         logging.info("Syncer is not configured to load model '%s', no action taken" % model_run_object.data_provider)
         return False
 
+    def apply_force(self, model):
+        """
+        Make a model reload its available model run into WDB and update all
+        WDB2TS hosts. If a job is in flight for the model, the force is kept
+        pending until that job has finished, as the job's result would
+        otherwise clear it.
+        """
+        if self.is_busy(model):
+            logging.info("Model %s has a job in flight, forced load will start when it has finished." % model)
+            return
+        model.reset_load_checkpoint()
+        model.reset_place_definition()
+        model.set_must_update_wdb(True)
+        model.set_must_update_wdb2ts(True)
+        model.force_pending = False
+
+    def apply_version_pending(self, model):
+        """
+        Increment the internal versions that were deferred while a job was in
+        flight for the model, so that a single job never sees two versions of
+        the same model run.
+        """
+        for model_run in model.version_pending:
+            model.increment_model_run_version(model_run)
+        model.version_pending = []
+        self.write_state()
+
     def handle_zmq_command(self, tokens):
         """
         Execute a command from the internal command queue.
@@ -515,12 +897,18 @@ class Daemon(object):
 
         if tokens['command'] == 'load':
             self.load_model_run(tokens['model_run_id'], tokens['force'])
+        elif tokens['command'] == 'resync':
+            self.zmq_agent.request_resync()
+            self.sync_zmq_status()
 
     def set_available_model_run(self, model, model_run, forced):
         """
         Check if a model run contains data sets, and set it as an available model run
         """
         if model_run is not None:
+            if not forced and model.has_available_model_run(model_run):
+                logging.debug("Model run %s is already available for model %s, no action taken." % (model_run.id, model))
+                return
             if len(model_run.data) == 0:
                 logging.warn("Model run %s contains no data, discarding." % model_run.id)
                 return
@@ -531,7 +919,11 @@ class Daemon(object):
                     logging.warn("Model run %s is not complete, discarding." % model_run.id)
                     return
 
-            model.increment_model_run_version(model_run)
+            if self.is_busy(model):
+                logging.info("Model %s has a job in flight, deferring version increment of model run %s until it has finished." % (model, model_run.id))
+                model.version_pending = model.version_pending + [model_run]
+            else:
+                model.increment_model_run_version(model_run)
 
         model.set_available_model_run(model_run)
         self.sync_zmq_status()
@@ -539,47 +931,171 @@ class Daemon(object):
 
     def load_model(self, model):
         """
-        Load the latest model run of a certain model into WDB
+        Submit a job that loads the latest model run of a certain model into WDB
         """
         logging.info("Loading model %s into WDB..." % model)
+        model_run = model.available_model_run
+        self.worker_pool.submit(model, JOB_WDB_LOAD, model_run, self.run_load_model, model, model_run)
+
+    def run_load_model(self, model, model_run):
+        """
+        Load a model run into WDB and cache it. Runs in a worker thread.
+        ANALYZE is run as part of this job only if there is no ANALYZE
+        scheduler.
+        """
+        self.wdb.load_model_run(model, model_run)
+        self.wdb.cache_model_run(model_run, self.analyze_scheduler is None)
 
+    def finish_load_model(self, job):
+        """
+        Apply the result of a WDB load job.
+        """
         try:
-            self.wdb.load_model_run(model, model.available_model_run)
-            self.wdb.cache_model_run(model.available_model_run)
-            model.set_wdb_model_run(model.available_model_run)
+            job.get()
+            job.model.set_wdb_model_run(job.model_run)
+            if self.analyze_scheduler:
+                self.analyze_scheduler.request(job.model_run)
             self.sync_zmq_status()
             self.write_state()
 
+        except syncer.exceptions.WDBLoadTimeout, e:
+            logging.error("WDB load timed out: %s" % e)
+            self.write_state()
         except syncer.exceptions.WDBLoadFailed, e:
             logging.error("WDB load failed: %s" % e)
+            self.write_state()
         except syncer.exceptions.OpdataURIException, e:
             logging.error("Failed to load some model data due to erroneous opdata uri: %s" % e)
         except syncer.exceptions.WDBCacheFailed, e:
             logging.error("Failed to cache model data, will try loading again: %s" % e)
 
-    def update_wdb2ts(self, model):
+    def is_busy(self, model):
+        """
+        Returns True if a job is in flight for the specified model, including
+        a WDB2TS update job covering several models.
+        """
+        if self.worker_pool.busy(model):
+            return True
+        return any([model in models for models in self.wdb2ts_host_models.values()])
+
+    def update_wdb2ts(self, host, models):
+        """
+        Submit a single job that updates one WDB2TS host with new model
+        information for several models. Only one such job runs for each host
+        at any given time, so that a slow host does not delay the others.
+        """
+        batch = []
+        for model in models:
+            logging.info("Updating model %s in WDB2TS at %s..." % (model, host.base_url))
+            batch += [(model, model.wdb_model_run)]
+        if self.worker_pool.submit(host, JOB_WDB2TS_UPDATE, None, self.run_update_wdb2ts, host, batch):
+            self.wdb2ts_host_models[host.base_url] = set(models)
+
+    def run_update_wdb2ts(self, host, batch):
         """
-        Update WDB2TS with new model information.
+        Load status information from a WDB2TS host if needed, and update it
+        with model runs. Runs in a worker thread. Returns the batch, and an
+        exception or None for each model.
         """
-        logging.info("Updating model %s in WDB2TS..." % model)
+        return batch, host.update_wdb2ts_host(batch)
 
+    def finish_update_wdb2ts(self, job):
+        """
+        Apply the result of a WDB2TS update job. Each model that was updated
+        successfully is recorded, even if other models failed.
+        """
+        host = job.model
+        self.wdb2ts_host_models.pop(host.base_url, None)
+        batch, errors = job.get()
+        updated = set()
+        for (model, model_run), error in zip(batch, errors):
+            if error is None:
+                model.set_wdb2ts_host_model_run(host.base_url, model_run)
+                updated.add(model.get_data_provider_or_group())
+            elif isinstance(error, syncer.exceptions.WDB2TSMissingContentException):
+                logging.critical("Error in WDB2TS configuration at %s: %s", host.base_url, unicode(error))
+            else:
+                logging.error("Failed to update model %s in WDB2TS at %s: %s" % (model, host.base_url, unicode(error)))
+
+            if not model.get_pending_wdb2ts_hosts(self.wdb2ts.get_base_urls()):
+                model.set_wdb2ts_model_run(model_run)
+        self.sync_zmq_status()
+        self.write_state()
+        if updated:
+            self.warm_wdb2ts({host.base_url: updated})
+
+    def warm_wdb2ts(self, updated):
+        """
+        Submit a job that warms the caches of updated WDB2TS services, if a
+        cache warmer is configured. `updated` maps the base URL of each host to
+        the data providers that were updated on that host. Services updated
+        while a warm-up is running are warmed up when it has finished.
+        """
+        if self.warmer is None:
+            return
+        for host in self.wdb2ts.hosts:
+            if host.base_url in updated:
+                pending = self.warm_pending.setdefault(host.base_url, set())
+                for data_provider in updated[host.base_url]:
+                    pending.update(host.get_services(data_provider))
+        if not self.warm_pending or self.worker_pool.busy(self.warmer):
+            return
+        targets = [(base_url, sorted(services)) for base_url, services in sorted(self.warm_pending.iteritems())]
+        self.warm_pending = {}
+        self.worker_pool.submit(self.warmer, JOB_WDB2TS_WARMUP, None, self.warmer.warm, targets)
+
+    def finish_warm_wdb2ts(self, job):
+        """
+        Called when a WDB2TS cache warm-up job has finished. Warm-up failures
+        never affect the model status.
+        """
         try:
-            self.wdb2ts.update_wdb2ts(model, model.wdb_model_run)
-            model.set_wdb2ts_model_run(model.wdb_model_run)
-            self.sync_zmq_status()
-            self.write_state()
+            job.get()
+        except Exception, e:
+            logging.error("WDB2TS cache warm-up failed: %s" % unicode(e))
+        self.warm_wdb2ts({})
+
+    def run_analyze(self):
+        """
+        Submit a job that runs all pending ANALYZE requests, if they are due.
+        """
+        if not self.analyze_scheduler or not self.analyze_scheduler.is_due():
+            return
+        if self.worker_pool.busy(self.analyze_scheduler):
+            return
+        data_providers = self.analyze_scheduler.start()
+        logging.info("Running ANALYZE after loading %s" % ', '.join(data_providers))
+        self.worker_pool.submit(self.analyze_scheduler, JOB_ANALYZE, None, self.wdb.analyze, self.analyze_scheduler.tables)
 
-        except syncer.exceptions.WDB2TSException, e:
-            logging.error("Failed to update WDB2TS: %s" % unicode(e))
+    def finish_analyze(self, job):
+        """
+        Apply the result of an ANALYZE job.
+        """
+        try:
+            job.get()
+            self.analyze_scheduler.finish(True)
+        except syncer.exceptions.WDBAnalyzeFailed, e:
+            logging.error("Failed to run ANALYZE, will try again later: %s" % e)
+            self.analyze_scheduler.finish(False)
 
     def main_loop_poll(self):
         """
         If ZeroMQ events do not arrive, Syncer might not load a model.
         This function will make sure that the REST API server is explicitly
         checked for updated model data if Syncer is currently issuing a WARNING
-        or CRITICAL state for that model.
+        or CRITICAL state for that model. Models receiving sequenced events
+        are skipped, as lost events are replayed as soon as they are detected.
+
+        This check runs at most once per main loop interval.
         """
+        now = time.time()
+        if now < self.next_poll:
+            return
+        self.next_poll = now + self.tick
+
         for model in self.models:
+            if self.zmq_subscriber.is_sequenced(model.data_provider):
+                continue
             state = model.get_monitoring_state()
             if state == MONITORING_WARNING:
                 state = 'WARNING'
@@ -593,30 +1109,62 @@ class Daemon(object):
 
     def main_loop_zmq(self):
         """
-        Check if we've got something from the Modelstatus ZeroMQ publisher or
-        the internal command queue.  This function will block for the amount of
-        seconds defined in the configuration option `syncer.tick`.
-        """
-
-        events = dict(self.zmq_poller.poll(self.tick * 1000))
-        if not events:
-            return None
-
-        if self.zmq_subscriber.sock in events:
-            zmq_event = self.zmq_subscriber.get_event()
-            if zmq_event:
-                self.handle_zmq_event(zmq_event)
+        Process events from the Modelstatus ZeroMQ publisher and commands from
+        the internal command queue, as buffered by the ZeroMQ ingress thread.
+        This function will block for the amount of seconds defined in the
+        configuration option `syncer.tick`, or for JOB_POLL_INTERVAL seconds if
+        there are jobs running in the worker pool, until a batch of messages
+        arrives.
+        """
+
+        timeout = self.tick
+        if self.worker_pool.pending():
+            timeout = min(timeout, JOB_POLL_INTERVAL)
+        if self.analyze_scheduler and self.analyze_scheduler.time_until_due() is not None:
+            timeout = min(timeout, self.analyze_scheduler.time_until_due())
+        if self.event_coalescer.time_until_due() is not None:
+            timeout = min(timeout, self.event_coalescer.time_until_due())
+
+        for kind, msg in self.zmq_ingress.get_batch(timeout):
+            if kind == syncer.zeromq.INGRESS_EVENT:
+                zmq_event = self.zmq_subscriber.parse_event(msg)
+                if isinstance(zmq_event, syncer.zeromq.ZMQHeartbeatEvent):
+                    self.handle_zmq_heartbeat(zmq_event)
+                elif zmq_event:
+                    after = self.zmq_subscriber.check_sequence(zmq_event)
+                    if after is not None:
+                        self.replay_events(zmq_event.data_provider, after, zmq_event.sequence)
+                    self.handle_zmq_event(zmq_event)
+            elif kind == syncer.zeromq.INGRESS_COMMAND:
+                self.handle_zmq_command(msg)
+
+        # Events may have been lost, so check all models with the REST API
+        if self.zmq_ingress.take_overflow():
+            logging.warning("ZeroMQ events have been dropped, fetching latest model runs from API...")
+            for model in self.models:
+                self.get_latest_model_run(model)
 
-        if self.zmq_agent.sub in events:
-            zmq_command = self.zmq_agent.get_command()
-            self.handle_zmq_command(zmq_command)
+    def main_loop_jobs(self):
+        """
+        Apply the results of jobs that have finished running in the worker pool.
+        """
+        for job in self.worker_pool.collect():
+            if job.kind == JOB_WDB_LOAD:
+                self.finish_load_model(job)
+            elif job.kind == JOB_WDB2TS_UPDATE:
+                self.finish_update_wdb2ts(job)
+            elif job.kind == JOB_WDB2TS_WARMUP:
+                self.finish_warm_wdb2ts(job)
+            elif job.kind == JOB_ANALYZE:
+                self.finish_analyze(job)
 
     def main_loop_inner(self):
         """
         This function is a single iteration in the main loop.
         It checks for ZeroMQ messages, downloads model run information from the
-        Modelstatus REST API service, loads data into WDB, and updates WDB2TS
-        if applicable.
+        Modelstatus REST API service, and submits jobs that load data into WDB
+        and update WDB2TS if applicable. Models which already have a job
+        running in the worker pool are skipped.
         """
 
         # Try to initialize all un-initialized models with current model run status
@@ -627,30 +1175,30 @@ class Daemon(object):
 
         # Loop through models and see which are not loaded into WDB yet
         for model in self.models:
+            if self.is_busy(model):
+                continue
+            if model.version_pending:
+                self.apply_version_pending(model)
+            if model.force_pending:
+                self.apply_force(model)
             if model.has_pending_wdb_load():
                 logging.info("Model %s has a new model run, not yet loaded into WDB." % model)
                 self.load_model(model)
 
-        # Loop through models again, and see which are loaded into WDB but not yet used to update WDB2TS
-        update_models = []
-        for model in self.models:
-            if model.has_pending_wdb2ts_update():
-                update_models += [model]
-
-        # Fetch new WDB2TS status information if a model needs updating
-        if update_models:
-            try:
-                self.wdb2ts.load_status()
-            except syncer.exceptions.WDB2TSMissingContentException, e:
-                logging.critical("Error in WDB2TS configuration: %s", unicode(e))
-            except syncer.exceptions.WDB2TSServerException, e:
-                logging.error("Can not fetch WDB2TS status information: %s", unicode(e))
-            else:
-
-                # Update all models in WDB2TS
-                for model in update_models:
-                    logging.info("WDB2TS is out of sync with WDB on model %s" % model)
-                    self.update_wdb2ts(model)
+        # Submit an update job to each WDB2TS host that is out of sync with WDB
+        # on any model. Status information is fetched by the job itself.
+        for host in self.wdb2ts.hosts:
+            if self.worker_pool.busy(host):
+                continue
+            update_models = []
+            for model in self.models:
+                if self.worker_pool.busy(model):
+                    continue
+                if model.get_pending_wdb2ts_hosts([host.base_url]):
+                    logging.info("WDB2TS at %s is out of sync with WDB on model %s" % (host.base_url, model))
+                    update_models += [model]
+            if update_models:
+                self.update_wdb2ts(host, update_models)
 
     def run(self):
         """Responsible for running the main loop. Returns the program exit code."""
@@ -658,16 +1206,26 @@ class Daemon(object):
 
         self.sync_zmq_status()
         self.write_state()
+        self.flush_state()
+        self.zmq_ingress.start()
 
         try:
             while True:
                 self.main_loop_poll()
+                self.main_loop_events()
+                self.main_loop_jobs()
                 self.main_loop_inner()
+                self.run_analyze()
                 self.main_loop_zmq()
+                self.flush_state()
 
         except KeyboardInterrupt:
             logging.info("Terminated by SIGINT")
 
+        self.zmq_ingress.stop()
+        self.worker_pool.terminate()
+        self.flush_state()
+
         logging.info("Daemon is terminating.")
         return EXIT_SUCCESS
 
@@ -702,11 +1260,44 @@ def run(argv):
         return EXIT_LOGGING
 
     try:
-        wdb = syncer.wdb.WDB(config.get('wdb', 'host'), config.get('wdb', 'ssh_user'))
+        wdb_host = config.get('wdb', 'host')
+        wdb_user = config.get('wdb', 'ssh_user')
+        ssh_connections = int(config.get_optional('wdb', 'ssh_connections', 0))
+        ssh_pool = None
+        if ssh_connections > 0:
+            ssh_pool = syncer.wdb.SSHConnectionPool(wdb_host, wdb_user, ssh_connections, config.get_optional('wdb', 'ssh_control_dir'))
+            logging.info("Using %d persistent SSH connections to WDB host %s" % (ssh_connections, wdb_host))
+        agent = None
+        agent_socket = config.get_optional('wdb', 'agent_socket')
+        if agent_socket:
+            agent = syncer.agent.LoadAgentClient(agent_socket, int(config.get_optional('wdb', 'agent_timeout', DEFAULT_AGENT_TIMEOUT)),
+                                                 config.get_optional('wdb', 'agent_key'))
+            logging.info("Submitting WDB load and cache jobs to load agent at %s" % agent_socket)
+        database = None
+        if config.get_optional('wdb', 'cache_backend', 'ssh') == 'database':
+            database = syncer.database.WDBDatabase.from_dsn(
+                config.get('wdb', 'database_dsn'),
+                int(config.get_optional('wdb', 'database_connections', DEFAULT_DATABASE_CONNECTIONS)),
+                int(config.get_optional('wdb', 'statement_timeout', DEFAULT_STATEMENT_TIMEOUT)),
+            )
+            logging.info("Running WDB cache queries directly against the database")
+        load_timeout = int(config.get_optional('wdb', 'load_timeout', DEFAULT_LOAD_TIMEOUT))
+        metrics = syncer.metrics.Metrics()
+        wdb = syncer.wdb.WDB(wdb_host, wdb_user, ssh_pool, agent, database, load_timeout, metrics)
 
         # Get all wdb2ts services from comma separated list in config
         wdb2ts_services = [s.strip() for s in config.get('wdb2ts', 'services').split(',')]
-        wdb2ts = syncer.wdb2ts.WDB2TS(config.get('wdb2ts', 'base_url'), wdb2ts_services)
+        wdb2ts_hosts = []
+        for base_url in [s.strip() for s in config.get('wdb2ts', 'base_url').split(',') if s.strip()]:
+            wdb2ts_hosts += [syncer.wdb2ts.WDB2TS(
+                base_url,
+                wdb2ts_services,
+                int(config.get_optional('wdb2ts', 'concurrency', syncer.wdb2ts.DEFAULT_CONCURRENCY)),
+                int(config.get_optional('wdb2ts', 'timeout', syncer.wdb2ts.DEFAULT_TIMEOUT)),
+                int(config.get_optional('wdb2ts', 'status_ttl', syncer.wdb2ts.DEFAULT_STATUS_TTL)),
+                int(config.get_optional('wdb2ts', 'status_backoff', syncer.wdb2ts.DEFAULT_STATUS_BACKOFF)),
+            )]
+        wdb2ts = syncer.wdb2ts.WDB2TSCluster(wdb2ts_hosts)
     except ConfigParser.NoOptionError, e:
         logging.critical("Missing configuration for WDB host")
         return EXIT_CONFIG
@@ -719,40 +1310,82 @@ def run(argv):
     verify_ssl = bool(int(config.get('webservice', 'verify_ssl')))
     tick = int(config.get('syncer', 'tick'))
     state_file = config.get('syncer', 'state_file')
+    worker_pool = syncer.worker.WorkerPool(int(config.get_optional('syncer', 'workers', DEFAULT_WORKERS)))
+
+    # WDB2TS caches are warmed after updates if queries are configured
+    warmer = None
+    warmup_queries_file = config.get_optional('wdb2ts', 'warmup_queries_file')
+    warmup_access_log = config.get_optional('wdb2ts', 'warmup_access_log')
+    if warmup_queries_file or warmup_access_log:
+        warmer = syncer.warmer.CacheWarmer(
+            syncer.warmer.read_queries_file(warmup_queries_file) if warmup_queries_file else [],
+            warmup_access_log,
+            int(config.get_optional('wdb2ts', 'warmup_sample_size', syncer.warmer.DEFAULT_SAMPLE_SIZE)),
+            int(config.get_optional('wdb2ts', 'warmup_concurrency', syncer.warmer.DEFAULT_CONCURRENCY)),
+            int(config.get_optional('wdb2ts', 'timeout', syncer.wdb2ts.DEFAULT_TIMEOUT)),
+            metrics,
+        )
+
+    # Modelstatus events arriving within this many seconds are handled together
+    event_window = int(config.get_optional('syncer', 'event_window', DEFAULT_EVENT_WINDOW))
+    event_coalescer = syncer.coalescer.EventCoalescer(event_window)
+
+    # ANALYZE is run as part of each load if the interval is zero
+    analyze_scheduler = None
+    analyze_interval = int(config.get_optional('wdb', 'analyze_interval', DEFAULT_ANALYZE_INTERVAL))
+    if analyze_interval > 0:
+        analyze_tables = [x.strip() for x in config.get_optional('wdb', 'analyze_tables', '').split(',') if x.strip()]
+        analyze_scheduler = syncer.maintenance.AnalyzeScheduler(analyze_interval, analyze_tables)
 
     # Instantiate REST API collection objects
     model_run_collection = modelstatus.ModelRunCollection(base_url, verify_ssl)
     data_collection = modelstatus.DataCollection(base_url, verify_ssl)
+    event_replay = syncer.replay.EventReplay(base_url, verify_ssl)
 
     # Start the ZeroMQ modelstatus subscriber process
     zmq_subscriber_socket = config.get('zeromq', 'socket')
     tcp_keepalive_interval = int(config.get('zeromq', 'tcp_keepalive_interval'))
     tcp_keepalive_count = int(config.get('zeromq', 'tcp_keepalive_count'))
-    zmq_subscriber = syncer.zeromq.ZMQSubscriber(zmq_subscriber_socket, tcp_keepalive_interval, tcp_keepalive_count)
+    data_providers = [model.data_provider for model in models]
+    heartbeat_timeout = int(config.get_optional('zeromq', 'heartbeat_timeout', syncer.zeromq.DEFAULT_HEARTBEAT_TIMEOUT))
+    try:
+        codecs = syncer.codec.parse_codecs(config.get_optional('zeromq', 'codecs', ','.join(syncer.codec.DEFAULT_CODECS)))
+    except ValueError, e:
+        logging.critical("Invalid ZeroMQ codec configuration: %s" % unicode(e))
+        return EXIT_CONFIG
+    logging.info("Preferred ZeroMQ message codecs: %s; available: %s" % (', '.join(codecs), ', '.join(syncer.codec.available_codecs(codecs))))
+    zmq_subscriber = syncer.zeromq.ZMQSubscriber(zmq_subscriber_socket, tcp_keepalive_interval, tcp_keepalive_count, data_providers, heartbeat_timeout, codecs)
     logging.info("ZeroMQ subscriber listening for events from %s, TCP keepalive interval=%d count=%d" % (zmq_subscriber_socket, tcp_keepalive_interval, tcp_keepalive_count))
 
     # Instantiate ZeroMQ agent class
-    zmq_agent = syncer.zeromq.ZMQAgent()
+    zmq_agent = syncer.zeromq.ZMQAgent(codecs=codecs)
+
+    # Buffer incoming ZeroMQ messages in a separate thread
+    ingress_queue_size = int(config.get_optional('zeromq', 'ingress_queue_size', syncer.zeromq.DEFAULT_INGRESS_QUEUE_SIZE))
+    zmq_ingress = syncer.zeromq.ZMQIngress(zmq_subscriber, zmq_agent, ingress_queue_size, metrics)
 
     # Start the ZeroMQ controller process
     zmq_controller_socket = config.get('zeromq', 'controller_socket')
-    zmq_ctl_proc = multiprocessing.Process(target=run_zmq_controller, args=(zmq_controller_socket,))
+    zmq_ctl_proc = multiprocessing.Process(target=run_zmq_controller, args=(zmq_controller_socket, codecs))
     zmq_ctl_proc.start()
     logging.info("ZeroMQ controller socket listening for commands on %s" % zmq_controller_socket)
 
     # Start main application
     try:
-        daemon = Daemon(config, models, zmq_subscriber, zmq_agent, wdb, wdb2ts, model_run_collection, data_collection, tick, state_file)
+        daemon = Daemon(config, models, zmq_subscriber, zmq_agent, wdb, wdb2ts, model_run_collection, data_collection, tick, state_file, worker_pool, analyze_scheduler, metrics, warmer, zmq_ingress, event_coalescer, event_replay)
         exit_code = daemon.run()
     except:
         zmq_ctl_proc.terminate()
         raise
+    finally:
+        if ssh_pool is not None:
+            ssh_pool.close()
 
     return exit_code
 
 
-def run_zmq_controller(sock):
-    controller = syncer.zeromq.ZMQController(sock)
+def run_zmq_controller(sock, codecs):
+    controller = syncer.zeromq.ZMQController(sock, codecs=codecs)
     try:
         controller.run()
     except (SystemExit, KeyboardInterrupt):
@@ -0,0 +1,457 @@
+# coding: utf-8
+
+"""
+WDB load agent.
+
+The load agent is an optional process running on the WDB host. It executes
+load programs and cache queries on behalf of Syncer, which submits jobs over
+ZeroMQ instead of running each command through SSH. The agent keeps its own
+job queue and concurrency limit, and streams back per-file progress and exit
+codes.
+
+Command lines are split into arguments using shell quoting rules, so that the
+same command lines can be used with both SSH and the load agent, but they are
+executed directly, without a shell. Only the programs listed in
+`allowed_programs` may be run.
+
+If a shared key is configured, every job must be signed with it, and jobs
+with a missing or invalid signature are rejected.
+"""
+
+import sys
+import hmac
+import json
+import time
+import shlex
+import hashlib
+import Queue
+import logging
+import logging.config
+import argparse
+import itertools
+import threading
+import traceback
+import ConfigParser
+import multiprocessing.pool
+
+import zmq
+
+import syncer.wdb
+import syncer.exceptions
+
+#
+# Version of the message format used between Syncer and the load agent.
+#
+# Follows Semantic Versioning 2.0.0: http://semver.org/spec/v2.0.0.html
+#
+AGENT_PROTOCOL_VERSION = [1, 2, 0]
+
+DEFAULT_CONFIG_PATH = '/etc/syncer-agent.ini'
+DEFAULT_LOG_LEVEL = 'DEBUG'
+DEFAULT_LOG_FORMAT = '%(asctime)s (%(levelname)s) %(message)s'
+DEFAULT_CONCURRENCY = 4
+
+EXIT_SUCCESS = 0
+EXIT_CONFIG = 1
+EXIT_LOGGING = 2
+
+# How many lines of STDERR output to send back to Syncer for each command
+STDERR_LINES = 50
+
+# How often the agent checks for finished commands, in milliseconds
+POLL_INTERVAL = 100
+
+JOB_LOAD = 'load'
+JOB_CACHE = 'cache'
+
+
+# Addresses the agent may listen on without a shared key
+LOCAL_ADDRESS_PREFIXES = ['ipc://', 'inproc://', 'tcp://127.', 'tcp://localhost:']
+
+
+def sign(key, payload):
+    """
+    Return the signature of a message payload, made with a shared key.
+    """
+    return hmac.new(key, payload, hashlib.sha256).hexdigest()
+
+
+def split_command(cmd):
+    """
+    Split a command line, given as a list of shell words, into the argument
+    list that a shell would execute. Raises ValueError if it can not be
+    parsed.
+    """
+    line = ' '.join(cmd)
+    if isinstance(line, unicode):
+        line = line.encode('utf-8')
+    return shlex.split(line)
+
+
+def run_shell_command(key, name, argv, timeout=None):
+    """
+    Run a program without a shell, and return a result message. If `timeout`
+    is set, the program is killed together with its child processes after
+    that many seconds, and the exit code of `timeout` is reported. Runs in a
+    worker thread.
+    """
+    start = time.time()
+    try:
+        result = syncer.wdb.WDB.run_command(argv, timeout)
+    except syncer.exceptions.WDBLoadTimeout, e:
+        result = syncer.wdb.CommandResult(syncer.wdb.EXIT_TIMEOUT, unicode(e), '', {})
+    except Exception, e:
+        result = syncer.wdb.CommandResult(-1, unicode(e), '', {})
+    lines = result.stderr.splitlines() if result.stderr else []
+    return {
+        'key': key,
+        'file': name,
+        'exit_code': result.exit_code,
+        'duration': time.time() - start,
+        'stderr': '\n'.join(lines[-STDERR_LINES:]),
+        'stdout': result.stdout if name is None else '',
+        'counters': result.counters,
+    }
+
+
+class AgentJob(object):
+    """
+    A load or cache job submitted by a Syncer instance.
+    """
+
+    def __init__(self, identity, job_id, kind, tasks, concurrency, timeout=None):
+        self.identity = identity
+        self.job_id = job_id
+        self.kind = kind
+        self.pending = list(tasks)
+        self.concurrency = max(1, concurrency)
+        self.timeout = timeout
+        self.running = 0
+        self.results = []
+
+    def key(self):
+        return (self.identity, self.job_id)
+
+    def finished(self):
+        return not self.pending and self.running == 0
+
+    def __repr__(self):
+        return "AgentJob id=%s kind=%s" % (self.job_id, self.kind)
+
+
+class LoadAgent(object):
+    """
+    Receives jobs from Syncer over a ZeroMQ ROUTER socket, and runs them with
+    a bounded number of simultaneous commands.
+    """
+
+    def __init__(self, addr, concurrency, allowed_programs=None, key=None):
+        self.context = zmq.Context()
+        self.sock = self.context.socket(zmq.ROUTER)
+        self.sock.setsockopt(zmq.LINGER, 0)
+        self.sock.bind(addr)
+        self.pool = multiprocessing.pool.ThreadPool(concurrency)
+        self.results = Queue.Queue()
+        self.allowed_programs = allowed_programs
+        self.key = key
+        self.jobs = {}
+        self.running = True
+
+    def send(self, identity, message):
+        self.sock.send_multipart([identity, json.dumps(message)])
+
+    def send_error(self, identity, job_id, message):
+        logging.warning("Rejecting job %s: %s" % (job_id, message))
+        self.send(identity, {'type': 'error', 'job_id': job_id, 'message': message})
+
+    def authenticate(self, payload, signature):
+        """
+        Returns True if a message was signed with the shared key, or if no key
+        is configured.
+        """
+        if self.key is None:
+            return True
+        if signature is None:
+            return False
+        return hmac.compare_digest(sign(self.key, payload), signature)
+
+    def validate_command(self, cmd):
+        """
+        Return the argument list of a command line. Raise ValueError if the
+        command is malformed or not allowed to run.
+        """
+        if not isinstance(cmd, list) or not cmd:
+            raise ValueError("Command must be a non-empty list")
+        argv = split_command(cmd)
+        if not argv:
+            raise ValueError("Command must be a non-empty list")
+        if self.allowed_programs is not None and argv[0] not in self.allowed_programs:
+            raise ValueError("Program '%s' is not allowed to run on this agent" % argv[0])
+        return argv
+
+    def create_job(self, identity, request):
+        """
+        Create an AgentJob from a request message. Raises ValueError or
+        KeyError if the request is invalid.
+        """
+        if request['version'][0] != AGENT_PROTOCOL_VERSION[0]:
+            raise ValueError("Unsupported protocol version %s" % request['version'])
+
+        timeout = None
+        if request['type'] == JOB_LOAD:
+            tasks = [(x['file'], x['cmd']) for x in request['files']]
+            concurrency = int(request['concurrency'])
+            timeout = int(request.get('timeout') or 0) or None
+        elif request['type'] == JOB_CACHE:
+            tasks = [(None, request['cmd'])]
+            concurrency = 1
+        else:
+            raise ValueError("Invalid job type '%s'" % request['type'])
+
+        tasks = [(name, self.validate_command(cmd)) for name, cmd in tasks]
+
+        return AgentJob(identity, request['job_id'], request['type'], tasks, concurrency, timeout)
+
+    def handle_request(self, identity, payload, signature=None):
+        """
+        Authenticate and validate an incoming job, and start running it.
+        """
+        try:
+            request = json.loads(payload)
+        except ValueError:
+            logging.warning("Discarding non-JSON message from Syncer.")
+            return
+
+        job_id = request.get('job_id') if isinstance(request, dict) else None
+        if not self.authenticate(payload, signature):
+            self.send_error(identity, job_id, "Authentication failed")
+            return
+
+        try:
+            job = self.create_job(identity, request)
+        except (ValueError, KeyError, TypeError, IndexError), e:
+            self.send_error(identity, job_id, "Invalid job: %s" % unicode(e))
+            return
+
+        logging.info("Accepted %s with %d commands" % (job, len(job.pending)))
+        self.jobs[job.key()] = job
+        self.schedule(job)
+        self.finish(job)
+
+    def schedule(self, job):
+        """
+        Start as many commands from a job as its concurrency limit allows.
+        Commands are queued in the worker pool until a worker is available.
+        """
+        while job.pending and job.running < job.concurrency:
+            name, argv = job.pending.pop(0)
+            job.running += 1
+            self.pool.apply_async(run_shell_command, (job.key(), name, argv, job.timeout), callback=self.results.put)
+
+    def handle_results(self):
+        """
+        Send progress for all finished commands, and the result of all
+        finished jobs.
+        """
+        while True:
+            try:
+                result = self.results.get_nowait()
+            except Queue.Empty:
+                return
+
+            job = self.jobs[result.pop('key')]
+            job.running -= 1
+            job.results += [result]
+
+            if job.kind == JOB_LOAD:
+                logging.info("%s: %s exited with code %d after %.2fs" % (job, result['file'], result['exit_code'], result['duration']))
+                progress = {'type': 'progress', 'job_id': job.job_id}
+                progress.update(result)
+                self.send(job.identity, progress)
+
+            self.schedule(job)
+            self.finish(job)
+
+    def finish(self, job):
+        """
+        Send the result of a job to Syncer if all its commands have finished.
+        """
+        if not job.finished():
+            return
+        logging.info("Finished %s" % job)
+        del self.jobs[job.key()]
+        self.send(job.identity, {'type': 'result', 'job_id': job.job_id, 'results': job.results})
+
+    def run(self):
+        """
+        Main loop of the load agent.
+        """
+        poller = zmq.Poller()
+        poller.register(self.sock, zmq.POLLIN)
+        while self.running:
+            events = dict(poller.poll(POLL_INTERVAL))
+            if self.sock in events:
+                frames = self.sock.recv_multipart()
+                if len(frames) in (2, 3):
+                    self.handle_request(*frames)
+                else:
+                    logging.warning("Discarding malformed message from Syncer.")
+            self.handle_results()
+
+    def stop(self):
+        """
+        Make the main loop exit at the next iteration.
+        """
+        self.running = False
+
+    def close(self):
+        self.pool.terminate()
+        self.sock.close()
+
+
+class LoadAgentClient(object):
+    """
+    Submits jobs to a LoadAgent, and waits for their results.
+
+    A new socket is used for each job, so that jobs can be submitted from
+    several threads at the same time. If `key` is set, jobs are signed with
+    it.
+    """
+
+    def __init__(self, addr, timeout, key=None):
+        self.addr = addr
+        self.timeout = timeout
+        self.key = key
+        self.context = zmq.Context()
+        self.job_ids = itertools.count(1)
+        self.lock = threading.Lock()
+
+    def next_job_id(self):
+        with self.lock:
+            return next(self.job_ids)
+
+    def submit(self, request, exception, progress_callback=None):
+        """
+        Send a job to the load agent, and return the result message. Progress
+        messages are passed to `progress_callback`. Raises `exception` if the
+        agent rejects the job or stops responding for `timeout` seconds.
+        """
+        request['version'] = AGENT_PROTOCOL_VERSION
+        request['job_id'] = self.next_job_id()
+
+        sock = self.context.socket(zmq.DEALER)
+        sock.setsockopt(zmq.LINGER, 0)
+        sock.connect(self.addr)
+        try:
+            payload = json.dumps(request)
+            if self.key is None:
+                sock.send(payload)
+            else:
+                sock.send_multipart([payload, sign(self.key, payload)])
+            while True:
+                if not sock.poll(self.timeout * 1000):
+                    raise exception("Load agent at %s did not respond within %d seconds" % (self.addr, self.timeout))
+                message = sock.recv_json()
+                if message.get('job_id') != request['job_id']:
+                    continue
+                if message['type'] == 'progress':
+                    if progress_callback is not None:
+                        progress_callback(message)
+                elif message['type'] == 'result':
+                    return message
+                elif message['type'] == 'error':
+                    raise exception("Load agent rejected job: %s" % message['message'])
+        finally:
+            sock.close()
+
+    def load(self, files, concurrency, progress_callback=None, timeout=0):
+        """
+        Load files into WDB. `files` is a list of (file name, load command)
+        tuples. If `timeout` is non-zero, the agent kills load programs that
+        run for longer than that many seconds. Returns the result message,
+        containing one result per file.
+        """
+        request = {
+            'type': JOB_LOAD,
+            'files': [{'file': name, 'cmd': cmd} for name, cmd in files],
+            'concurrency': concurrency,
+            'timeout': timeout,
+        }
+        return self.submit(request, syncer.exceptions.WDBLoadFailed, progress_callback)
+
+    def cache(self, cmd):
+        """
+        Run a cache command. Returns three values: exit_code(int),
+        stderr(string) and stdout(string).
+        """
+        reply = self.submit({'type': JOB_CACHE, 'cmd': cmd}, syncer.exceptions.WDBCacheFailed)
+        result = reply['results'][0]
+        return result['exit_code'], result['stderr'], result['stdout']
+
+    def __repr__(self):
+        return "LoadAgentClient(%s)" % self.addr
+
+
+def run(argv):
+    parser = argparse.ArgumentParser(formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument('-c', '--config', help='path to configuration file', default=DEFAULT_CONFIG_PATH)
+    args = parser.parse_args(argv)
+
+    config = ConfigParser.SafeConfigParser()
+    try:
+        config.readfp(open(args.config))
+    except IOError, e:
+        logging.critical("Could not read configuration file: %s" % unicode(e))
+        return EXIT_CONFIG
+
+    try:
+        logging.config.fileConfig(args.config, disable_existing_loggers=True)
+    except ConfigParser.Error, e:
+        logging.critical("There is an error in the logging configuration: %s" % unicode(e))
+        return EXIT_LOGGING
+
+    try:
+        addr = config.get('agent', 'socket')
+        concurrency = DEFAULT_CONCURRENCY
+        if config.has_option('agent', 'concurrency'):
+            concurrency = int(config.get('agent', 'concurrency'))
+        allowed_programs = None
+        if config.has_option('agent', 'allowed_programs'):
+            allowed_programs = [x.strip() for x in config.get('agent', 'allowed_programs').split(',')]
+        key = None
+        if config.has_option('agent', 'key'):
+            key = config.get('agent', 'key')
+    except ConfigParser.Error, e:
+        logging.critical("Error in load agent configuration: %s" % unicode(e))
+        return EXIT_CONFIG
+
+    if key is None and not any([addr.startswith(prefix) for prefix in LOCAL_ADDRESS_PREFIXES]):
+        logging.critical("A shared key must be configured when listening on %s" % addr)
+        return EXIT_CONFIG
+
+    agent = LoadAgent(addr, concurrency, allowed_programs, key)
+    logging.info("Load agent listening for jobs on %s, running at most %d commands at a time" % (addr, concurrency))
+
+    try:
+        agent.run()
+    except KeyboardInterrupt:
+        logging.info("Terminated by SIGINT")
+    finally:
+        agent.close()
+
+    return EXIT_SUCCESS
+
+
+def main(argv):
+    logging.basicConfig(format=DEFAULT_LOG_FORMAT, level=DEFAULT_LOG_LEVEL)
+    logging.info("Starting Syncer load agent...")
+
+    try:
+        exit_code = run(argv)
+    except Exception:
+        for line in traceback.format_exc().split("\n"):
+            logging.critical(line)
+        exit_code = 255
+
+    logging.info("Exiting with status %d", exit_code)
+    sys.exit(exit_code)
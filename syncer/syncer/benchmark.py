@@ -0,0 +1,149 @@
+"""
+Benchmark of the message codecs used on ZeroMQ channels.
+
+Messages are modelled on real traffic: Modelstatus events carrying a model
+run, and status snapshots sent from the daemon to the ZeroMQ controller,
+carrying the serialized state of every model. For each available codec, the
+size of the encoded message and the encode and decode throughput are
+reported.
+"""
+
+import sys
+import time
+import argparse
+
+import syncer.codec
+
+DEFAULT_MODELS = 20
+DEFAULT_FILES = 67
+DEFAULT_ITERATIONS = 1000
+
+
+def make_model_run(id, data_provider, num_files):
+    """
+    Return a serialized model run, as published by Modelstatus.
+    """
+    return {
+        'id': id,
+        'data_provider': data_provider,
+        'reference_time': '2015-01-19T06:00:00+00:00',
+        'created_date': '2015-01-19T08:36:03.689297+00:00',
+        'version': 1,
+        'data': [{
+            'id': id * 1000 + index,
+            'model_run_id': id,
+            'format': 'netcdf',
+            'href': 'opdata:///opdata/%s/%s_20150119T06Z_%03d.nc' % (data_provider, data_provider, index),
+            'created_time': '2015-01-19T08:36:03.689297+00:00',
+        } for index in range(num_files)],
+    }
+
+
+def make_event(num_files):
+    """
+    Return a Modelstatus event about a data file, carrying its model run.
+    """
+    model_run = make_model_run(1, 'arome_metcoop_2500m', num_files)
+    return {
+        'version': [1, 6, 0],
+        'type': 'resource',
+        'resource': 'data',
+        'id': model_run['data'][-1]['id'],
+        'sequence': 1234,
+        'previous_sequence': 1230,
+        'model_run_id': 1,
+        'model_run': model_run,
+    }
+
+
+def make_model(index, num_files):
+    """
+    Return a serialized model, as sent from the daemon to the controller.
+    """
+    data_provider = 'model_%02d' % index
+    model_run = make_model_run(index + 1, data_provider, num_files)
+    reference = {
+        'id': model_run['id'],
+        'reference_time': model_run['reference_time'],
+        'version': model_run['version'],
+        'data': [{'href': data['href']} for data in model_run['data']],
+    }
+    return {
+        'data_provider': data_provider,
+        'model_run_age_warning': 420,
+        'model_run_age_critical': 540,
+        'place_definitions': [],
+        '_available_model_run_initialized': True,
+        'available_model_run': reference,
+        'available_updated': '2015-01-19T08:37:00.000000Z',
+        'wdb_model_run': reference,
+        'wdb_updated': '2015-01-19T08:52:00.000000Z',
+        'wdb2ts_model_run': reference,
+        'wdb2ts_updated': '2015-01-19T08:53:00.000000Z',
+        'wdb2ts_host_model_run': {},
+        'load_checkpoint': None,
+        'model_run_version': {'2015-01-19T06:00:00+00:00': 1},
+    }
+
+
+def make_status(num_models, num_files):
+    """
+    Return a status snapshot message sent from ZMQAgent to ZMQController.
+    """
+    return {
+        'type': 'snapshot',
+        'epoch': 1421650000.0,
+        'metrics': {'counters': {'zmq_ingress_received': 1000}, 'gauges': {}, 'timings': {}},
+        'publisher': {'epoch': 1421640000.0, 'last_heartbeat': 1421650000.0},
+        'models': dict([(model['data_provider'], {'version': 1, 'changes': model})
+                        for model in [make_model(index, num_files) for index in range(num_models)]]),
+    }
+
+
+def run(message, iterations, names=syncer.codec.DEFAULT_CODECS):
+    """
+    Encode and decode a message `iterations` times with each available codec.
+    Returns a list of (codec name, encoded size in bytes, messages encoded per
+    second, messages decoded per second) tuples.
+    """
+    results = []
+    for name in syncer.codec.available_codecs(names):
+        codec = syncer.codec.CODECS[name]
+        start = time.time()
+        for _ in xrange(iterations):
+            data = codec.encode(message)
+        encode_time = time.time() - start
+        start = time.time()
+        for _ in xrange(iterations):
+            syncer.codec.decode(data)
+        decode_time = time.time() - start
+        results += [(name, len(data), iterations / max(encode_time, 1e-9), iterations / max(decode_time, 1e-9))]
+    return results
+
+
+def parse_arguments(args):
+    parser = argparse.ArgumentParser(description='Benchmark ZeroMQ message codecs')
+    parser.add_argument('--models', type=int, default=DEFAULT_MODELS, help='number of models in status messages')
+    parser.add_argument('--files', type=int, default=DEFAULT_FILES, help='number of files per model run')
+    parser.add_argument('--iterations', type=int, default=DEFAULT_ITERATIONS, help='number of times each message is encoded and decoded')
+    return parser.parse_args(args)
+
+
+def main(argv):
+    args = parse_arguments(argv)
+    messages = [
+        ('event', make_event(args.files)),
+        ('status', make_status(args.models, args.files)),
+    ]
+    unavailable = [name for name in syncer.codec.DEFAULT_CODECS if name not in syncer.codec.available_codecs()]
+    if unavailable:
+        print "Not available: %s" % ', '.join(unavailable)
+    print "%-10s %-10s %12s %14s %14s" % ('message', 'codec', 'size', 'encode/s', 'decode/s')
+    for label, message in messages:
+        for name, size, encoded, decoded in run(message, args.iterations):
+            print "%-10s %-10s %12d %14.1f %14.1f" % (label, name, size, encoded, decoded)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,80 @@
+"""
+Coalescing of Modelstatus events.
+
+Modelstatus publishes one event for each data file posted to a model run, and
+one for the model run itself. Handling each of them separately means fetching
+the same model run from the REST API over and over again. Instead, events are
+collected here for a short time window, and then handed out at once, so that
+each model run is fetched only once per window.
+"""
+
+import time
+import logging
+
+
+class EventCoalescer(object):
+    """
+    Collects the ids of model run and data resources from Modelstatus events,
+    and hands them out once per time window, together with any model runs
+    embedded in the events. The first event opens a new time window.
+    """
+
+    def __init__(self, window):
+        self.window = window
+        self.model_runs = set()
+        self.data = set()
+        self.payloads = {}
+        self.events = 0
+        self.window_start = None
+
+    def add(self, resource, id, model_run_id=None, model_run=None):
+        """
+        Add a resource id from a Modelstatus event. Duplicate ids within a
+        time window are merged. If the event names the model run of a data
+        resource, the data id does not need to be resolved. If the event
+        carries the model run itself, the most recently received copy is kept.
+        """
+        if self.window_start is None:
+            self.window_start = time.time()
+        if model_run_id is not None:
+            self.model_runs.add(model_run_id)
+            if model_run is not None:
+                self.payloads[model_run_id] = model_run
+        elif resource == 'model_run':
+            self.model_runs.add(id)
+        elif resource == 'data':
+            self.data.add(id)
+        self.events += 1
+
+    def time_until_due(self):
+        """
+        Return the number of seconds until the collected events are due, or
+        None if there are no events.
+        """
+        if self.window_start is None:
+            return None
+        return max(0, self.window_start + self.window - time.time())
+
+    def is_due(self):
+        """
+        Returns True if the time window of the collected events has elapsed.
+        """
+        return self.time_until_due() == 0
+
+    def take(self):
+        """
+        Return the collected model run ids and data ids as two sorted lists,
+        together with a dictionary of model runs received with the events,
+        keyed by id. Then start over.
+        """
+        logging.debug("Coalesced %d events into %d model runs and %d data ids." % (self.events, len(self.model_runs), len(self.data)))
+        result = (sorted(self.model_runs), sorted(self.data), self.payloads)
+        self.model_runs = set()
+        self.data = set()
+        self.payloads = {}
+        self.events = 0
+        self.window_start = None
+        return result
+
+    def __repr__(self):
+        return "EventCoalescer"
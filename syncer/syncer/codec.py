@@ -0,0 +1,136 @@
+"""
+Message encodings for ZeroMQ channels.
+
+JSON is the default encoding, and is always available. Binary codecs are more
+compact and faster to decode; each of them prefixes its messages with a
+single marker byte, so that any message can be decoded without knowing in
+advance how it was encoded. JSON messages have no marker, and always start
+with an opening brace or bracket, so messages from older peers are still
+understood.
+
+MessagePack is an optional dependency, which is only used if the `msgpack`
+module is installed.
+"""
+
+import json
+import zlib
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+# Codecs in order of preference
+DEFAULT_CODECS = ['msgpack', 'zlib', 'json']
+
+
+class JSONCodec(object):
+    name = 'json'
+    marker = None
+
+    def available(self):
+        return True
+
+    def dumps(self, obj):
+        return json.dumps(obj, separators=(',', ':'))
+
+    def loads(self, data):
+        return json.loads(data)
+
+    def encode(self, obj):
+        return self.dumps(obj)
+
+    def decode(self, data):
+        return self.loads(data)
+
+
+class ZlibCodec(JSONCodec):
+    """
+    Compact JSON compressed with zlib.
+    """
+    name = 'zlib'
+    marker = b'\x01'
+
+    def dumps(self, obj):
+        return zlib.compress(JSONCodec.dumps(self, obj), 1)
+
+    def loads(self, data):
+        try:
+            return JSONCodec.loads(self, zlib.decompress(data))
+        except zlib.error, e:
+            raise ValueError("Invalid zlib data: %s" % unicode(e))
+
+    def encode(self, obj):
+        return self.marker + self.dumps(obj)
+
+    def decode(self, data):
+        return self.loads(data[1:])
+
+
+class MsgpackCodec(ZlibCodec):
+    """
+    MessagePack, if installed.
+    """
+    name = 'msgpack'
+    marker = b'\x02'
+
+    def available(self):
+        return msgpack is not None
+
+    def dumps(self, obj):
+        return msgpack.packb(obj, use_bin_type=True)
+
+    def loads(self, data):
+        if msgpack is None:
+            raise ValueError("Received a MessagePack message, but the msgpack module is not installed")
+        try:
+            return msgpack.unpackb(data, raw=False)
+        except Exception, e:
+            raise ValueError("Invalid MessagePack data: %s" % unicode(e))
+
+
+CODECS = dict([(codec.name, codec) for codec in [JSONCodec(), ZlibCodec(), MsgpackCodec()]])
+MARKERS = dict([(codec.marker, codec) for codec in CODECS.values() if codec.marker is not None])
+
+
+def parse_codecs(value):
+    """
+    Parse a comma separated list of codec names. Raises ValueError for
+    unknown codecs.
+    """
+    names = [name.strip() for name in value.split(',') if name.strip()]
+    for name in names:
+        if name not in CODECS:
+            raise ValueError("Unknown message codec '%s'" % name)
+    return names
+
+
+def available_codecs(names=DEFAULT_CODECS):
+    """
+    Return the names of the available codecs among `names`, in order.
+    """
+    return [name for name in names if CODECS[name].available()]
+
+
+def get_codec(names=DEFAULT_CODECS, supported=None):
+    """
+    Return the first available codec in `names` which is also listed in
+    `supported`, if given. JSON is the fallback.
+    """
+    for name in available_codecs(names):
+        if supported is None or name in supported:
+            return CODECS[name]
+    return CODECS['json']
+
+
+def decode(data):
+    """
+    Decode a message encoded with any available codec. Raises ValueError if
+    the message cannot be decoded.
+    """
+    if data[:1] in (b'{', b'['):
+        return CODECS['json'].decode(data)
+    codec = MARKERS.get(data[:1])
+    if codec is None:
+        raise ValueError("Unknown message encoding")
+    return codec.decode(data)
@@ -0,0 +1,194 @@
+"""
+Direct database access to WDB.
+
+This module runs SQL statements against WDB over a pool of DB-API
+connections, as an alternative to running `psql` through SSH. Each statement
+is timed individually and run with a statement timeout, so that slow or
+failing statements can be identified.
+
+The PostgreSQL driver, psycopg2, is an optional dependency which is only
+required when this backend is used.
+"""
+
+import time
+import logging
+import threading
+
+import syncer.exceptions
+
+try:
+    import psycopg2
+except ImportError:
+    psycopg2 = None
+
+
+class ConnectionPool(object):
+    """
+    Thread-safe pool of at most `size` DB-API connections, created on demand
+    by calling `connect`.
+    """
+
+    def __init__(self, connect, size):
+        self.connect = connect
+        self.size = size
+        self.idle = []
+        self.lock = threading.Lock()
+        self.semaphore = threading.BoundedSemaphore(size)
+
+    def get(self):
+        """
+        Return a connection from the pool, blocking until one is available.
+        If a new connection can not be made, its place in the pool is freed.
+        """
+        self.semaphore.acquire()
+        connection = None
+        try:
+            with self.lock:
+                if self.idle:
+                    connection = self.idle.pop()
+            if connection is None:
+                connection = self.connect()
+        finally:
+            if connection is None:
+                self.semaphore.release()
+        return connection
+
+    def put(self, connection, discard=False):
+        """
+        Return a connection to the pool. If `discard` is True, the connection
+        is closed instead of being reused.
+        """
+        try:
+            if discard:
+                try:
+                    connection.close()
+                except Exception:
+                    pass
+            else:
+                with self.lock:
+                    self.idle.append(connection)
+        finally:
+            self.semaphore.release()
+
+    def close(self):
+        """
+        Close all idle connections.
+        """
+        with self.lock:
+            for connection in self.idle:
+                connection.close()
+            self.idle = []
+
+
+class StatementResult(object):
+    """
+    Timing and outcome of a single SQL statement.
+    """
+
+    def __init__(self, statement, duration, error=None):
+        self.statement = statement
+        self.duration = duration
+        self.error = error
+
+    def success(self):
+        return self.error is None
+
+    def __repr__(self):
+        if self.success():
+            return "'%s' completed in %.2fs" % (self.statement, self.duration)
+        return "'%s' failed after %.2fs: %s" % (self.statement, self.duration, self.error)
+
+
+class WDBDatabase(object):
+    """
+    Runs SQL statements against WDB using pooled connections.
+    """
+
+    # Statement used to limit the run time of each statement, in milliseconds
+    TIMEOUT_STATEMENT = 'SET statement_timeout = %d'
+
+    def __init__(self, pool, statement_timeout=None):
+        self.pool = pool
+        self.statement_timeout = statement_timeout
+
+    @staticmethod
+    def from_dsn(dsn, size, statement_timeout):
+        """
+        Instantiate a WDBDatabase that connects to PostgreSQL using psycopg2.
+        """
+        if psycopg2 is None:
+            raise RuntimeError("The psycopg2 module is required for direct database access to WDB")
+
+        def connect():
+            logging.info("Opening new database connection to WDB")
+            connection = psycopg2.connect(dsn)
+            connection.autocommit = True
+            return connection
+
+        return WDBDatabase(ConnectionPool(connect, size), statement_timeout)
+
+    def set_statement_timeout(self, cursor):
+        """
+        Limit the run time of the following statements. Returns None, or a
+        StatementResult if the timeout could not be set.
+        """
+        if not self.statement_timeout:
+            return None
+        statement = self.TIMEOUT_STATEMENT % (self.statement_timeout * 1000)
+        start = time.time()
+        try:
+            cursor.execute(statement)
+        except Exception, e:
+            return StatementResult(statement, time.time() - start, unicode(e).strip())
+        return None
+
+    def get_cursor(self):
+        """
+        Return a connection from the pool and a cursor on it. Raises
+        WDBDatabaseConnectionFailed if no connection could be made.
+        """
+        try:
+            connection = self.pool.get()
+        except Exception, e:
+            raise syncer.exceptions.WDBDatabaseConnectionFailed(unicode(e).strip())
+        try:
+            return connection, connection.cursor()
+        except Exception, e:
+            self.pool.put(connection, True)
+            raise syncer.exceptions.WDBDatabaseConnectionFailed(unicode(e).strip())
+
+    def execute(self, statements):
+        """
+        Run a list of statements on a single connection, in order. Returns a
+        list of StatementResult objects. Execution stops at the first failing
+        statement, which will be the last entry of the list. If the statement
+        timeout could not be set, its statement is the only entry. Raises
+        WDBDatabaseConnectionFailed if no connection could be made.
+        """
+        connection, cursor = self.get_cursor()
+        discard = False
+        try:
+            failure = self.set_statement_timeout(cursor)
+            if failure is not None:
+                discard = True
+                return [failure]
+            results = []
+            for statement in statements:
+                start = time.time()
+                try:
+                    cursor.execute(statement)
+                except Exception, e:
+                    results += [StatementResult(statement, time.time() - start, unicode(e).strip())]
+                    discard = True
+                    break
+                results += [StatementResult(statement, time.time() - start)]
+            cursor.close()
+            return results
+        except Exception:
+            discard = True
+            raise
+        finally:
+            self.pool.put(connection, discard)
+
+    def close(self):
+        self.pool.close()
@@ -13,6 +13,11 @@ class RESTServiceClientErrorException(RESTException):
     pass
 
 
+class EventReplayGapTooOld(RESTServiceClientErrorException):
+    """Thrown when missed events are no longer kept by Modelstatus."""
+    pass
+
+
 class RESTServiceUnavailableException(RESTException):
     """Thrown when the server returns a 5xx error."""
     pass
@@ -33,11 +38,26 @@ class WDBLoadFailed(Exception):
     pass
 
 
+class WDBLoadTimeout(WDBLoadFailed):
+    """Thrown when a load program was killed after running for too long."""
+    pass
+
+
 class WDBCacheFailed(Exception):
     """Thrown when WDB can't cache data."""
     pass
 
 
+class WDBAnalyzeFailed(WDBCacheFailed):
+    """Thrown when WDB can't analyze tables after a load."""
+    pass
+
+
+class WDBDatabaseConnectionFailed(Exception):
+    """Thrown when a connection to the WDB database can not be made."""
+    pass
+
+
 class OpdataURIException(Exception):
     """Thrown when the uri given is not a correct opdata uri."""
     pass
@@ -50,7 +70,9 @@ class WDB2TSException(Exception):
 
 class WDB2TSClientException(WDB2TSException):
     """Base class for client errors during WDB2TS calls."""
-    pass
+    def __init__(self, message, status_code=None):
+        super(WDB2TSClientException, self).__init__(message)
+        self.status_code = status_code
 
 
 class WDB2TSServerException(WDB2TSException):
@@ -0,0 +1,77 @@
+"""
+Post-load database maintenance.
+
+Running a database-wide ANALYZE after every model load makes WDB2TS wait for
+statistics to be updated, and analyzes the whole database several times when
+multiple models are loaded within a short time. Instead, loads request an
+ANALYZE from the scheduler in this module, which merges all requests made
+within a time window into a single run.
+"""
+
+import time
+import logging
+
+
+class AnalyzeScheduler(object):
+    """
+    Collects ANALYZE requests from finished model loads, and hands them out as
+    a single ANALYZE once per time window. The scheduler does not know which
+    tables a load has written to; every run analyzes the same configured list
+    of tables, or the entire database if the list is empty.
+    """
+
+    def __init__(self, interval, tables):
+        self.interval = interval
+        self.tables = tables
+        self.pending = set()
+        self.running = []
+        self.window_start = None
+
+    def request(self, model_run):
+        """
+        Request an ANALYZE after a model run has been loaded into WDB. The
+        first request opens a new time window.
+        """
+        if not self.pending:
+            self.window_start = time.time()
+        self.pending.add(model_run.data_provider)
+        logging.debug("ANALYZE requested for %s, %d data providers waiting." % (model_run.data_provider, len(self.pending)))
+
+    def time_until_due(self):
+        """
+        Return the number of seconds until the pending requests are due, or
+        None if there are no pending requests.
+        """
+        if not self.pending:
+            return None
+        return max(0, self.window_start + self.interval - time.time())
+
+    def is_due(self):
+        """
+        Returns True if the time window of the pending requests has elapsed.
+        """
+        return self.time_until_due() == 0
+
+    def start(self):
+        """
+        Mark all pending requests as running, and return the list of data
+        providers covered by this run.
+        """
+        self.running = sorted(self.pending)
+        self.pending = set()
+        self.window_start = None
+        return self.running
+
+    def finish(self, success):
+        """
+        Mark the running requests as finished. If the run failed, the
+        requests are put back into the queue to be retried in the next window.
+        """
+        if not success and self.running:
+            if not self.pending:
+                self.window_start = time.time()
+            self.pending.update(self.running)
+        self.running = []
+
+    def __repr__(self):
+        return "AnalyzeScheduler"
@@ -0,0 +1,65 @@
+"""
+Operational metrics of the Syncer daemon.
+
+Counters and timings are collected from the main loop as well as from worker
+threads, and are reported to the ZeroMQ controller together with the model
+status, where they can be queried with `syncerctl metrics`.
+"""
+
+import threading
+
+
+class Metrics(object):
+    """
+    Thread-safe collection of named counters, gauges and timings.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.counters = {}
+        self.gauges = {}
+        self.timings = {}
+
+    def increment(self, name, value=1):
+        """
+        Increase the counter `name` by `value`.
+        """
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + value
+
+    def get(self, name):
+        """
+        Return the value of the counter `name`, or zero if it has never been
+        incremented.
+        """
+        with self.lock:
+            return self.counters.get(name, 0)
+
+    def set_gauge(self, name, value):
+        """
+        Set the current value of the gauge `name`.
+        """
+        with self.lock:
+            self.gauges[name] = value
+
+    def add_timing(self, name, seconds):
+        """
+        Record the duration of an operation, in seconds.
+        """
+        with self.lock:
+            timing = self.timings.setdefault(name, {'count': 0, 'total': 0.0, 'max': 0.0, 'last': 0.0})
+            timing['count'] += 1
+            timing['total'] += seconds
+            timing['max'] = max(timing['max'], seconds)
+            timing['last'] = seconds
+
+    def serialize(self):
+        """
+        Return a JSON encodable copy of all counters, gauges and timings.
+        """
+        with self.lock:
+            return {
+                'counters': dict(self.counters),
+                'gauges': dict(self.gauges),
+                'timings': dict([(key, dict(value)) for key, value in self.timings.iteritems()]),
+            }
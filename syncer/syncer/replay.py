@@ -0,0 +1,79 @@
+"""
+Replay of missed Modelstatus events.
+
+Since version 1.4 of the message protocol, each event published by
+Modelstatus carries a sequence number, together with the sequence number of
+the previous event about the same data provider. When the two do not match
+up, events have been lost between the publisher and Syncer, and exactly the
+missing ones are fetched from the `event` collection of the REST API.
+
+Modelstatus only keeps the most recent events. If some of the missed events
+have been deleted, it answers with 410 Gone, and Syncer has to resynchronize
+instead.
+"""
+
+import json
+import requests
+
+import syncer.exceptions
+
+# Number of seconds to wait for a response from the REST API
+DEFAULT_TIMEOUT = 30
+
+# Number of events requested at a time
+PAGE_SIZE = 100
+
+
+class EventReplay(object):
+    """
+    Fetches previously published events from the Modelstatus REST API.
+    """
+
+    def __init__(self, base_url, verify_ssl=True, timeout=DEFAULT_TIMEOUT):
+        self.url = "%s/event" % base_url
+        self.timeout = timeout
+        self.session = requests.Session()
+        self.session.verify = verify_ssl
+
+    def get_page(self, params):
+        """
+        Request a single page of events, and return the list of messages.
+        """
+        try:
+            response = self.session.get(self.url, params=params, timeout=self.timeout)
+        except requests.RequestException, e:
+            raise syncer.exceptions.RESTServiceUnavailableException("Could not fetch events: %s" % unicode(e))
+        if response.status_code >= 500:
+            raise syncer.exceptions.RESTServiceUnavailableException(response.text)
+        if response.status_code == 410:
+            raise syncer.exceptions.EventReplayGapTooOld(response.text)
+        if response.status_code >= 400:
+            raise syncer.exceptions.RESTServiceClientErrorException(response.text)
+        try:
+            messages = json.loads(response.content)
+            assert isinstance(messages, list)
+        except (ValueError, AssertionError), e:
+            raise syncer.exceptions.UnserializeException("Invalid list of events: %s" % unicode(e))
+        return messages
+
+    def get_events(self, data_provider, after, before):
+        """
+        Return the messages of all events about a data provider with sequence
+        numbers between `after` and `before`, in order.
+        """
+        messages = []
+        while True:
+            params = {
+                'data_provider': data_provider,
+                'after': after,
+                'before': before,
+                'limit': PAGE_SIZE,
+            }
+            page = self.get_page(params)
+            messages += page
+            if len(page) < PAGE_SIZE:
+                return messages
+            after = page[-1]['sequence']
+
+    def __repr__(self):
+        return "EventReplay"
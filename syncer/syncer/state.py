@@ -0,0 +1,196 @@
+"""
+Persistent daemon state.
+
+The state of all models is kept in a snapshot file, which is only ever
+replaced atomically by writing a temporary file and renaming it. Changes made
+after the snapshot was written are appended to a journal next to it, as one
+compact JSON record per write, containing only the model attributes that
+changed. When the journal grows too long, it is compacted into a new snapshot.
+
+Every record carries a sequence number, and the snapshot records the sequence
+number of the last change it contains, so that records which are already part
+of the snapshot are skipped when the journal is replayed. A record truncated
+by a crash is ignored. If appending a record fails, the journal is truncated
+back to its previous length, so that the next record starts on a line of its
+own.
+"""
+
+import os
+import json
+import logging
+import tempfile
+
+# Number of journal records written before the journal is compacted
+DEFAULT_COMPACT_RECORDS = 100
+
+# Journal file name suffix
+JOURNAL_SUFFIX = '.journal'
+
+
+class StateStore(object):
+    """
+    Reads and writes the state dictionary `{'models': [...]}`, where each
+    model is identified by its `data_provider` key.
+    """
+
+    def __init__(self, path, compact_records=DEFAULT_COMPACT_RECORDS):
+        self.path = path
+        self.journal_path = path + JOURNAL_SUFFIX
+        self.compact_records = compact_records
+        self.sequence = 0
+        self.journal_records = 0
+        self.models = None
+
+    @staticmethod
+    def index_models(state):
+        """
+        Return a dictionary of serialized models keyed by data provider.
+        """
+        return dict([(model['data_provider'], model) for model in state.get('models', [])])
+
+    def read_snapshot(self):
+        """
+        Read the snapshot file. Returns an empty dictionary if it does not
+        exist or is empty, and raises ValueError if it is not valid JSON.
+        """
+        try:
+            with open(self.path, 'r') as f:
+                contents = f.read().strip()
+        except IOError:
+            if os.path.isfile(self.path):
+                raise
+            logging.info("File does not exist, continuing with blank slate.")
+            return {}
+        if not contents:
+            return {}
+        return json.loads(contents)
+
+    def read_journal(self):
+        """
+        Return the list of valid records in the journal.
+        """
+        records = []
+        try:
+            with open(self.journal_path, 'r') as f:
+                for line in f:
+                    try:
+                        records += [json.loads(line)]
+                    except ValueError:
+                        logging.warning("Ignoring incomplete record in state journal %s" % self.journal_path)
+                        break
+        except IOError:
+            if os.path.isfile(self.journal_path):
+                raise
+        return records
+
+    def read(self):
+        """
+        Read the snapshot, replay the journal on top of it, and return the
+        resulting state dictionary.
+        """
+        snapshot = self.read_snapshot()
+        models = self.index_models(snapshot)
+        sequence = snapshot.get('sequence', 0)
+        records = self.read_journal()
+        for record in records:
+            if record['sequence'] <= sequence:
+                continue
+            for data_provider, changes in record['models'].iteritems():
+                models.setdefault(data_provider, {}).update(changes)
+            sequence = record['sequence']
+        if records:
+            logging.info("Replayed %d records from state journal %s" % (len(records), self.journal_path))
+        self.sequence = sequence
+        if not models:
+            return {}
+        return {'models': [models[key] for key in sorted(models)]}
+
+    def write(self, state):
+        """
+        Persist a state dictionary. Only changes since the last write are
+        appended to the journal. A new snapshot is written the first time,
+        and every `compact_records` writes.
+        """
+        models = self.index_models(state)
+        if self.models is None or self.journal_records >= self.compact_records:
+            return self.write_snapshot(models)
+
+        changes = {}
+        for data_provider, model in models.iteritems():
+            previous = self.models.get(data_provider, {})
+            changed = dict([(key, value) for key, value in model.iteritems() if previous.get(key) != value])
+            if changed:
+                changes[data_provider] = changed
+        if not changes:
+            return
+
+        record = {'sequence': self.sequence + 1, 'models': changes}
+        length = self.journal_length()
+        try:
+            self.append_journal(json.dumps(record, sort_keys=True, separators=(',', ':')) + '\n')
+        except Exception:
+            self.truncate_journal(length)
+            raise
+        self.sequence += 1
+        self.journal_records += 1
+        self.models = models
+
+    def journal_length(self):
+        """
+        Return the size of the journal in bytes.
+        """
+        try:
+            return os.path.getsize(self.journal_path)
+        except OSError:
+            return 0
+
+    def append_journal(self, line):
+        """
+        Append a line to the journal, and wait until it has been written to disk.
+        """
+        with open(self.journal_path, 'a') as f:
+            f.write(line)
+            f.flush()
+            os.fsync(f.fileno())
+
+    def truncate_journal(self, length):
+        """
+        Remove a partially appended record from the journal. If that fails,
+        the next write replaces the snapshot and empties the journal instead.
+        """
+        try:
+            with open(self.journal_path, 'r+') as f:
+                f.truncate(length)
+                f.flush()
+                os.fsync(f.fileno())
+        except (IOError, OSError), e:
+            logging.error("Could not truncate state journal %s, writing a new snapshot next time: %s" % (self.journal_path, e))
+            self.models = None
+
+    def write_snapshot(self, models):
+        """
+        Atomically replace the snapshot with the given models, and empty the
+        journal.
+        """
+        self.sequence += 1
+        state = {
+            'sequence': self.sequence,
+            'models': [models[key] for key in sorted(models)],
+        }
+        directory = os.path.dirname(os.path.abspath(self.path))
+        fd, tmp_path = tempfile.mkstemp(prefix=os.path.basename(self.path) + '.', dir=directory)
+        try:
+            with os.fdopen(fd, 'w') as f:
+                json.dump(state, f, sort_keys=True, separators=(',', ':'))
+                f.flush()
+                os.fsync(f.fileno())
+            os.rename(tmp_path, self.path)
+        except Exception:
+            try:
+                os.unlink(tmp_path)
+            except OSError:
+                pass
+            raise
+        open(self.journal_path, 'w').close()
+        self.journal_records = 0
+        self.models = models
@@ -1,17 +1,39 @@
 # coding: utf-8
 
+import os
+import sys
 import copy
+import time
 import unittest
+import threading
 import ConfigParser
 import StringIO
+import sqlite3
 import datetime
+import json
+import shutil
+import tempfile
+import SocketServer
+import BaseHTTPServer
 import dateutil
 import dateutil.relativedelta
+import zmq
 
 import syncer
 import syncer.wdb
+import syncer.agent
 import syncer.wdb2ts
+import syncer.database
 import syncer.utils
+import syncer.worker
+import syncer.maintenance
+import syncer.metrics
+import syncer.warmer
+import syncer.state
+import syncer.coalescer
+import syncer.replay
+import syncer.codec
+import syncer.benchmark
 import syncer.exceptions
 
 import modelstatus
@@ -151,6 +173,142 @@ VALID_STATE_HASH = {
 ZEROMQ_PROTOCOL_VERSION = [1, 1, 0]
 
 
+def make_model_run_fixture(num_files):
+    """
+    Return a copy of VALID_MODEL_RUN_FIXTURE with `num_files` data entries.
+    """
+    fixture = copy.deepcopy(VALID_MODEL_RUN_FIXTURE)
+    fixture['data'] = []
+    for index in range(num_files):
+        data = copy.deepcopy(VALID_MODEL_RUN_FIXTURE['data'][0])
+        data['id'] = '/modelstatus/v0/data%d' % (index + 1)
+        data['href'] = 'opdata:///arome2_5/arome_metcoop_default2_5km_20150112T06Z_%d.nc' % index
+        fixture['data'] += [data]
+    return fixture
+
+
+class LocalWDB(syncer.wdb.WDB):
+    """
+    WDB class that runs load programs on the local host instead of through SSH.
+    """
+    def create_ssh_command(self, cmd):
+        return cmd
+
+
+class RecordingWDB(LocalWDB):
+    """
+    WDB class that records the load commands it runs on the local host.
+    """
+    def __init__(self, *args, **kwargs):
+        super(RecordingWDB, self).__init__(*args, **kwargs)
+        self.commands = []
+
+    def create_ssh_command(self, cmd):
+        self.commands += [cmd]
+        return cmd
+
+
+class FailingFilesWDB(RecordingWDB):
+    """
+    WDB class that fails to load a specific set of files.
+    """
+    def __init__(self, *args, **kwargs):
+        super(FailingFilesWDB, self).__init__(*args, **kwargs)
+        self.failing = set()
+        self.failure = ['false']
+
+    def create_ssh_command(self, cmd):
+        cmd = super(FailingFilesWDB, self).create_ssh_command(cmd)
+        if cmd[-1] in self.failing:
+            return self.failure
+        return cmd
+
+
+class LocalHTTPServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    """
+    HTTP server running in a background thread, standing in for WDB2TS.
+    Responses are looked up by request path, including the query string, and
+    all requested paths are recorded.
+    """
+    daemon_threads = True
+
+    class Handler(BaseHTTPServer.BaseHTTPRequestHandler):
+        def do_GET(self):
+            self.server.requests += [self.path]
+            time.sleep(self.server.delay)
+            status, body = self.server.responses.get(self.path, (404, 'Not found'))
+            self.send_response(status)
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, *args):
+            pass
+
+    def __init__(self):
+        BaseHTTPServer.HTTPServer.__init__(self, ('127.0.0.1', 0), self.Handler)
+        self.responses = {}
+        self.requests = []
+        self.delay = 0
+        self.thread = threading.Thread(target=self.serve_forever)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def get_base_url(self):
+        return 'http://127.0.0.1:%d/metno-wdb2ts' % self.server_address[1]
+
+    def handle_error(self, request, client_address):
+        # Clients giving up on slow responses are expected
+        pass
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+
+
+class FakeCollection(object):
+    """
+    Stand-in for a Modelstatus REST API collection, counting requests.
+    """
+    def __init__(self, objects):
+        self.objects = objects
+        self.requests = []
+
+    def get_object(self, id):
+        self.requests += [id]
+        return self.objects[id]
+
+
+class FakeEventReplay(object):
+    """
+    Stand-in for the Modelstatus event replay, recording requests.
+    """
+    def __init__(self, messages, exception=None):
+        self.messages = messages
+        self.exception = exception
+        self.requests = []
+
+    def get_events(self, data_provider, after, before):
+        self.requests += [(data_provider, after, before)]
+        if self.exception is not None:
+            raise self.exception
+        return self.messages
+
+
+class FinishedResult(object):
+    """
+    Stand-in for the AsyncResult of a job that has already finished.
+    """
+    def __init__(self, value):
+        self.value = value
+
+    def ready(self):
+        return True
+
+    def get(self):
+        return self.value
+
+
 class SyncerTest(unittest.TestCase):
     def setUp(self):
         self.config_file = StringIO.StringIO(config_file_contents)
@@ -220,6 +378,196 @@ class WDB2TS(unittest.TestCase):
         self.assertEqual('http://localhost/metno-wdb2ts/aromeecepsforecastupdate?arome_metcoop_2500m=2015-01-29T00:00:00Z,1', url)
 
 
+class WDB2TSHTTPTest(unittest.TestCase):
+    SERVICES = ['aromeecepsforecast', 'aromeecepsforecastlts', 'proffecepsforecast', 'proffecepsforecastlts']
+
+    def setUp(self):
+        self.server = LocalHTTPServer()
+        for service in self.SERVICES:
+            self.server.responses['/metno-wdb2ts/%s?status' % service] = (200, WDB2TS.VALID_STATUS_XML)
+            self.server.responses['/metno-wdb2ts/%supdate?arome_metcoop_2500m=2015-01-19T16:04:40Z,1337' % service] = (200, 'Updated')
+        self.wdb2ts = syncer.wdb2ts.WDB2TS(self.server.get_base_url(), self.SERVICES, 4, 1)
+        self.model = syncer.Model(VALID_MODEL_FIXTURE)
+        self.model.data_provider_group = 'arome_metcoop_2500m'
+        self.model_run = modelstatus.ModelRun(VALID_MODEL_RUN_FIXTURE)
+
+    def tearDown(self):
+        self.server.stop()
+
+    def test_load_status_concurrent(self):
+        self.server.delay = 0.3
+        start = time.time()
+        status = self.wdb2ts.load_status()
+        self.assertLess(time.time() - start, 0.3 * len(self.SERVICES))
+        self.assertEqual(sorted(status.keys()), self.SERVICES)
+        for service in self.SERVICES:
+            self.assertIn('arome_metcoop_2500m', status[service]['data_providers'])
+
+    def test_update_wdb2ts(self):
+        self.wdb2ts.load_status()
+        self.server.requests = []
+        self.assertEqual(self.wdb2ts.update_wdb2ts_host([(self.model, self.model_run)]), [None])
+        self.assertEqual(len(self.server.requests), len(self.SERVICES))
+
+    def test_update_wdb2ts_server_error(self):
+        self.wdb2ts.load_status()
+        self.server.responses['/metno-wdb2ts/proffecepsforecastupdate?arome_metcoop_2500m=2015-01-19T16:04:40Z,1337'] = (500, 'Error')
+        errors = self.wdb2ts.update_wdb2ts_host([(self.model, self.model_run)])
+        self.assertIsInstance(errors[0], syncer.exceptions.WDB2TSServerUpdateFailure)
+
+    def test_update_wdb2ts_client_error(self):
+        self.wdb2ts.load_status()
+        del self.server.responses['/metno-wdb2ts/proffecepsforecastupdate?arome_metcoop_2500m=2015-01-19T16:04:40Z,1337']
+        errors = self.wdb2ts.update_wdb2ts_host([(self.model, self.model_run)])
+        self.assertIsInstance(errors[0], syncer.exceptions.WDB2TSClientUpdateFailure)
+
+    def test_load_status_cached(self):
+        self.wdb2ts.load_status()
+        self.wdb2ts.load_status(['arome_metcoop_2500m'])
+        self.assertEqual(len(self.server.requests), len(self.SERVICES))
+        self.wdb2ts.invalidate_status()
+        self.wdb2ts.load_status()
+        self.assertEqual(len(self.server.requests), 2 * len(self.SERVICES))
+
+    def test_load_status_missing_data_provider(self):
+        self.wdb2ts.load_status()
+        self.wdb2ts.load_status(['new_data_provider'])
+        self.assertEqual(len(self.server.requests), 2 * len(self.SERVICES))
+
+    def test_load_status_expired(self):
+        self.wdb2ts.status_ttl = 0
+        self.wdb2ts.load_status()
+        self.wdb2ts.load_status()
+        self.assertEqual(len(self.server.requests), 2 * len(self.SERVICES))
+
+    def test_load_status_backoff(self):
+        self.wdb2ts.status_ttl = 0
+        self.wdb2ts.load_status()
+        self.server.responses = {}
+        for i in range(2):
+            with self.assertRaises(syncer.exceptions.WDB2TSServiceClientErrorException):
+                self.wdb2ts.load_status()
+        self.assertEqual(len(self.server.requests), 2 * len(self.SERVICES))
+        self.assertEqual(self.wdb2ts.get_services('arome_metcoop_2500m'), self.SERVICES)
+        self.wdb2ts.status_backoff = 0
+        with self.assertRaises(syncer.exceptions.WDB2TSServiceClientErrorException):
+            self.wdb2ts.load_status()
+        self.assertEqual(len(self.server.requests), 3 * len(self.SERVICES))
+
+    def test_update_wdb2ts_host_status_failure(self):
+        self.server.responses = {}
+        errors = self.wdb2ts.update_wdb2ts_host(self.make_batch())
+        self.assertEqual(len(errors), 2)
+        self.assertTrue(all([isinstance(e, syncer.exceptions.WDB2TSServiceClientErrorException) for e in errors]))
+
+    def test_services_by_provider(self):
+        self.wdb2ts.load_status()
+        self.assertEqual(self.wdb2ts.get_services('arome_metcoop_2500m'), self.SERVICES)
+        self.assertEqual(self.wdb2ts.get_services('foo'), [])
+
+    def test_update_wdb2ts_host_down(self):
+        down = syncer.wdb2ts.WDB2TS('http://127.0.0.1:1/metno-wdb2ts', self.SERVICES, 4, 1)
+        errors = down.update_wdb2ts_host([(self.model, self.model_run)])
+        self.assertIsInstance(errors[0], syncer.exceptions.WDB2TSConnectionFailure)
+
+    def make_batch(self):
+        other = copy.deepcopy(VALID_MODEL_FIXTURE)
+        other['data_provider'] = other['data_provider_group'] = 'met eceps small domain v.1.0'
+        return [(self.model, self.model_run), (syncer.Model(other), self.model_run)]
+
+    def test_split_update_params(self):
+        params = [('a', 't1', 1), ('b', 't1', 1), ('a', 't1', 1), ('a', 't2', 1)]
+        batches = syncer.wdb2ts.WDB2TS.split_update_params(params)
+        self.assertEqual(batches, [[('a', 't1', 1), ('b', 't1', 1)], [('a', 't2', 1)]])
+
+    def set_batch_responses(self, combined, arome, eceps):
+        for service in self.SERVICES:
+            url = '/metno-wdb2ts/%supdate?arome_metcoop_2500m=2015-01-19T16:04:40Z,1337&met eceps small domain v.1.0=2015-01-19T16:04:40Z,1337' % service
+            self.server.responses[url.replace(' ', '%20')] = (200, combined)
+            self.server.responses['/metno-wdb2ts/%supdate?arome_metcoop_2500m=2015-01-19T16:04:40Z,1337' % service] = (200, arome)
+            url = '/metno-wdb2ts/%supdate?met eceps small domain v.1.0=2015-01-19T16:04:40Z,1337' % service
+            self.server.responses[url.replace(' ', '%20')] = (200, eceps)
+
+    def test_update_wdb2ts_batch(self):
+        self.set_batch_responses('Updated', 'NoNewDataRefTime', 'NoNewDataRefTime')
+        self.wdb2ts.load_status()
+        self.server.requests = []
+        errors = self.wdb2ts.update_wdb2ts_batch(self.make_batch())
+        self.assertEqual(errors, [None, None])
+        self.assertEqual(len(self.server.requests), 3 * len(self.SERVICES))
+        self.assertEqual(self.wdb2ts.batch_unsupported, set())
+        self.assertEqual(self.wdb2ts.batch_supported, set(self.SERVICES))
+
+        self.server.requests = []
+        errors = self.wdb2ts.update_wdb2ts_batch(self.make_batch())
+        self.assertEqual(errors, [None, None])
+        self.assertEqual(len(self.server.requests), len(self.SERVICES))
+
+    def test_update_wdb2ts_batch_first_parameter_only(self):
+        self.set_batch_responses('Updated', 'NoNewDataRefTime', 'Updated')
+        self.wdb2ts.load_status()
+        self.server.requests = []
+        errors = self.wdb2ts.update_wdb2ts_batch(self.make_batch())
+        self.assertEqual(errors, [None, None])
+        self.assertEqual(len(self.server.requests), 3 * len(self.SERVICES))
+        self.assertEqual(self.wdb2ts.batch_unsupported, set(self.SERVICES))
+        self.assertEqual(self.wdb2ts.batch_supported, set())
+
+        self.server.requests = []
+        self.wdb2ts.update_wdb2ts_batch(self.make_batch())
+        self.assertEqual(len(self.server.requests), 2 * len(self.SERVICES))
+        self.assertFalse([x for x in self.server.requests if '&' in x])
+
+    def test_update_wdb2ts_batch_fallback(self):
+        for service in self.SERVICES:
+            url = '/metno-wdb2ts/%supdate?met eceps small domain v.1.0=2015-01-19T16:04:40Z,1337' % service
+            self.server.responses[url.replace(' ', '%20')] = (200, 'Updated')
+        self.wdb2ts.load_status()
+        self.server.requests = []
+        errors = self.wdb2ts.update_wdb2ts_batch(self.make_batch())
+        self.assertEqual(errors, [None, None])
+        self.assertEqual(len(self.server.requests), 3 * len(self.SERVICES))
+        self.assertEqual(self.wdb2ts.batch_unsupported, set(self.SERVICES))
+
+        self.server.requests = []
+        self.wdb2ts.update_wdb2ts_batch(self.make_batch())
+        self.assertEqual(len(self.server.requests), 2 * len(self.SERVICES))
+
+    def test_update_wdb2ts_batch_model_error(self):
+        self.wdb2ts.load_status()
+        self.server.requests = []
+        errors = self.wdb2ts.update_wdb2ts_batch(self.make_batch())
+        self.assertIsNone(errors[0])
+        self.assertIsInstance(errors[1], syncer.exceptions.WDB2TSClientUpdateFailure)
+        self.assertEqual(errors[1].status_code, 404)
+        self.assertEqual(len(self.server.requests), 3 * len(self.SERVICES))
+        self.assertEqual(self.wdb2ts.batch_unsupported, set())
+
+    def test_update_wdb2ts_batch_client_error(self):
+        for service in self.SERVICES:
+            url = '/metno-wdb2ts/%supdate?arome_metcoop_2500m=2015-01-19T16:04:40Z,1337&met eceps small domain v.1.0=2015-01-19T16:04:40Z,1337' % service
+            self.server.responses[url.replace(' ', '%20')] = (403, 'Forbidden')
+            url = '/metno-wdb2ts/%supdate?met eceps small domain v.1.0=2015-01-19T16:04:40Z,1337' % service
+            self.server.responses[url.replace(' ', '%20')] = (200, 'Updated')
+        self.wdb2ts.load_status()
+        errors = self.wdb2ts.update_wdb2ts_batch(self.make_batch())
+        self.assertEqual(errors, [None, None])
+        self.assertEqual(self.wdb2ts.batch_unsupported, set())
+
+    def test_update_wdb2ts_batch_server_error(self):
+        self.wdb2ts.load_status()
+        self.server.delay = 2
+        errors = self.wdb2ts.update_wdb2ts_batch(self.make_batch())
+        self.assertTrue(all([isinstance(e, syncer.exceptions.WDB2TSServerUpdateFailure) for e in errors]))
+        self.assertEqual(self.wdb2ts.batch_unsupported, set())
+
+    def test_update_wdb2ts_timeout(self):
+        self.wdb2ts.load_status()
+        self.server.delay = 2
+        errors = self.wdb2ts.update_wdb2ts_host([(self.model, self.model_run)])
+        self.assertIsInstance(errors[0], syncer.exceptions.WDB2TSServerUpdateFailure)
+
+
 class WDBTest(unittest.TestCase):
 
     def setUp(self):
@@ -245,6 +593,95 @@ class WDBTest(unittest.TestCase):
         )
         self.assertEqual(" ".join(cmd), "netcdfLoad --dataprovider 'arome_metcoop_2500m' -c /etc/netcdfload/arome.config --loadPlaceDefinition --dataversion 1337 /opdata/arome2_5/arome_metcoop_default2_5km_20150112T06Z.nc")
 
+    def test_create_load_command_known_place_name(self):
+        self.model.set_place_definition_loaded()
+        cmd = syncer.wdb.WDB.create_load_command(
+            self.model,
+            self.model_run,
+            '/opdata/arome2_5/arome_metcoop_default2_5km_20150112T06Z.nc'
+        )
+        self.assertEqual(" ".join(cmd), "netcdfLoad --dataprovider 'arome_metcoop_2500m' -c /etc/netcdfload/arome.config --placename 'arome_metcoop_2500m default' --dataversion 1337 /opdata/arome2_5/arome_metcoop_default2_5km_20150112T06Z.nc")
+
+    def test_create_load_command_place_definition(self):
+        cmd = syncer.wdb.WDB.create_load_command(
+            self.model,
+            self.model_run,
+            '/opdata/arome2_5/arome_metcoop_default2_5km_20150112T06Z.nc',
+            True
+        )
+        self.assertEqual(" ".join(cmd), "netcdfLoad --dataprovider 'arome_metcoop_2500m' -c /etc/netcdfload/arome.config --loadPlaceDefinition --placename 'arome_metcoop_2500m default' --dataversion 1337 /opdata/arome2_5/arome_metcoop_default2_5km_20150112T06Z.nc")
+
+    def test_load_model_run_place_definition_once(self):
+        fixture = copy.deepcopy(VALID_MODEL_FIXTURE)
+        fixture['load_program'] = 'true'
+        fixture['load_concurrency'] = 2
+        model = syncer.Model(fixture)
+        model_run = modelstatus.ModelRun(make_model_run_fixture(3))
+        wdb = RecordingWDB('localhost', 'test')
+        wdb.load_model_run(model, model_run)
+        self.assertEqual(len(wdb.commands), 3)
+        self.assertIn('--loadPlaceDefinition', wdb.commands[0])
+        self.assertTrue(all(['--loadPlaceDefinition' not in cmd for cmd in wdb.commands[1:]]))
+        self.assertEqual(model.place_definitions, ['arome_metcoop_2500m default'])
+        self.assertFalse(model.needs_place_definition())
+
+        wdb.commands = []
+        wdb.load_model_run(model, model_run)
+        self.assertTrue(all(['--loadPlaceDefinition' not in cmd for cmd in wdb.commands]))
+
+    def test_load_model_run_place_definition_failure(self):
+        fixture = copy.deepcopy(VALID_MODEL_FIXTURE)
+        fixture['load_program'] = 'false'
+        model = syncer.Model(fixture)
+        model_run = modelstatus.ModelRun(make_model_run_fixture(2))
+        wdb = RecordingWDB('localhost', 'test')
+        with self.assertRaises(syncer.exceptions.WDBLoadFailed):
+            wdb.load_model_run(model, model_run)
+        self.assertTrue(all(['--loadPlaceDefinition' in cmd for cmd in wdb.commands]))
+        self.assertTrue(all(['--placename' not in cmd for cmd in wdb.commands[1:]]))
+        self.assertTrue(model.needs_place_definition())
+
+    def test_load_model_run_place_definition_retry(self):
+        fixture = copy.deepcopy(VALID_MODEL_FIXTURE)
+        fixture['load_program'] = 'true'
+        fixture['load_concurrency'] = 2
+        model = syncer.Model(fixture)
+        model_run = modelstatus.ModelRun(make_model_run_fixture(3))
+        files = [syncer.wdb.WDB.convert_opdata_uri_to_file(x.href) for x in model_run.data]
+        wdb = FailingFilesWDB('localhost', 'test')
+
+        # Registering the place name fails, the other files are loaded as before
+        wdb.failing = set(files[:1])
+        with self.assertRaises(syncer.exceptions.WDBLoadFailed):
+            wdb.load_model_run(model, model_run)
+        self.assertIn('--placename', wdb.commands[0])
+        self.assertEqual(wdb.commands[1:], [syncer.wdb.WDB.create_load_command(model, model_run, x) for x in files[1:]])
+        self.assertTrue(all(['--placename' not in cmd for cmd in wdb.commands[1:]]))
+        self.assertTrue(model.needs_place_definition())
+
+        # The retried file registers the place name
+        wdb.failing = set()
+        wdb.commands = []
+        wdb.load_model_run(model, model_run)
+        self.assertEqual(len(wdb.commands), 1)
+        self.assertIn('--loadPlaceDefinition', wdb.commands[0])
+        self.assertFalse(model.needs_place_definition())
+
+        # A file fails using the known place name, so it is registered again
+        model.increment_model_run_version(model_run)
+        wdb.failing = set(files[2:])
+        wdb.commands = []
+        with self.assertRaises(syncer.exceptions.WDBLoadFailed):
+            wdb.load_model_run(model, model_run)
+        self.assertTrue(all(['--loadPlaceDefinition' not in cmd for cmd in wdb.commands]))
+        self.assertTrue(model.needs_place_definition())
+        wdb.failing = set()
+        wdb.commands = []
+        wdb.load_model_run(model, model_run)
+        self.assertEqual(wdb.commands[0][-1], files[2])
+        self.assertIn('--loadPlaceDefinition', wdb.commands[0])
+        self.assertFalse(model.needs_place_definition())
+
     def test_convert_opdata_uri_to_file(self):
         filepath = syncer.wdb.WDB.convert_opdata_uri_to_file('opdata:///nwparc/eps25/eps25_lqqt_probandltf_1_2015012600Z.nc')
         self.assertEqual(filepath, '/opdata/nwparc/eps25/eps25_lqqt_probandltf_1_2015012600Z.nc')
@@ -257,12 +694,392 @@ class WDBTest(unittest.TestCase):
         query = syncer.wdb.WDB.create_analyze_query()
         self.assertEqual(query, "ANALYZE")
 
+    def test_get_load_concurrency_default(self):
+        self.assertEqual(syncer.wdb.WDB.get_load_concurrency(self.model), 1)
+
+    def test_load_model_run_concurrent(self):
+        fixture = copy.deepcopy(VALID_MODEL_FIXTURE)
+        fixture['load_program'] = 'true'
+        fixture['load_concurrency'] = 3
+        model = syncer.Model(fixture)
+        model_run = modelstatus.ModelRun(make_model_run_fixture(5))
+        results = LocalWDB('localhost', 'test').load_model_run(model, model_run)
+        self.assertEqual(len(results), 5)
+        self.assertTrue(all([result.success() for result in results]))
+        self.assertEqual(results[4].modelfile, '/opdata/arome2_5/arome_metcoop_default2_5km_20150112T06Z_4.nc')
+
+    def test_load_model_run_collects_all_failures(self):
+        fixture = copy.deepcopy(VALID_MODEL_FIXTURE)
+        fixture['load_program'] = 'false'
+        fixture['load_concurrency'] = 2
+        model = syncer.Model(fixture)
+        model_run = modelstatus.ModelRun(make_model_run_fixture(3))
+        with self.assertRaisesRegexp(syncer.exceptions.WDBLoadFailed, '^3 of 3 files'):
+            LocalWDB('localhost', 'test').load_model_run(model, model_run)
+
+    def test_load_model_run_retries_failed_files_only(self):
+        fixture = copy.deepcopy(VALID_MODEL_FIXTURE)
+        fixture['load_program'] = 'true'
+        fixture['load_concurrency'] = 2
+        model = syncer.Model(fixture)
+        model_run = modelstatus.ModelRun(make_model_run_fixture(3))
+        failing = '/opdata/arome2_5/arome_metcoop_default2_5km_20150112T06Z_1.nc'
+        wdb = FailingFilesWDB('localhost', 'test')
+        wdb.failing.add(failing)
+        with self.assertRaises(syncer.exceptions.WDBLoadFailed):
+            wdb.load_model_run(model, model_run)
+        self.assertEqual(len(model.get_loaded_files(model_run)), 2)
+
+        wdb.failing = set()
+        wdb.commands = []
+        results = wdb.load_model_run(model, model_run)
+        self.assertEqual([result.modelfile for result in results], [failing])
+        self.assertEqual([cmd[-1] for cmd in wdb.commands], [failing])
+        self.assertEqual(len(model.get_loaded_files(model_run)), 3)
+
+        wdb.commands = []
+        self.assertEqual(wdb.load_model_run(model, model_run), [])
+        self.assertEqual(wdb.commands, [])
+
+    def test_load_model_run_new_version_starts_over(self):
+        fixture = copy.deepcopy(VALID_MODEL_FIXTURE)
+        fixture['load_program'] = 'true'
+        model = syncer.Model(fixture)
+        model_run = modelstatus.ModelRun(make_model_run_fixture(2))
+        wdb = RecordingWDB('localhost', 'test')
+        wdb.load_model_run(model, model_run)
+        model.increment_model_run_version(model_run)
+        self.assertEqual(model.get_loaded_files(model_run), [])
+        wdb.commands = []
+        wdb.load_model_run(model, model_run)
+        self.assertEqual(len(wdb.commands), 2)
+
+    def test_create_timeout_command(self):
+        cmd = syncer.wdb.WDB.create_timeout_command(['netcdfLoad', 'file.nc'], 600)
+        self.assertEqual(cmd, ['timeout', '--kill-after=10', '600', 'netcdfLoad', 'file.nc'])
+        self.assertEqual(syncer.wdb.WDB.create_timeout_command(['netcdfLoad'], 0), ['netcdfLoad'])
+
+    def test_get_load_timeout(self):
+        wdb = syncer.wdb.WDB('localhost', 'test', load_timeout=3600)
+        self.assertEqual(wdb.get_load_timeout(self.model), 3600)
+        fixture = copy.deepcopy(VALID_MODEL_FIXTURE)
+        fixture['load_timeout'] = 60
+        self.assertEqual(wdb.get_load_timeout(syncer.Model(fixture)), 60)
+
+    def test_execute_command_timeout_kills_process_tree(self):
+        start = time.time()
+        with self.assertRaises(syncer.exceptions.WDBLoadTimeout):
+            syncer.wdb.WDB.execute_command(['sh', '-c', 'sleep 30 & sleep 30'], 1)
+        self.assertLess(time.time() - start, syncer.wdb.KILL_GRACE_PERIOD)
+
+    def test_run_command_keeps_last_lines(self):
+        result = syncer.wdb.WDB.run_command(['seq', '100000'])
+        lines = result.stdout.splitlines()
+        self.assertEqual(result.exit_code, 0)
+        self.assertEqual(len(lines), syncer.wdb.OUTPUT_LINES)
+        self.assertEqual(lines[-1], '100000')
+
+    def test_run_command_process_group(self):
+        result = syncer.wdb.WDB.run_command([sys.executable, '-c', 'import os; print os.getpgrp() == os.getpid()'])
+        self.assertEqual(result.exit_code, 0)
+        self.assertEqual(result.stdout.strip(), 'True')
+
+    def test_run_command_summary_counters(self):
+        result = syncer.wdb.WDB.run_command(['sh', '-c', 'echo "1200 fields loaded"; echo "3 duplicates" >&2; echo "Loaded 10 fields"'])
+        self.assertEqual(result.counters, {'fields_loaded': 1210, 'fields_duplicate': 3})
+        self.assertEqual(result.stderr, '3 duplicates')
+
+    def test_load_model_run_counters(self):
+        fixture = copy.deepcopy(VALID_MODEL_FIXTURE)
+        fixture['load_program'] = 'echo'
+        model = syncer.Model(fixture)
+        model_run = modelstatus.ModelRun(make_model_run_fixture(2))
+        metrics = syncer.metrics.Metrics()
+        wdb = LocalWDB('localhost', 'test', metrics=metrics)
+        wdb.create_ssh_command = lambda cmd: ['echo', '5 fields loaded']
+        results = wdb.load_model_run(model, model_run)
+        self.assertEqual([result.counters for result in results], [{'fields_loaded': 5}] * 2)
+        self.assertEqual(metrics.get('wdb_fields_loaded'), 10)
+
+    def test_check_load_exit_code_timeout(self):
+        with self.assertRaises(syncer.exceptions.WDBLoadTimeout):
+            self.wdb.check_load_exit_code(syncer.wdb.EXIT_TIMEOUT, '')
+
+    def test_load_model_run_counts_timeouts(self):
+        fixture = copy.deepcopy(VALID_MODEL_FIXTURE)
+        fixture['load_program'] = 'true'
+        model = syncer.Model(fixture)
+        model_run = modelstatus.ModelRun(make_model_run_fixture(2))
+        metrics = syncer.metrics.Metrics()
+        wdb = FailingFilesWDB('localhost', 'test', metrics=metrics)
+        wdb.failing.add('/opdata/arome2_5/arome_metcoop_default2_5km_20150112T06Z_1.nc')
+        wdb.failure = ['sh', '-c', 'exit %d' % syncer.wdb.EXIT_TIMEOUT]
+        with self.assertRaises(syncer.exceptions.WDBLoadTimeout):
+            wdb.load_model_run(model, model_run)
+        self.assertEqual(metrics.get('wdb_load_timeouts'), 1)
+        self.assertEqual(metrics.get('wdb_files_failed'), 1)
+        self.assertEqual(metrics.get('wdb_files_loaded'), 1)
+
     def test_create_cache_model_run_command(self):
         cmd_list = self.wdb.create_cache_model_run_command(self.model_run)
         cmd = ' '.join(cmd_list)
         self.assertEqual(cmd, "ssh test@localhost psql -c \"SELECT wci.begin('wdb'); SELECT wci.cacheQuery(array['arome_metcoop_2500m'], NULL, 'exact 2015-01-19T16:04:40Z', NULL, NULL, NULL, array[-1]); ANALYZE;\"")
 
 
+class FakeSSHConnectionPool(syncer.wdb.SSHConnectionPool):
+    """
+    SSH connection pool which records control commands instead of running them.
+    """
+    def __init__(self, *args, **kwargs):
+        super(FakeSSHConnectionPool, self).__init__(*args, **kwargs)
+        self.connect_succeeds = True
+        self.alive = set()
+        self.commands = []
+
+    def is_alive(self, control_path):
+        return control_path in self.alive
+
+    def _run(self, cmd):
+        self.commands += [cmd]
+        if '-M' in cmd and self.connect_succeeds:
+            self.alive.add(cmd[cmd.index('-S') + 1])
+            return True
+        return False
+
+
+class SSHConnectionPoolTest(unittest.TestCase):
+
+    def setUp(self):
+        self.pool = FakeSSHConnectionPool('localhost', 'test', 2, '/tmp')
+
+    def test_private_control_dir(self):
+        pool = FakeSSHConnectionPool('localhost', 'test', 2)
+        control_dir = os.path.dirname(pool.control_paths[0])
+        self.assertEqual(os.stat(control_dir).st_mode & 0777, 0700)
+        self.assertEqual(os.path.dirname(pool.control_paths[1]), control_dir)
+        pool.close()
+        self.assertFalse(os.path.exists(control_dir))
+
+    def test_create_ssh_command_multiplexed(self):
+        cmd = self.pool.create_ssh_command(['ls'])
+        self.assertEqual(cmd, ['ssh', '-S', self.pool.control_paths[0], '-o', 'ControlMaster=no', 'test@localhost', 'ls'])
+        self.assertEqual(len(self.pool.commands), 1)
+
+    def test_round_robin(self):
+        paths = [self.pool.create_ssh_command(['ls'])[2] for x in range(3)]
+        self.assertEqual(paths, self.pool.control_paths + self.pool.control_paths[:1])
+        self.assertEqual(len(self.pool.commands), 2)
+
+    def test_reconnect(self):
+        self.pool.create_ssh_command(['ls'])
+        self.pool.alive.clear()
+        self.pool.index = 0
+        self.pool.create_ssh_command(['ls'])
+        self.assertEqual(len(self.pool.commands), 2)
+
+    def test_fallback(self):
+        self.pool.connect_succeeds = False
+        cmd = self.pool.create_ssh_command(['ls'])
+        self.assertEqual(cmd, ['ssh', 'test@localhost', 'ls'])
+        self.pool.index = 0
+        self.pool.create_ssh_command(['ls'])
+        self.assertEqual(len(self.pool.commands), 1)
+
+    def test_wdb_uses_pool(self):
+        wdb = syncer.wdb.WDB('localhost', 'test', self.pool)
+        cmd = wdb.create_ssh_command(['ls'])
+        self.assertEqual(cmd[:2], ['ssh', '-S'])
+
+
+class DatabaseTest(unittest.TestCase):
+    def setUp(self):
+        self.connections = []
+        self.pool = syncer.database.ConnectionPool(self.connect, 1)
+        self.database = syncer.database.WDBDatabase(self.pool)
+
+    def connect(self):
+        connection = sqlite3.connect(':memory:', check_same_thread=False)
+        self.connections += [connection]
+        return connection
+
+    def test_pool_reuse(self):
+        connection = self.pool.get()
+        self.pool.put(connection)
+        self.assertIs(self.pool.get(), connection)
+
+    def test_pool_connect_failure(self):
+        def connect():
+            raise sqlite3.OperationalError('down')
+        pool = syncer.database.ConnectionPool(connect, 1)
+        for x in range(2):
+            with self.assertRaises(sqlite3.OperationalError):
+                pool.get()
+
+    def test_execute(self):
+        results = self.database.execute(['SELECT 1', 'SELECT 2'])
+        self.assertEqual([result.statement for result in results], ['SELECT 1', 'SELECT 2'])
+        self.assertTrue(all([result.success() for result in results]))
+        self.database.execute(['SELECT 3'])
+        self.assertEqual(len(self.connections), 1)
+
+    def test_execute_error(self):
+        results = self.database.execute(['SELECT 1', 'SELECT nonexistent()', 'SELECT 2'])
+        self.assertEqual(len(results), 2)
+        self.assertFalse(results[1].success())
+        self.assertIn('nonexistent', results[1].error)
+        self.database.execute(['SELECT 1'])
+        self.assertEqual(len(self.connections), 2)
+
+    def test_wdb_cache_model_run(self):
+        wdb = syncer.wdb.WDB('localhost', 'test', database=self.database)
+        model_run = modelstatus.ModelRun(VALID_MODEL_RUN_FIXTURE)
+        with self.assertRaisesRegexp(syncer.exceptions.WDBCacheFailed, 'wci.begin'):
+            wdb.cache_model_run(model_run)
+
+    def test_wdb_connection_failure(self):
+        def connect():
+            raise sqlite3.OperationalError('down')
+        database = syncer.database.WDBDatabase(syncer.database.ConnectionPool(connect, 1))
+        wdb = syncer.wdb.WDB('localhost', 'test', database=database)
+        with self.assertRaisesRegexp(syncer.exceptions.WDBAnalyzeFailed, 'Could not connect to WDB database: down'):
+            wdb.analyze([])
+
+    def test_statement_timeout_failure(self):
+        database = syncer.database.WDBDatabase(self.pool, 1)
+        results = database.execute(['SELECT 1'])
+        self.assertEqual(len(results), 1)
+        self.assertEqual(results[0].statement, 'SET statement_timeout = 1000')
+        self.assertFalse(results[0].success())
+        wdb = syncer.wdb.WDB('localhost', 'test', database=database)
+        with self.assertRaisesRegexp(syncer.exceptions.WDBAnalyzeFailed, "ANALYZE failed: 'SET statement_timeout = 1000' failed"):
+            wdb.analyze([])
+
+    def test_create_cache_statements(self):
+        model_run = modelstatus.ModelRun(VALID_MODEL_RUN_FIXTURE)
+        statements = syncer.wdb.WDB.create_cache_statements(model_run)
+        self.assertEqual(statements, [
+            "SELECT wci.begin('wdb')",
+            "SELECT wci.cacheQuery(array['arome_metcoop_2500m'], NULL, 'exact 2015-01-19T16:04:40Z', NULL, NULL, NULL, array[-1])",
+            "ANALYZE",
+        ])
+
+
+class LoadAgentTest(unittest.TestCase):
+    """
+    Runs a load agent in a background thread, executing fake load programs.
+    """
+
+    def setUp(self):
+        addr = 'ipc:///tmp/syncer-agent-test-%d' % os.getpid()
+        self.agent = syncer.agent.LoadAgent(addr, 2, ['true', 'false', 'sh'])
+        self.thread = threading.Thread(target=self.agent.run)
+        self.thread.start()
+        self.client = syncer.agent.LoadAgentClient(addr, 10)
+        self.wdb = syncer.wdb.WDB('localhost', 'test', agent=self.client)
+        self.model_run = modelstatus.ModelRun(make_model_run_fixture(3))
+
+    def tearDown(self):
+        self.agent.stop()
+        self.thread.join()
+        self.agent.close()
+
+    def get_model(self, load_program):
+        fixture = copy.deepcopy(VALID_MODEL_FIXTURE)
+        fixture['load_program'] = load_program
+        fixture['load_concurrency'] = 2
+        return syncer.Model(fixture)
+
+    def test_load_model_run(self):
+        results = self.wdb.load_model_run(self.get_model('true'), self.model_run)
+        self.assertEqual(len(results), 3)
+        self.assertTrue(all([result.success() for result in results]))
+        self.assertEqual(results[2].modelfile, '/opdata/arome2_5/arome_metcoop_default2_5km_20150112T06Z_2.nc')
+
+    def test_load_model_run_duplicate_fields(self):
+        results = self.wdb.load_model_run(self.get_model('sh -c "exit 100"'), self.model_run)
+        self.assertTrue(all([result.success() for result in results]))
+
+    def test_load_model_run_failure(self):
+        with self.assertRaisesRegexp(syncer.exceptions.WDBLoadFailed, '^3 of 3 files'):
+            self.wdb.load_model_run(self.get_model('false'), self.model_run)
+
+    def test_load_model_run_default_timeout(self):
+        wdb = syncer.wdb.WDB('localhost', 'test', agent=self.client, load_timeout=syncer.DEFAULT_LOAD_TIMEOUT)
+        results = wdb.load_model_run(self.get_model('true'), self.model_run)
+        self.assertTrue(all([result.success() for result in results]))
+
+    def test_load_model_run_timeout(self):
+        wdb = syncer.wdb.WDB('localhost', 'test', agent=self.client, load_timeout=1)
+        start = time.time()
+        with self.assertRaisesRegexp(syncer.exceptions.WDBLoadTimeout, '3 timed out'):
+            wdb.load_model_run(self.get_model('sh -c "sleep 30"'), self.model_run)
+        self.assertLess(time.time() - start, syncer.wdb.KILL_GRACE_PERIOD)
+
+    def test_load_progress(self):
+        progress = []
+        files = [('a', ['true']), ('b', ['false'])]
+        reply = self.client.load(files, 1, progress.append)
+        self.assertEqual(sorted([x['file'] for x in progress]), ['a', 'b'])
+        self.assertEqual(sorted([(x['file'], x['exit_code']) for x in reply['results']]), [('a', 0), ('b', 1)])
+
+    def test_program_not_allowed(self):
+        with self.assertRaisesRegexp(syncer.exceptions.WDBLoadFailed, 'not allowed'):
+            self.wdb.load_model_run(self.get_model('rm'), self.model_run)
+
+    def test_cache(self):
+        exit_code, stderr, stdout = self.client.cache(['true'])
+        self.assertEqual(exit_code, 0)
+        with self.assertRaises(syncer.exceptions.WDBCacheFailed):
+            self.client.cache(['psql'])
+
+    def test_timeout(self):
+        client = syncer.agent.LoadAgentClient('ipc:///tmp/syncer-agent-test-nonexistent', 0.1)
+        with self.assertRaises(syncer.exceptions.WDBLoadFailed):
+            client.load([('a', ['true'])], 1)
+
+    def test_no_shell(self):
+        path = os.path.join(tempfile.gettempdir(), 'syncer-agent-test-injection-%d' % os.getpid())
+        exit_code, stderr, stdout = self.client.cache(['true', '-c', '"x"; touch %s' % path])
+        self.assertEqual(exit_code, 0)
+        self.assertFalse(os.path.exists(path))
+
+    def test_split_command(self):
+        cmd = syncer.wdb.WDB.create_psql_command(['SELECT 1', "SELECT 'a b'"])
+        self.assertEqual(syncer.agent.split_command(cmd), ['psql', '-c', "SELECT 1; SELECT 'a b';"])
+        self.assertEqual(self.agent.validate_command(['true', '--dataprovider', "'a b'"]), ['true', '--dataprovider', 'a b'])
+
+
+class LoadAgentAuthTest(unittest.TestCase):
+    """
+    Runs a load agent which requires jobs to be signed with a shared key.
+    """
+
+    def setUp(self):
+        self.addr = 'ipc:///tmp/syncer-agent-auth-test-%d' % os.getpid()
+        self.agent = syncer.agent.LoadAgent(self.addr, 1, ['true'], 'secret')
+        self.thread = threading.Thread(target=self.agent.run)
+        self.thread.start()
+
+    def tearDown(self):
+        self.agent.stop()
+        self.thread.join()
+        self.agent.close()
+
+    def test_signed(self):
+        client = syncer.agent.LoadAgentClient(self.addr, 10, 'secret')
+        self.assertEqual(client.cache(['true'])[0], 0)
+
+    def test_unsigned(self):
+        client = syncer.agent.LoadAgentClient(self.addr, 10)
+        with self.assertRaisesRegexp(syncer.exceptions.WDBCacheFailed, 'Authentication failed'):
+            client.cache(['true'])
+
+    def test_wrong_key(self):
+        client = syncer.agent.LoadAgentClient(self.addr, 10, 'guess')
+        with self.assertRaisesRegexp(syncer.exceptions.WDBCacheFailed, 'Authentication failed'):
+            client.cache(['true'])
+
+
 class DaemonTest(unittest.TestCase):
 
     def setUp(self):
@@ -272,7 +1089,11 @@ class DaemonTest(unittest.TestCase):
         self.wdb = syncer.wdb.WDB(self.config.get('wdb', 'host'), self.config.get('wdb', 'ssh_user'))
 
         wdb2ts_services = [s.strip() for s in self.config.get('wdb2ts', 'services')]
-        self.wdb2ts = syncer.wdb2ts.WDB2TS(self.config.get('wdb2ts', 'base_url'), wdb2ts_services)
+        self.wdb2ts = syncer.wdb2ts.WDB2TSCluster([syncer.wdb2ts.WDB2TS(self.config.get('wdb2ts', 'base_url'), wdb2ts_services)])
+        self.state_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.state_dir)
 
     def make_daemon(self):
         models = set([syncer.Model(VALID_MODEL_FIXTURE)])
@@ -281,8 +1102,19 @@ class DaemonTest(unittest.TestCase):
         zmq_subscriber = syncer.zeromq.ZMQSubscriber('ipc://null', 30, 30)
         zmq_agent = syncer.zeromq.ZMQAgent()
         tick = 300
-        state_file = '/dev/null'
-        return syncer.Daemon(self.config, models, zmq_subscriber, zmq_agent, self.wdb, self.wdb2ts, model_run_collection, data_collection, tick, state_file)
+        state_file = os.path.join(self.state_dir, 'state.json')
+        worker_pool = syncer.worker.WorkerPool(2)
+        analyze_scheduler = syncer.maintenance.AnalyzeScheduler(0, [])
+        metrics = syncer.metrics.Metrics()
+        zmq_ingress = syncer.zeromq.ZMQIngress(zmq_subscriber, zmq_agent, 10, metrics)
+        event_coalescer = syncer.coalescer.EventCoalescer(0)
+        event_replay = syncer.replay.EventReplay('http://localhost', True)
+        return syncer.Daemon(self.config, models, zmq_subscriber, zmq_agent, self.wdb, self.wdb2ts, model_run_collection, data_collection, tick, state_file, worker_pool, analyze_scheduler, metrics, None, zmq_ingress, event_coalescer, event_replay)
+
+    def wait_for_jobs(self, daemon):
+        while daemon.worker_pool.pending():
+            daemon.worker_pool.jobs.values()[0].async_result.wait()
+            daemon.main_loop_jobs()
 
     def test_instance(self):
         self.make_daemon()
@@ -296,6 +1128,32 @@ class DaemonTest(unittest.TestCase):
         daemon = self.make_daemon()
         daemon.write_state_file({})
 
+    def test_write_state_once_per_iteration(self):
+        daemon = self.make_daemon()
+        writes = []
+        daemon.write_state_file = lambda state: writes.append(state)
+        daemon.write_state()
+        daemon.write_state()
+        self.assertEqual(writes, [])
+        daemon.flush_state()
+        daemon.flush_state()
+        self.assertEqual(len(writes), 1)
+
+    def test_state_roundtrip(self):
+        daemon = self.make_daemon()
+        model_run = modelstatus.ModelRun(VALID_MODEL_RUN_FIXTURE)
+        for model in daemon.models:
+            model.set_available_model_run(model_run)
+        daemon.write_state()
+        daemon.flush_state()
+        for model in daemon.models:
+            model.set_wdb_model_run(model_run)
+        daemon.write_state()
+        daemon.flush_state()
+        state = syncer.state.StateStore(daemon.state_file).read()
+        self.assertEqual(state, daemon.make_state())
+        self.assertEqual(state['models'][0]['wdb_model_run']['id'], model_run.id)
+
     def test_load_state(self):
         daemon = self.make_daemon()
         daemon.load_state(VALID_STATE_HASH)
@@ -314,6 +1172,364 @@ class DaemonTest(unittest.TestCase):
     def test_make_state(self):
         pass
 
+    def test_load_model_job(self):
+        daemon = self.make_daemon()
+        daemon.sync_zmq_status = lambda: None
+        daemon.wdb = LocalWDB('localhost', 'test')
+        daemon.wdb.cache_model_run = lambda model_run, analyze: self.assertFalse(analyze)
+        daemon.wdb.analyze = lambda tables: None
+        model_run = modelstatus.ModelRun(VALID_MODEL_RUN_FIXTURE)
+        for model in daemon.models:
+            model.load_program = 'true'
+            model.set_available_model_run(model_run)
+            daemon.load_model(model)
+            self.assertTrue(daemon.worker_pool.busy(model))
+            self.assertIsNone(daemon.worker_pool.submit(model, syncer.JOB_WDB_LOAD, model_run, daemon.run_load_model, model, model_run))
+            self.wait_for_jobs(daemon)
+            self.assertEqual(model.wdb_model_run, model_run)
+            self.assertFalse(model.has_pending_wdb_load())
+            self.assertTrue(daemon.analyze_scheduler.is_due())
+            daemon.run_analyze()
+            self.assertTrue(daemon.worker_pool.busy(daemon.analyze_scheduler))
+            self.wait_for_jobs(daemon)
+            self.assertIsNone(daemon.analyze_scheduler.time_until_due())
+        daemon.worker_pool.terminate()
+
+    def test_finish_update_wdb2ts_partial(self):
+        daemon = self.make_daemon()
+        daemon.sync_zmq_status = lambda: None
+        second = syncer.wdb2ts.WDB2TS('http://other/metno-wdb2ts', [])
+        daemon.wdb2ts.hosts += [second]
+        base_urls = daemon.wdb2ts.get_base_urls()
+        model = list(daemon.models)[0]
+        model_run = modelstatus.ModelRun(VALID_MODEL_RUN_FIXTURE)
+        model.set_wdb_model_run(model_run)
+
+        hosts = daemon.wdb2ts.hosts
+        result = ([(model, model_run)], [None])
+        job = syncer.worker.Job(hosts[0], syncer.JOB_WDB2TS_UPDATE, None, FinishedResult(result))
+        daemon.finish_update_wdb2ts(job)
+        result = ([(model, model_run)], [syncer.exceptions.WDB2TSServerUpdateFailure('down')])
+        job = syncer.worker.Job(hosts[1], syncer.JOB_WDB2TS_UPDATE, None, FinishedResult(result))
+        daemon.finish_update_wdb2ts(job)
+        self.assertEqual(model.get_pending_wdb2ts_hosts(base_urls), base_urls[1:])
+        self.assertIsNone(model.wdb2ts_model_run)
+
+        result = ([(model, model_run)], [None])
+        job = syncer.worker.Job(hosts[1], syncer.JOB_WDB2TS_UPDATE, None, FinishedResult(result))
+        daemon.finish_update_wdb2ts(job)
+        self.assertEqual(model.get_pending_wdb2ts_hosts(base_urls), [])
+        self.assertEqual(model.wdb2ts_model_run, model_run)
+
+    def test_finish_update_wdb2ts_warmup(self):
+        daemon = self.make_daemon()
+        daemon.sync_zmq_status = lambda: None
+        targets = []
+        daemon.warmer = syncer.warmer.CacheWarmer()
+        daemon.warmer.warm = lambda x: targets.extend(x)
+        host = daemon.wdb2ts.hosts[0]
+        host.services_by_provider = {'arome': ['aromeecepsforecast', 'proffecepsforecast']}
+        model = list(daemon.models)[0]
+        model_run = modelstatus.ModelRun(VALID_MODEL_RUN_FIXTURE)
+        model.set_wdb_model_run(model_run)
+
+        result = ([(model, model_run)], [None])
+        job = syncer.worker.Job(host, syncer.JOB_WDB2TS_UPDATE, None, FinishedResult(result))
+        daemon.finish_update_wdb2ts(job)
+        self.wait_for_jobs(daemon)
+        self.assertEqual(targets, [(host.base_url, ['aromeecepsforecast', 'proffecepsforecast'])])
+        daemon.worker_pool.terminate()
+
+    def test_main_loop_wdb2ts_slow_host(self):
+        daemon = self.make_daemon()
+        daemon.sync_zmq_status = lambda: None
+        servers = [LocalHTTPServer(), LocalHTTPServer()]
+        try:
+            for server in servers:
+                for service in WDB2TSHTTPTest.SERVICES:
+                    server.responses['/metno-wdb2ts/%s?status' % service] = (200, WDB2TS.VALID_STATUS_XML)
+                    server.responses['/metno-wdb2ts/%supdate?arome_metcoop_2500m=2015-01-19T16:04:40Z,1337' % service] = (200, 'Updated')
+            servers[1].delay = 0.5
+            hosts = [syncer.wdb2ts.WDB2TS(server.get_base_url(), WDB2TSHTTPTest.SERVICES, 4, 5) for server in servers]
+            daemon.wdb2ts = syncer.wdb2ts.WDB2TSCluster(hosts)
+            base_urls = daemon.wdb2ts.get_base_urls()
+            model = list(daemon.models)[0]
+            model.data_provider_group = 'arome_metcoop_2500m'
+            model_run = modelstatus.ModelRun(VALID_MODEL_RUN_FIXTURE)
+            model.set_available_model_run(model_run)
+            model.set_wdb_model_run(model_run)
+
+            start = time.time()
+            daemon.main_loop_inner()
+            self.assertLess(time.time() - start, 0.5)
+            self.assertTrue(daemon.worker_pool.busy(hosts[0]))
+            self.assertTrue(daemon.worker_pool.busy(hosts[1]))
+
+            daemon.worker_pool.jobs[hosts[0]].async_result.wait()
+            daemon.main_loop_jobs()
+            self.assertEqual(model.get_pending_wdb2ts_hosts(base_urls), base_urls[1:])
+            self.assertIsNone(model.wdb2ts_model_run)
+
+            self.wait_for_jobs(daemon)
+            self.assertEqual(model.get_pending_wdb2ts_hosts(base_urls), [])
+            self.assertEqual(model.wdb2ts_model_run, model_run)
+        finally:
+            daemon.worker_pool.terminate()
+            for server in servers:
+                server.stop()
+
+    def test_warm_wdb2ts_while_busy(self):
+        daemon = self.make_daemon()
+        targets = []
+        daemon.warmer = syncer.warmer.CacheWarmer()
+        daemon.warmer.warm = lambda x: targets.append(x)
+        host = daemon.wdb2ts.hosts[0]
+        host.services_by_provider = {'arome': ['aromeecepsforecast'], 'ec': ['proffecepsforecast']}
+        daemon.worker_pool.jobs[daemon.warmer] = None
+        daemon.warm_wdb2ts({host.base_url: set(['arome'])})
+        daemon.warm_wdb2ts({host.base_url: set(['ec'])})
+        self.assertEqual(daemon.warm_pending, {host.base_url: set(['aromeecepsforecast', 'proffecepsforecast'])})
+        del daemon.worker_pool.jobs[daemon.warmer]
+        daemon.finish_warm_wdb2ts(syncer.worker.Job(daemon.warmer, syncer.JOB_WDB2TS_WARMUP, None, FinishedResult(None)))
+        self.wait_for_jobs(daemon)
+        self.assertEqual(targets, [[(host.base_url, ['aromeecepsforecast', 'proffecepsforecast'])]])
+        self.assertEqual(daemon.warm_pending, {})
+        daemon.worker_pool.terminate()
+
+    def test_main_loop_zmq_batch(self):
+        daemon = self.make_daemon()
+        handled = []
+        daemon.handle_zmq_event = lambda event: handled.append(event.id)
+        daemon.handle_zmq_command = lambda command: handled.append(command['command'])
+        event = {'version': ZEROMQ_PROTOCOL_VERSION, 'type': 'resource', 'resource': 'model_run', 'id': 1}
+        daemon.zmq_ingress.put(syncer.zeromq.INGRESS_EVENT, event)
+        daemon.zmq_ingress.put(syncer.zeromq.INGRESS_EVENT, {'garbage': True})
+        daemon.zmq_ingress.put(syncer.zeromq.INGRESS_COMMAND, {'command': 'resync'})
+        daemon.zmq_ingress.put(syncer.zeromq.INGRESS_EVENT, dict(event, id=2))
+        daemon.main_loop_zmq()
+        self.assertEqual(handled, [1, 'resync', 2])
+        self.assertEqual(daemon.metrics.serialize()['gauges']['zmq_ingress_depth'], 0)
+
+    def test_main_loop_zmq_overflow(self):
+        daemon = self.make_daemon()
+        fetched = []
+        daemon.get_latest_model_run = lambda model: fetched.append(model)
+        for index in range(11):
+            daemon.zmq_ingress.put(syncer.zeromq.INGRESS_COMMAND, {'command': 'noop'})
+        daemon.main_loop_zmq()
+        self.assertEqual(fetched, list(daemon.models))
+        self.assertEqual(daemon.metrics.get('zmq_ingress_dropped'), 1)
+
+    def make_event_daemon(self):
+        daemon = self.make_daemon()
+        daemon.sync_zmq_status = lambda: None
+        fixture = copy.deepcopy(VALID_MODEL_RUN_FIXTURE)
+        fixture['data'] = [dict(fixture['data'][0], id=index, href='opdata:///arome_metcoop_%d.nc' % index) for index in range(50)]
+        model_run = modelstatus.ModelRun(fixture)
+        daemon.model_run_collection = FakeCollection({1: model_run})
+        daemon.data_collection = FakeCollection(dict([(data.id, data) for data in model_run.data]))
+        daemon.event_coalescer.window = 60
+        for model in daemon.models:
+            model.data_file_count = 50
+        return daemon
+
+    def make_event(self, resource, id):
+        return syncer.zeromq.ZMQEvent.factory(version=ZEROMQ_PROTOCOL_VERSION, type='resource', resource=resource, id=id)
+
+    def test_coalesce_data_events(self):
+        daemon = self.make_event_daemon()
+        for index in range(50):
+            daemon.handle_zmq_event(self.make_event('data', index))
+        daemon.main_loop_events()
+        self.assertEqual(daemon.model_run_collection.requests, [])
+        daemon.event_coalescer.window = 0
+        daemon.main_loop_events()
+        self.assertEqual(len(daemon.data_collection.requests), 1)
+        self.assertEqual(daemon.model_run_collection.requests, [1])
+        for model in daemon.models:
+            self.assertEqual(model.available_model_run.id, 1)
+            self.assertEqual(model.get_internal_model_run_version(model.available_model_run), 1)
+
+    def test_coalesce_model_run_and_data_events(self):
+        daemon = self.make_event_daemon()
+        for index in range(50):
+            daemon.handle_zmq_event(self.make_event('data', index))
+        daemon.handle_zmq_event(self.make_event('model_run', 1))
+        daemon.handle_zmq_event(self.make_event('model_run', 1))
+        daemon.event_coalescer.window = 0
+        daemon.main_loop_events()
+        self.assertEqual(daemon.data_collection.requests, [])
+        self.assertEqual(daemon.model_run_collection.requests, [1])
+
+    def test_embedded_model_run(self):
+        daemon = self.make_event_daemon()
+        payload = daemon.model_run_collection.objects[1].serialize()
+        for index in range(50):
+            event = syncer.zeromq.ZMQEvent.factory(version=[1, 2, 0], type='resource', resource='data', id=index, model_run_id=1, model_run=payload)
+            daemon.handle_zmq_event(event)
+        daemon.event_coalescer.window = 0
+        daemon.main_loop_events()
+        self.assertEqual(daemon.data_collection.requests, [])
+        self.assertEqual(daemon.model_run_collection.requests, [])
+        for model in daemon.models:
+            self.assertEqual(model.available_model_run.id, 1)
+            self.assertEqual(len(model.available_model_run.data), 50)
+
+    def test_duplicate_model_run_suppressed(self):
+        daemon = self.make_event_daemon()
+        synced = []
+        daemon.sync_zmq_status = lambda: synced.append(True)
+        daemon.event_coalescer.window = 0
+        daemon.handle_zmq_event(self.make_event('model_run', 1))
+        daemon.handle_zmq_event(self.make_event('model_run', 1))
+        self.assertEqual(daemon.model_run_collection.requests, [1, 1])
+        self.assertEqual(len(synced), 1)
+        for model in daemon.models:
+            self.assertEqual(model.get_internal_model_run_version(model.available_model_run), 1)
+        daemon.load_model_run(1, True)
+        for model in daemon.models:
+            self.assertEqual(model.get_internal_model_run_version(model.available_model_run), 2)
+
+    def test_forced_load_reloads_place_definition(self):
+        daemon = self.make_event_daemon()
+        for model in daemon.models:
+            model.set_place_definition_loaded()
+        daemon.load_model_run(1, True)
+        for model in daemon.models:
+            self.assertTrue(model.needs_place_definition())
+
+    def test_forced_load_while_job_in_flight(self):
+        daemon = self.make_event_daemon()
+        loaded = []
+        daemon.load_model = lambda model: loaded.append(model.available_model_run.id)
+        daemon.update_wdb2ts = lambda host, models: None
+        daemon.load_model_run(1, False)
+        model = list(daemon.models)[0]
+        daemon.wdb2ts_host_models = {daemon.wdb2ts.get_base_urls()[0]: set([model])}
+        daemon.load_model_run(1, True)
+        self.assertTrue(model.force_pending)
+        self.assertFalse(model.must_update_wdb)
+        model.set_wdb_model_run(model.available_model_run)
+        daemon.main_loop_inner()
+        self.assertEqual(loaded, [])
+        daemon.wdb2ts_host_models = {}
+        daemon.main_loop_inner()
+        self.assertFalse(model.force_pending)
+        self.assertTrue(model.must_update_wdb)
+        self.assertTrue(model.must_update_wdb2ts)
+        self.assertEqual(loaded, [1])
+
+    def test_version_increment_while_load_in_flight(self):
+        daemon = self.make_event_daemon()
+        loaded = []
+        daemon.load_model = lambda model: loaded.append(model.get_model_run_version(model.available_model_run))
+        daemon.update_wdb2ts = lambda host, models: None
+        daemon.load_model_run(1, False)
+        model = list(daemon.models)[0]
+        version = model.get_model_run_version(model.available_model_run)
+        daemon.worker_pool.jobs[model] = None
+        daemon.load_model_run(1, True)
+        self.assertEqual(model.get_model_run_version(model.available_model_run), version)
+        self.assertEqual(len(model.version_pending), 1)
+        del daemon.worker_pool.jobs[model]
+        daemon.main_loop_inner()
+        self.assertEqual(model.version_pending, [])
+        self.assertEqual(loaded, [version + 1])
+
+    def test_resync_command(self):
+        daemon = self.make_daemon()
+        synced = []
+        agent = daemon.zmq_agent
+        daemon.sync_zmq_status = lambda: synced.append(agent.resync)
+        agent.resync = False
+        daemon.handle_zmq_command({'command': 'resync'})
+        self.assertEqual(synced, [True])
+
+    def make_sequenced_message(self, resource, id, sequence, previous_sequence):
+        return {
+            'version': [1, 4, 0],
+            'type': 'resource',
+            'resource': resource,
+            'id': id,
+            'model_run_id': 1,
+            'model_run': VALID_MODEL_RUN_FIXTURE,
+            'sequence': sequence,
+            'previous_sequence': previous_sequence,
+        }
+
+    def test_replay_missed_events(self):
+        daemon = self.make_event_daemon()
+        daemon.event_replay = FakeEventReplay([self.make_sequenced_message('data', 2, 12, 10)])
+        daemon.zmq_ingress.put(syncer.zeromq.INGRESS_EVENT, self.make_sequenced_message('model_run', 1, 10, None))
+        daemon.zmq_ingress.put(syncer.zeromq.INGRESS_EVENT, self.make_sequenced_message('data', 1, 11, 10))
+        daemon.main_loop_zmq()
+        self.assertEqual(daemon.event_replay.requests, [])
+        daemon.zmq_ingress.put(syncer.zeromq.INGRESS_EVENT, self.make_sequenced_message('data', 3, 14, 12))
+        daemon.main_loop_zmq()
+        self.assertEqual(daemon.event_replay.requests, [('arome_metcoop_2500m', 11, 14)])
+        self.assertEqual(daemon.metrics.get('zmq_events_replayed'), 1)
+        self.assertEqual(daemon.event_coalescer.events, 4)
+
+    def test_replay_failure_fetches_latest_model_run(self):
+        daemon = self.make_event_daemon()
+        daemon.event_replay = FakeEventReplay([], syncer.exceptions.RESTServiceUnavailableException('down'))
+        fetched = []
+        daemon.get_latest_model_run = lambda model: fetched.append(model.data_provider)
+        daemon.zmq_ingress.put(syncer.zeromq.INGRESS_EVENT, self.make_sequenced_message('model_run', 1, 10, None))
+        daemon.zmq_ingress.put(syncer.zeromq.INGRESS_EVENT, self.make_sequenced_message('data', 1, 14, 12))
+        daemon.main_loop_zmq()
+        self.assertEqual(daemon.event_replay.requests, [('arome_metcoop_2500m', 10, 14)])
+        self.assertEqual(fetched, ['arome_metcoop_2500m'])
+
+    def test_replay_gap_too_old_fetches_latest_model_run(self):
+        daemon = self.make_event_daemon()
+        daemon.event_replay = FakeEventReplay([], syncer.exceptions.EventReplayGapTooOld('gone'))
+        fetched = []
+        daemon.get_latest_model_run = lambda model: fetched.append(model.data_provider)
+        daemon.replay_events('arome_metcoop_2500m', 10, 14)
+        self.assertEqual(fetched, ['arome_metcoop_2500m'])
+        self.assertEqual(daemon.metrics.get('zmq_replay_gaps_too_old'), 1)
+
+    def test_heartbeat_replays_missed_events(self):
+        daemon = self.make_event_daemon()
+        synced = []
+        daemon.sync_zmq_status = lambda: synced.append(True)
+        daemon.event_replay = FakeEventReplay([self.make_sequenced_message('data', 2, 12, 10)])
+        heartbeat = {'version': [1, 5, 0], 'type': 'heartbeat', 'epoch': 1.0, 'sequence': 12, 'sequences': {'arome_metcoop_2500m': 12, 'ecdet': 11}}
+        daemon.zmq_ingress.put(syncer.zeromq.INGRESS_EVENT, self.make_sequenced_message('model_run', 1, 10, None))
+        daemon.zmq_ingress.put(syncer.zeromq.INGRESS_EVENT, heartbeat)
+        daemon.main_loop_zmq()
+        self.assertEqual(daemon.event_replay.requests, [('arome_metcoop_2500m', 10, 13)])
+        self.assertEqual(synced, [True])
+        self.assertEqual(daemon.zmq_subscriber.epoch, 1.0)
+
+    def test_poll_skips_sequenced_models(self):
+        daemon = self.make_event_daemon()
+        fetched = []
+        daemon.get_latest_model_run = lambda model: fetched.append(model.data_provider)
+        for model in daemon.models:
+            model.get_monitoring_state = lambda: syncer.MONITORING_CRITICAL
+        daemon.main_loop_poll()
+        self.assertEqual(fetched, ['arome_metcoop_2500m'])
+        daemon.zmq_subscriber.check_sequence(daemon.zmq_subscriber.parse_event(self.make_sequenced_message('model_run', 1, 10, None)))
+        daemon.next_poll = 0
+        daemon.main_loop_poll()
+        self.assertEqual(fetched, ['arome_metcoop_2500m'])
+
+    def test_load_model_job_failure(self):
+        daemon = self.make_daemon()
+        daemon.sync_zmq_status = lambda: None
+        daemon.wdb = LocalWDB('localhost', 'test')
+        model_run = modelstatus.ModelRun(VALID_MODEL_RUN_FIXTURE)
+        for model in daemon.models:
+            model.load_program = 'false'
+            model.set_available_model_run(model_run)
+            daemon.load_model(model)
+            self.wait_for_jobs(daemon)
+            self.assertIsNone(model.wdb_model_run)
+            self.assertTrue(model.has_pending_wdb_load())
+        daemon.worker_pool.terminate()
+
     def test_instance_model_type_error(self):
         models = ['invalid type']
         with self.assertRaises(TypeError):
@@ -325,6 +1541,382 @@ class DaemonTest(unittest.TestCase):
             syncer.Daemon(self.config, models)
 
 
+class OutputCaptureTest(unittest.TestCase):
+    def test_bounded_lines(self):
+        capture = syncer.wdb.OutputCapture(3)
+        for index in range(10):
+            capture.feed('line %d\n' % index)
+        self.assertEqual(capture.text(), 'line 7\nline 8\nline 9')
+        self.assertEqual(capture.total_lines, 10)
+
+    def test_counters(self):
+        capture = syncer.wdb.OutputCapture()
+        capture.feed('Finished: 120 fields loaded, 4 duplicates\n')
+        capture.feed('Nothing to see here\n')
+        self.assertEqual(capture.counters, {'fields_loaded': 120, 'fields_duplicate': 4})
+
+
+class MetricsTest(unittest.TestCase):
+    def test_counters(self):
+        metrics = syncer.metrics.Metrics()
+        self.assertEqual(metrics.get('foo'), 0)
+        metrics.increment('foo')
+        metrics.increment('foo', 2)
+        self.assertEqual(metrics.get('foo'), 3)
+
+    def test_timings(self):
+        metrics = syncer.metrics.Metrics()
+        metrics.add_timing('load', 2.0)
+        metrics.add_timing('load', 1.0)
+        serialized = metrics.serialize()
+        self.assertEqual(serialized['timings']['load'], {'count': 2, 'total': 3.0, 'max': 2.0, 'last': 1.0})
+        self.assertEqual(serialized['counters'], {})
+
+
+class CacheWarmerTest(unittest.TestCase):
+    QUERIES = [
+        'aromeecepsforecast?lat=59.91;lon=10.75',
+        'aromeecepsforecast?lat=60.39;lon=5.32',
+        'proffecepsforecast?lat=59.91;lon=10.75',
+    ]
+
+    def setUp(self):
+        self.server = LocalHTTPServer()
+        for query in self.QUERIES:
+            self.server.responses['/metno-wdb2ts/%s' % query] = (200, 'OK')
+        self.metrics = syncer.metrics.Metrics()
+        self.warmer = syncer.warmer.CacheWarmer(self.QUERIES, concurrency=2, timeout=1, metrics=self.metrics)
+
+    def tearDown(self):
+        self.server.stop()
+
+    def test_read_queries_file(self):
+        path = tempfile.mktemp()
+        with open(path, 'w') as f:
+            f.write('# comment\n\naromeecepsforecast?lat=59.91;lon=10.75\n')
+        try:
+            self.assertEqual(syncer.warmer.read_queries_file(path), ['aromeecepsforecast?lat=59.91;lon=10.75'])
+        finally:
+            os.unlink(path)
+
+    def test_sample_access_log(self):
+        line = '127.0.0.1 - - [19/Jan/2015:16:04:40 +0000] "GET /metno-wdb2ts/%s HTTP/1.1" 200 1234\n'
+        path = tempfile.mktemp()
+        with open(path, 'w') as f:
+            f.write(line % 'proffecepsforecast?lat=1;lon=2')
+            f.write(line % 'aromeecepsforecast?lat=3;lon=4' * 2)
+            f.write(line % 'aromeecepsforecast?status')
+            f.write(line % 'aromeecepsforecastupdate?arome_metcoop_2500m=2015-01-19T16:04:40Z,1337')
+            f.write('garbage\n')
+        try:
+            queries = syncer.warmer.sample_access_log(path, 10)
+            self.assertEqual(queries, ['aromeecepsforecast?lat=3;lon=4', 'proffecepsforecast?lat=1;lon=2'])
+            self.assertEqual(syncer.warmer.sample_access_log(path, 1), queries[:1])
+        finally:
+            os.unlink(path)
+
+    def test_warm_updated_services(self):
+        results = self.warmer.warm([(self.server.get_base_url(), ['aromeecepsforecast'])])
+        self.assertEqual(len(results), 2)
+        self.assertTrue(all([result.success() for result in results]))
+        self.assertEqual(sorted(self.server.requests), sorted(['/metno-wdb2ts/%s' % query for query in self.QUERIES[:2]]))
+        timings = self.metrics.serialize()['timings']
+        self.assertEqual(timings['wdb2ts_warmup_request']['count'], 2)
+        self.assertEqual(timings['wdb2ts_warmup']['count'], 1)
+
+    def test_warm_bounded_concurrency(self):
+        self.server.delay = 0.2
+        start = time.time()
+        self.warmer.warm([(self.server.get_base_url(), ['aromeecepsforecast', 'proffecepsforecast'])])
+        self.assertGreaterEqual(time.time() - start, 0.4)
+
+    def test_warm_failures(self):
+        del self.server.responses['/metno-wdb2ts/%s' % self.QUERIES[0]]
+        results = self.warmer.warm([(self.server.get_base_url(), ['aromeecepsforecast'])])
+        self.assertEqual(len([result for result in results if not result.success()]), 1)
+        self.assertEqual(self.metrics.get('wdb2ts_warmup_failures'), 1)
+
+    def test_warm_nothing(self):
+        self.assertEqual(self.warmer.warm([(self.server.get_base_url(), ['unknownservice'])]), [])
+        self.assertEqual(self.server.requests, [])
+
+
+class EventReplayTest(unittest.TestCase):
+    def setUp(self):
+        self.server = LocalHTTPServer()
+        self.replay = syncer.replay.EventReplay(self.server.get_base_url(), timeout=1)
+
+    def tearDown(self):
+        self.server.stop()
+
+    def test_get_page(self):
+        self.server.responses['/metno-wdb2ts/event'] = (200, json.dumps([{'sequence': 1}]))
+        self.assertEqual(self.replay.get_page({}), [{'sequence': 1}])
+
+    def test_get_page_server_error(self):
+        self.server.responses['/metno-wdb2ts/event'] = (500, 'Internal server error')
+        with self.assertRaises(syncer.exceptions.RESTServiceUnavailableException):
+            self.replay.get_page({})
+
+    def test_get_page_gap_too_old(self):
+        self.server.responses['/metno-wdb2ts/event'] = (410, '{"title": "Gap too old"}')
+        with self.assertRaises(syncer.exceptions.EventReplayGapTooOld):
+            self.replay.get_page({})
+
+    def test_get_page_invalid(self):
+        self.server.responses['/metno-wdb2ts/event'] = (200, '{"sequence": 1}')
+        with self.assertRaises(syncer.exceptions.UnserializeException):
+            self.replay.get_page({})
+
+    def test_get_events_pages(self):
+        pages = [[{'sequence': x} for x in range(11, 11 + syncer.replay.PAGE_SIZE)], [{'sequence': 200}]]
+        params = []
+
+        def get_page(x):
+            params.append(x['after'])
+            return pages[len(params) - 1]
+        self.replay.get_page = get_page
+        messages = self.replay.get_events('arome25', 10, 201)
+        self.assertEqual(len(messages), syncer.replay.PAGE_SIZE + 1)
+        self.assertEqual(params, [10, 10 + syncer.replay.PAGE_SIZE])
+
+
+class CodecTest(unittest.TestCase):
+    MESSAGE = {'type': 'resource', 'id': 1, 'model_run': {'data_provider': u'arome25', 'data': [{'href': u'opdata:///\xe6.nc'}]}}
+
+    def test_json_roundtrip(self):
+        data = syncer.codec.CODECS['json'].encode(self.MESSAGE)
+        self.assertEqual(data[:1], '{')
+        self.assertEqual(syncer.codec.decode(data), self.MESSAGE)
+
+    def test_zlib_roundtrip(self):
+        data = syncer.codec.CODECS['zlib'].encode(self.MESSAGE)
+        self.assertEqual(data[:1], syncer.codec.CODECS['zlib'].marker)
+        self.assertEqual(syncer.codec.decode(data), self.MESSAGE)
+
+    @unittest.skipIf(syncer.codec.msgpack is None, 'msgpack is not installed')
+    def test_msgpack_roundtrip(self):
+        data = syncer.codec.CODECS['msgpack'].encode(self.MESSAGE)
+        self.assertEqual(syncer.codec.decode(data), self.MESSAGE)
+
+    def test_decode_invalid(self):
+        with self.assertRaises(ValueError):
+            syncer.codec.decode('\xffgarbage')
+        with self.assertRaises(ValueError):
+            syncer.codec.decode(syncer.codec.CODECS['zlib'].marker + 'garbage')
+        with self.assertRaises(ValueError):
+            syncer.codec.decode('{garbage')
+
+    def test_parse_codecs(self):
+        self.assertEqual(syncer.codec.parse_codecs(' zlib, json'), ['zlib', 'json'])
+        with self.assertRaises(ValueError):
+            syncer.codec.parse_codecs('zlib,xml')
+
+    def test_get_codec(self):
+        self.assertEqual(syncer.codec.get_codec(['zlib', 'json']).name, 'zlib')
+        self.assertEqual(syncer.codec.get_codec(['zlib', 'json'], ['json']).name, 'json')
+        self.assertEqual(syncer.codec.get_codec(['zlib'], ['msgpack']).name, 'json')
+
+    def test_benchmark(self):
+        status = syncer.benchmark.make_status(3, 10)
+        results = dict([(x[0], x) for x in syncer.benchmark.run(status, 2)])
+        self.assertEqual(sorted(results.keys()), sorted(syncer.codec.available_codecs()))
+        self.assertLess(results['zlib'][1], results['json'][1])
+
+
+class StateStoreTest(unittest.TestCase):
+    def setUp(self):
+        self.state_dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.state_dir, 'state.json')
+        self.store = syncer.state.StateStore(self.path, 3)
+
+    def tearDown(self):
+        shutil.rmtree(self.state_dir)
+
+    def make_state(self, **kwargs):
+        model = {'data_provider': 'arome', 'version': 1, 'loaded': False}
+        model.update(kwargs)
+        return {'models': [model]}
+
+    def read_journal(self):
+        with open(self.store.journal_path) as f:
+            return f.readlines()
+
+    def test_read_missing(self):
+        self.assertEqual(self.store.read(), {})
+
+    def test_read_legacy_state_file(self):
+        with open(self.path, 'w') as f:
+            json.dump(VALID_STATE_HASH, f, indent=4)
+        self.assertEqual(self.store.read(), VALID_STATE_HASH)
+
+    def test_read_corrupt_snapshot(self):
+        with open(self.path, 'w') as f:
+            f.write('{"models": [')
+        with self.assertRaises(ValueError):
+            self.store.read()
+
+    def test_journal_changes_only(self):
+        self.store.write(self.make_state())
+        self.assertEqual(self.read_journal(), [])
+        self.store.write(self.make_state())
+        self.assertEqual(self.read_journal(), [])
+        self.store.write(self.make_state(loaded=True))
+        records = [json.loads(line) for line in self.read_journal()]
+        self.assertEqual(records, [{'sequence': 2, 'models': {'arome': {'loaded': True}}}])
+        self.assertEqual(syncer.state.StateStore(self.path).read(), self.make_state(loaded=True))
+
+    def test_compaction(self):
+        self.store.write(self.make_state())
+        for version in range(2, 7):
+            self.store.write(self.make_state(version=version))
+        self.assertEqual(len(self.read_journal()), 1)
+        self.assertEqual(syncer.state.StateStore(self.path).read(), self.make_state(version=6))
+        self.assertEqual(sorted(os.listdir(self.state_dir)), ['state.json', 'state.json.journal'])
+
+    def test_snapshot_failure_removes_temporary_file(self):
+        with self.assertRaises(TypeError):
+            self.store.write(self.make_state(loaded=object()))
+        self.assertEqual(os.listdir(self.state_dir), [])
+
+    def test_replay_skips_compacted_records(self):
+        self.store.write(self.make_state())
+        self.store.write(self.make_state(version=2))
+        journal = self.read_journal()
+        self.store.write(self.make_state(version=3))
+        self.store.write(self.make_state(version=4))
+        self.store.write(self.make_state(version=5))
+        # Simulate a crash between writing the snapshot and emptying the journal
+        with open(self.store.journal_path, 'w') as f:
+            f.writelines(journal)
+        self.assertEqual(syncer.state.StateStore(self.path).read(), self.make_state(version=5))
+
+    def test_partial_append_is_truncated(self):
+        self.store.write(self.make_state())
+        self.store.write(self.make_state(version=2))
+        append_journal = self.store.append_journal
+
+        def fail(line):
+            append_journal(line[:10])
+            raise IOError('No space left on device')
+        self.store.append_journal = fail
+        with self.assertRaises(IOError):
+            self.store.write(self.make_state(version=3))
+        self.assertEqual(len(self.read_journal()), 1)
+
+        self.store.append_journal = append_journal
+        self.store.write(self.make_state(version=3))
+        self.assertEqual(len(self.read_journal()), 2)
+        self.assertEqual(syncer.state.StateStore(self.path).read(), self.make_state(version=3))
+
+    def test_replay_truncated_record(self):
+        self.store.write(self.make_state())
+        self.store.write(self.make_state(version=2))
+        with open(self.store.journal_path, 'a') as f:
+            f.write('{"sequence": 2, "mod')
+        store = syncer.state.StateStore(self.path)
+        self.assertEqual(store.read(), self.make_state(version=2))
+        store.write(self.make_state(version=3))
+        self.assertEqual(syncer.state.StateStore(self.path).read(), self.make_state(version=3))
+
+
+class EventCoalescerTest(unittest.TestCase):
+    def test_window(self):
+        coalescer = syncer.coalescer.EventCoalescer(60)
+        self.assertIsNone(coalescer.time_until_due())
+        coalescer.add('data', 2)
+        coalescer.add('data', 2)
+        coalescer.add('model_run', 1)
+        coalescer.add('data', 3)
+        self.assertGreater(coalescer.time_until_due(), 0)
+        self.assertFalse(coalescer.is_due())
+        coalescer.window = 0
+        self.assertTrue(coalescer.is_due())
+        self.assertEqual(coalescer.take(), ([1], [2, 3], {}))
+        self.assertIsNone(coalescer.time_until_due())
+        self.assertEqual(coalescer.take(), ([], [], {}))
+
+    def test_payloads(self):
+        coalescer = syncer.coalescer.EventCoalescer(0)
+        coalescer.add('data', 2, 1, 'first')
+        coalescer.add('data', 3, 1, 'second')
+        coalescer.add('model_run', 4, 4)
+        self.assertEqual(coalescer.take(), ([1, 4], [], {1: 'second'}))
+
+
+class AnalyzeSchedulerTest(unittest.TestCase):
+    def setUp(self):
+        self.scheduler = syncer.maintenance.AnalyzeScheduler(60, ['wdb_int.gridvalue'])
+        self.model_run = modelstatus.ModelRun(VALID_MODEL_RUN_FIXTURE)
+
+    def test_coalesce(self):
+        self.assertIsNone(self.scheduler.time_until_due())
+        self.scheduler.request(self.model_run)
+        self.scheduler.request(self.model_run)
+        self.assertFalse(self.scheduler.is_due())
+        self.scheduler.window_start -= 60
+        self.assertTrue(self.scheduler.is_due())
+        self.assertEqual(self.scheduler.start(), ['arome_metcoop_2500m'])
+        self.assertIsNone(self.scheduler.time_until_due())
+
+    def test_retry(self):
+        self.scheduler.request(self.model_run)
+        self.scheduler.start()
+        self.scheduler.finish(False)
+        self.assertEqual(self.scheduler.pending, set(['arome_metcoop_2500m']))
+        self.scheduler.start()
+        self.scheduler.finish(True)
+        self.assertEqual(self.scheduler.pending, set())
+
+    def test_create_analyze_statements(self):
+        self.assertEqual(syncer.wdb.WDB.create_analyze_statements([]), ['ANALYZE'])
+        self.assertEqual(syncer.wdb.WDB.create_analyze_statements(['a', 'b']), ['ANALYZE a', 'ANALYZE b'])
+
+    def test_cache_statements_without_analyze(self):
+        statements = syncer.wdb.WDB.create_cache_statements(self.model_run, False)
+        self.assertNotIn('ANALYZE', statements)
+
+
+class WorkerPoolTest(unittest.TestCase):
+    def setUp(self):
+        self.pool = syncer.worker.WorkerPool(2)
+
+    def tearDown(self):
+        self.pool.terminate()
+
+    def wait(self, job):
+        job.async_result.wait()
+        return self.pool.collect()
+
+    def test_submit_collect(self):
+        model = syncer.Model(VALID_MODEL_FIXTURE)
+        job = self.pool.submit(model, 'test', None, lambda x: x * 2, 21)
+        self.assertTrue(self.pool.busy(model))
+        self.assertEqual(self.wait(job), [job])
+        self.assertEqual(job.get(), 42)
+        self.assertFalse(self.pool.busy(model))
+        self.assertEqual(self.pool.pending(), 0)
+
+    def test_one_job_per_model(self):
+        model = syncer.Model(VALID_MODEL_FIXTURE)
+        other = syncer.Model(VALID_MODEL_FIXTURE)
+        job = self.pool.submit(model, 'test', None, lambda: None)
+        self.assertIsNone(self.pool.submit(model, 'test', None, lambda: None))
+        self.assertIsNotNone(self.pool.submit(other, 'test', None, lambda: None))
+        self.wait(job)
+
+    def test_exception(self):
+        model = syncer.Model(VALID_MODEL_FIXTURE)
+
+        def fail():
+            raise syncer.exceptions.WDBLoadFailed('foo')
+
+        job = self.pool.submit(model, 'test', None, fail)
+        self.wait(job)
+        with self.assertRaises(syncer.exceptions.WDBLoadFailed):
+            job.get()
+
+
 class ModelTest(unittest.TestCase):
     def setUp(self):
         self.config_file = StringIO.StringIO(config_file_contents)
@@ -341,6 +1933,35 @@ class ModelTest(unittest.TestCase):
         data = syncer.Model.data_from_config_section(self.config, 'model_foo')
         self.assertEqual(data, VALID_MODEL_FIXTURE)
 
+    def test_load_checkpoint(self):
+        model = self.get_model()
+        model_run = self.get_model_run()
+        results = [
+            syncer.wdb.WDBLoadResult('/a.nc', 1.0),
+            syncer.wdb.WDBLoadResult('/b.nc', 1.0, syncer.exceptions.WDBLoadFailed('failed')),
+        ]
+        model.set_load_results(model_run, results)
+        self.assertEqual(model.get_loaded_files(model_run), ['/a.nc'])
+        model.set_load_results(model_run, [syncer.wdb.WDBLoadResult('/b.nc', 1.0)])
+        self.assertEqual(model.get_loaded_files(model_run), ['/a.nc', '/b.nc'])
+
+        model.unserialize(model.serialize())
+        self.assertEqual(model.get_loaded_files(model_run), ['/a.nc', '/b.nc'])
+
+        model.reset_load_checkpoint()
+        self.assertEqual(model.get_loaded_files(model_run), [])
+
+    def test_place_definitions_state(self):
+        model = self.get_model()
+        model.set_place_definition_loaded()
+        serialized = model.serialize()
+        self.assertEqual(serialized['place_definitions'], ['arome_metcoop_2500m default'])
+        del serialized['place_definitions']
+        model = self.get_model()
+        model.unserialize(serialized)
+        self.assertEqual(model.place_definitions, [])
+        self.assertTrue(model.needs_place_definition())
+
     def test_instantiate(self):
         model = self.get_model()
         for key, value in VALID_MODEL_FIXTURE.iteritems():
@@ -365,6 +1986,13 @@ class ModelTest(unittest.TestCase):
         del serialized['model_run_version']
         del serialized['_available_model_run_initialized']
 
+        self.assertEqual(serialized['place_definitions'], [])
+        del serialized['place_definitions']
+        self.assertEqual(serialized['load_checkpoint'], None)
+        del serialized['load_checkpoint']
+        self.assertEqual(serialized['wdb2ts_host_model_run'], {})
+        del serialized['wdb2ts_host_model_run']
+
         for key, value in serialized.iteritems():
             self.assertEqual(serialized[key], VALID_MODEL_FIXTURE[key])
 
@@ -430,6 +2058,22 @@ class ModelTest(unittest.TestCase):
         model.set_wdb2ts_model_run(model_run)
         self.assertEqual(model.has_pending_wdb2ts_update(), False)
 
+    def test_pending_wdb2ts_hosts(self):
+        model = self.get_model()
+        model_run = self.get_model_run()
+        hosts = ['http://a/metno-wdb2ts', 'http://b/metno-wdb2ts']
+        self.assertEqual(model.get_pending_wdb2ts_hosts(hosts), [])
+        model.set_wdb_model_run(model_run)
+        self.assertEqual(model.get_pending_wdb2ts_hosts(hosts), hosts)
+        model.set_wdb2ts_host_model_run(hosts[0], model_run)
+        self.assertEqual(model.get_pending_wdb2ts_hosts(hosts), hosts[1:])
+
+        model.unserialize(model.serialize())
+        self.assertEqual(model.get_pending_wdb2ts_hosts(hosts), hosts[1:])
+
+        model.set_must_update_wdb2ts(True)
+        self.assertEqual(model.get_pending_wdb2ts_hosts(hosts), hosts)
+
     def test_set_invalid_data(self):
         """
         Test that the various set_ functions only accepts a ModelRun object.
@@ -469,6 +2113,70 @@ class ModelTest(unittest.TestCase):
         version = model.get_model_run_version(model_run)
         self.assertEqual(version, ref_version)
 
+    def test_prune_model_run_version(self):
+        model = self.get_model()
+        model.model_run_version_retention = 60 * 24
+        model_run = self.get_model_run()
+        model.set_model_run_version(model_run, 1)
+        model_run.reference_time += datetime.timedelta(hours=12)
+        model.set_model_run_version(model_run, 2)
+        self.assertEqual(len(model.model_run_version), 2)
+        model_run.reference_time += datetime.timedelta(hours=13)
+        model.set_model_run_version(model_run, 3)
+        self.assertEqual(sorted(model.model_run_version.values()), [2, 3])
+
+    def test_unserialize_prunes_model_run_version(self):
+        model = self.get_model()
+        serialized = model.serialize()
+        serialized['model_run_version'] = {
+            '2015-01-01T00:00:00Z': 1,
+            '2015-03-03T00:00:00Z': 2,
+            '2015-03-09T12:00:00Z': 3,
+        }
+        model.unserialize(serialized)
+        self.assertEqual(model.model_run_version, {'2015-03-09T12:00:00Z': 3, '2015-03-03T00:00:00Z': 2})
+
+    def test_serialize_compact_model_run(self):
+        model = self.get_model()
+        model_run_fixture = copy.deepcopy(VALID_MODEL_RUN_FIXTURE)
+        model_run_fixture['data'].append(dict(model_run_fixture['data'][0], href='opdata:///other/unmatched.nc'))
+        model_run = modelstatus.ModelRun(model_run_fixture)
+        model.set_available_model_run(model_run)
+        model.set_wdb_model_run(model_run)
+        model.set_wdb2ts_host_model_run('http://a/metno-wdb2ts', model_run)
+        serialized = model.serialize()
+        self.assertEqual(serialized['available_model_run'], {
+            'id': 1,
+            'reference_time': '2015-01-19T16:04:40Z',
+            'version': 1337,
+            'data': [{'href': VALID_MODEL_RUN_FIXTURE['data'][0]['href']}],
+        })
+        self.assertEqual(serialized['wdb2ts_host_model_run'], {
+            'http://a/metno-wdb2ts': {'id': 1, 'reference_time': '2015-01-19T16:04:40Z', 'version': 1337},
+        })
+
+        model = self.get_model()
+        model.unserialize(serialized)
+        self.assertEqual(model.available_model_run.id, 1)
+        self.assertEqual(model.available_model_run.data_provider, model.data_provider)
+        self.assertEqual(model.available_model_run.reference_time, model_run.reference_time)
+        self.assertEqual([x.href for x in model.wdb_model_run.data], [VALID_MODEL_RUN_FIXTURE['data'][0]['href']])
+        self.assertTrue(model.is_complete_dataset(model.wdb_model_run.data))
+        self.assertEqual(model.get_model_run_version(model.wdb_model_run), 1337)
+        self.assertEqual(model.serialize(), serialized)
+
+    def test_unserialize_legacy_model_run(self):
+        model = self.get_model()
+        model.data_uri_pattern = 'AROME_MetCoOp'
+        model.unserialize(VALID_STATE_HASH['models'][0])
+        self.assertIsInstance(model.available_model_run, modelstatus.ModelRun)
+        self.assertEqual(model.serialize()['available_model_run'], {
+            'id': 801,
+            'reference_time': '2015-03-09T12:00:00Z',
+            'version': 1,
+            'data': [{'href': 'opdata:///arome2_5/AROME_MetCoOp_12_fp.nc'}],
+        })
+
     def test_increment_model_run_version(self):
         model = self.get_model()
         model_run = self.get_model_run()
@@ -523,6 +2231,38 @@ class ZeroMQTest(unittest.TestCase):
         self.assertEqual(event.id, 123)
         self.assertEqual(event.version, ZEROMQ_PROTOCOL_VERSION)
 
+    def test_zmqevent_model_run_payload(self):
+        data = {
+            'version': [1, 2, 0],
+            'type': 'resource',
+            'resource': 'data',
+            'id': 123,
+            'model_run_id': 1,
+            'model_run': VALID_MODEL_RUN_FIXTURE,
+        }
+        event = syncer.zeromq.ZMQEvent.factory(**data)
+        self.assertEqual(event.model_run_id, 1)
+        model_run = event.get_model_run()
+        self.assertIsInstance(model_run, modelstatus.ModelRun)
+        self.assertEqual(model_run.data_provider, VALID_MODEL_RUN_FIXTURE['data_provider'])
+
+    def test_zmqevent_invalid_model_run_payload(self):
+        data = {
+            'version': [1, 2, 0],
+            'type': 'resource',
+            'resource': 'model_run',
+            'id': 1,
+            'model_run': {'id': 1},
+        }
+        event = syncer.zeromq.ZMQEvent.factory(**data)
+        self.assertEqual(event.model_run_id, 1)
+        self.assertIsNone(event.get_model_run())
+
+    def test_zmqevent_without_payload(self):
+        event = syncer.zeromq.ZMQEvent.factory(version=ZEROMQ_PROTOCOL_VERSION, type='resource', resource='data', id=123)
+        self.assertIsNone(event.model_run_id)
+        self.assertIsNone(event.get_model_run())
+
     def test_zmqevent_invalid_id(self):
         data = {
             'version': ZEROMQ_PROTOCOL_VERSION,
@@ -600,6 +2340,305 @@ class ZeroMQTest(unittest.TestCase):
         self.assertEqual(data['status'], 0)
         self.assertEqual(data['data'], ['Hello, world!'])
 
+    def test_ingress_drains_sockets(self):
+        context = zmq.Context.instance()
+        publisher = context.socket(zmq.PUB)
+        publisher.bind('ipc://test_ingress')
+        subscriber = syncer.zeromq.ZMQSubscriber('ipc://test_ingress', 30, 30)
+        agent = self.make_agent()
+        ingress = syncer.zeromq.ZMQIngress(subscriber, agent)
+        ingress.start()
+        try:
+            # Wait for the subscription to be established
+            deadline = time.time() + 5
+            batch = []
+            while not batch and time.time() < deadline:
+                publisher.send_json({'id': 0})
+                batch = ingress.get_batch(0.1)
+            for index in range(1, 201):
+                publisher.send_json({'id': index})
+            received = []
+            while len(received) < 200 and time.time() < deadline:
+                received += [msg['id'] for kind, msg in ingress.get_batch(0.5) if msg['id'] > 0]
+            self.assertEqual(received, range(1, 201))
+            self.assertEqual(ingress.dropped, 0)
+        finally:
+            ingress.stop()
+            publisher.close()
+
+    def test_make_topic(self):
+        self.assertEqual(syncer.zeromq.make_topic('model_run', 'arome25'), 'model_run arome25\0')
+
+    def test_check_sequence(self):
+        def event(sequence, previous_sequence, data_provider='arome25'):
+            return syncer.zeromq.ZMQEvent.factory(version=[1, 4, 0], type='resource', resource='model_run', id=1,
+                                                  model_run={'data_provider': data_provider},
+                                                  sequence=sequence, previous_sequence=previous_sequence)
+        self.assertFalse(self.zmq.is_sequenced('arome25'))
+        self.assertIsNone(self.zmq.check_sequence(event(5, 3)))
+        self.assertTrue(self.zmq.is_sequenced('arome25'))
+        self.assertIsNone(self.zmq.check_sequence(event(7, 5)))
+        self.assertIsNone(self.zmq.check_sequence(event(8, None, 'ecdet')))
+        self.assertEqual(self.zmq.check_sequence(event(12, 9)), 7)
+        self.assertIsNone(self.zmq.check_sequence(event(13, 12)))
+        self.assertIsNone(self.zmq.check_sequence(event(1, None)))
+        legacy = syncer.zeromq.ZMQEvent.factory(version=[1, 1, 0], type='resource', resource='model_run', id=1)
+        self.assertIsNone(self.zmq.check_sequence(legacy))
+
+    def make_heartbeat(self, epoch, sequences):
+        return syncer.zeromq.ZMQEvent.factory(version=[1, 5, 0], type='heartbeat', epoch=epoch,
+                                              sequence=max(sequences.values()), sequences=sequences)
+
+    def test_check_heartbeat(self):
+        self.assertEqual(self.zmq.check_heartbeat(self.make_heartbeat(1.0, {'arome25': 5, 'ecdet': 3})), [])
+        self.assertTrue(self.zmq.is_sequenced('ecdet'))
+        event = syncer.zeromq.ZMQEvent.factory(version=[1, 5, 0], type='resource', resource='model_run', id=1,
+                                               model_run={'data_provider': 'arome25'}, sequence=6, previous_sequence=5)
+        self.assertIsNone(self.zmq.check_sequence(event))
+        self.assertEqual(self.zmq.check_heartbeat(self.make_heartbeat(1.0, {'arome25': 6, 'ecdet': 3})), [])
+
+        # events published while the connection was down are found after a restart
+        gaps = self.zmq.check_heartbeat(self.make_heartbeat(2.0, {'arome25': 9, 'ecdet': 3}))
+        self.assertEqual(gaps, [('arome25', 6, 10)])
+        self.assertEqual(self.zmq.epoch, 2.0)
+        self.assertEqual(self.zmq.check_heartbeat(self.make_heartbeat(2.0, {'arome25': 9, 'ecdet': 3})), [])
+
+    def test_check_heartbeat_data_providers(self):
+        self.zmq.data_providers = ['arome25']
+        self.zmq.check_heartbeat(self.make_heartbeat(1.0, {'arome25': 5, 'ecdet': 3}))
+        self.assertEqual(self.zmq.sequences, {'arome25': 5})
+
+    def test_reconnect_if_late(self):
+        self.assertFalse(self.zmq.reconnect_if_late())
+        self.zmq.heartbeat_timeout = 1
+        self.zmq.last_heartbeat = time.time()
+        self.zmq.sequences['arome25'] = 5
+        self.assertTrue(self.zmq.is_sequenced('arome25'))
+        self.assertFalse(self.zmq.reconnect_if_late())
+        self.zmq.last_heartbeat -= 5
+        self.assertFalse(self.zmq.is_sequenced('arome25'))
+        sock = self.zmq.sock
+        self.assertTrue(self.zmq.reconnect_if_late())
+        self.assertTrue(sock.closed)
+        self.assertFalse(self.zmq.sock.closed)
+        self.assertFalse(self.zmq.reconnect_if_late())
+
+    def test_subscriber_heartbeat(self):
+        publisher = zmq.Context.instance().socket(zmq.PUB)
+        publisher.bind('ipc://test_heartbeat')
+        subscriber = syncer.zeromq.ZMQSubscriber('ipc://test_heartbeat', 30, 30, ['arome25'], 30)
+        try:
+            deadline = time.time() + 5
+            msg = None
+            while msg is None and time.time() < deadline:
+                publisher.send_multipart([syncer.zeromq.HEARTBEAT_TOPIC, json.dumps({'type': 'heartbeat', 'epoch': 1.0})])
+                time.sleep(0.01)
+                msg = subscriber.recv()
+            self.assertEqual(msg['epoch'], 1.0)
+            self.assertLess(subscriber.heartbeat_age(), 5)
+        finally:
+            subscriber.sock.close()
+            publisher.close()
+
+    def test_has_expected_topic(self):
+        topic = syncer.zeromq.make_topic('data', 'arome25')
+        self.assertTrue(syncer.zeromq.has_expected_topic(['{}'], {'version': [1, 2, 0]}))
+        self.assertTrue(syncer.zeromq.has_expected_topic([topic, '{}'], {'version': [1, 6, 0]}))
+        self.assertFalse(syncer.zeromq.has_expected_topic(['{}'], {'version': [1, 3, 0]}))
+        self.assertFalse(syncer.zeromq.has_expected_topic(['{}'], {'version': [1, 6, 0]}))
+
+    def test_subscriptions(self):
+        self.assertEqual(self.zmq.get_subscriptions(), ['model_run ', 'data ', syncer.zeromq.HEARTBEAT_TOPIC, '{'])
+        self.zmq.negotiate(['json', 'zlib'])
+        self.assertEqual(self.zmq.codec.name, 'zlib')
+        self.assertEqual(self.zmq.get_subscriptions(), ['zlib:model_run ', 'zlib:data ', syncer.zeromq.HEARTBEAT_TOPIC])
+        self.zmq.negotiate(None)
+        self.assertEqual(self.zmq.codec.name, 'json')
+
+    def test_subscriber_negotiates_codec(self):
+        publisher = zmq.Context.instance().socket(zmq.PUB)
+        publisher.bind('ipc://test_codec')
+        subscriber = syncer.zeromq.ZMQSubscriber('ipc://test_codec', 30, 30, ['arome25'], 30, ['zlib', 'json'])
+        zlib_codec = syncer.codec.CODECS['zlib']
+        heartbeat = {'type': 'heartbeat', 'epoch': 1.0, 'codecs': ['json', 'zlib']}
+
+        def publish(id):
+            publisher.send_multipart([syncer.zeromq.make_topic('model_run', 'arome25'), json.dumps({'id': id, 'codec': 'json'})])
+            publisher.send_multipart([syncer.zeromq.make_topic('model_run', 'arome25', zlib_codec), zlib_codec.encode({'id': id, 'codec': 'zlib'})])
+
+        def receive():
+            received = []
+            time.sleep(0.05)
+            msg = subscriber.recv()
+            while msg is not None:
+                received += [msg]
+                msg = subscriber.recv()
+            return received
+
+        try:
+            deadline = time.time() + 5
+            while subscriber.codec.name != 'zlib' and time.time() < deadline:
+                publisher.send_multipart([syncer.zeromq.HEARTBEAT_TOPIC, json.dumps(heartbeat)])
+                receive()
+            self.assertEqual(subscriber.codec.name, 'zlib')
+            received = []
+            while not received and time.time() < deadline:
+                publish(1)
+                received = [msg for msg in receive() if msg['codec'] == 'zlib']
+            publish(2)
+            self.assertEqual(receive(), [{'id': 2, 'codec': 'zlib'}])
+        finally:
+            subscriber.sock.close()
+            publisher.close()
+
+    def test_agent_receives_encoded_command(self):
+        agent = self.make_agent()
+        controller = syncer.zeromq.ZMQController('ipc://test_ctl2', 'ipc://test_status', 'ipc://test_command', ['zlib', 'json'])
+        deadline = time.time() + 5
+        while not agent.sub.poll(50) and time.time() < deadline:
+            controller.queue_exec_syncer({'command': 'noop'})
+        self.assertEqual(agent.recv_command(), {'command': 'noop'})
+
+    def test_subscriber_topic_filter(self):
+        publisher = zmq.Context.instance().socket(zmq.PUB)
+        publisher.bind('ipc://test_topic')
+        subscriber = syncer.zeromq.ZMQSubscriber('ipc://test_topic', 30, 30, ['arome25'])
+        try:
+            # Wait for the subscription to be established
+            deadline = time.time() + 5
+            msg = None
+            while msg is None and time.time() < deadline:
+                publisher.send_multipart([syncer.zeromq.make_topic('model_run', 'arome25'), json.dumps({'id': 0})])
+                time.sleep(0.01)
+                msg = subscriber.recv()
+            while subscriber.recv() is not None:
+                pass
+            publisher.send_multipart([syncer.zeromq.make_topic('model_run', 'arome2500'), json.dumps({'id': 1})])
+            publisher.send_multipart([syncer.zeromq.make_topic('data', 'ec'), json.dumps({'id': 2})])
+            publisher.send_multipart([syncer.zeromq.make_topic('data', 'arome25'), json.dumps({'id': 3})])
+            publisher.send_json({'id': 4})
+            received = []
+            while len(received) < 2 and time.time() < deadline:
+                msg = subscriber.recv()
+                if msg is None:
+                    time.sleep(0.01)
+                else:
+                    received += [msg['id']]
+            self.assertEqual(received, [3, 4])
+            time.sleep(0.05)
+            self.assertIsNone(subscriber.recv())
+        finally:
+            subscriber.sock.close()
+            publisher.close()
+
+    def test_ingress_batch_size(self):
+        ingress = syncer.zeromq.ZMQIngress(None, None, 10)
+        for index in range(5):
+            ingress.put(syncer.zeromq.INGRESS_EVENT, {'id': index})
+        self.assertEqual(len(ingress.get_batch(0, 3)), 3)
+        self.assertEqual(ingress.depth(), 2)
+        self.assertEqual(len(ingress.get_batch(0, 3)), 2)
+        self.assertEqual(ingress.get_batch(0), [])
+
+    def test_ingress_overflow(self):
+        metrics = syncer.metrics.Metrics()
+        ingress = syncer.zeromq.ZMQIngress(None, None, 2, metrics)
+        for index in range(3):
+            ingress.put(syncer.zeromq.INGRESS_EVENT, {'id': index})
+        self.assertEqual(ingress.dropped, 1)
+        self.assertEqual(metrics.get('zmq_ingress_dropped'), 1)
+        self.assertEqual(metrics.get('zmq_ingress_received'), 2)
+        self.assertTrue(ingress.take_overflow())
+        self.assertFalse(ingress.take_overflow())
+
+    def make_status(self, **kwargs):
+        model = {'data_provider': 'arome', 'wdb_updated': None, 'version': 1}
+        model.update(kwargs)
+        return {'models': [model, {'data_provider': 'ecmwf', 'version': 1}], 'metrics': {'counters': {}}}
+
+    def make_agent(self):
+        return syncer.zeromq.ZMQAgent('ipc://test_status', 'ipc://test_command')
+
+    def test_status_delta(self):
+        agent = self.make_agent()
+        message = agent.make_status_message(self.make_status())
+        self.assertEqual(message['type'], syncer.zeromq.STATUS_SNAPSHOT)
+        agent.resync = False
+        message = agent.make_status_message(self.make_status())
+        self.assertEqual(message['type'], syncer.zeromq.STATUS_DELTA)
+        self.assertEqual(message['models'], {})
+        message = agent.make_status_message(self.make_status(version=2))
+        self.assertEqual(message['models'], {'arome': {'version': 2, 'changes': {'version': 2}}})
+
+    def test_status_rebuild_from_deltas(self):
+        agent = self.make_agent()
+        requests = []
+        self.controller.queue_exec_syncer = lambda command: requests.append(command)
+        for version in range(1, 4):
+            self.controller.apply_status(agent.make_status_message(self.make_status(version=version)))
+            agent.resync = False
+        self.assertEqual(self.controller.status['models'], self.make_status(version=3)['models'])
+        self.assertEqual(self.controller.status['metrics'], {'counters': {}})
+        self.assertEqual(requests, [])
+
+    def test_status_gap_requests_resync(self):
+        agent = self.make_agent()
+        requests = []
+        self.controller.queue_exec_syncer = lambda command: requests.append(command)
+        self.controller.apply_status(agent.make_status_message(self.make_status()))
+        agent.resync = False
+        agent.make_status_message(self.make_status(version=2))
+        self.controller.apply_status(agent.make_status_message(self.make_status(version=3)))
+        self.assertEqual(requests, [{'command': 'resync'}])
+        self.assertEqual(self.controller.status['models'], self.make_status()['models'])
+
+        # Repeated gaps do not flood the agent with requests
+        self.controller.apply_status(agent.make_status_message(self.make_status(version=4)))
+        self.assertEqual(len(requests), 1)
+
+        agent.request_resync()
+        self.controller.apply_status(agent.make_status_message(self.make_status(version=4)))
+        self.assertEqual(self.controller.status['models'], self.make_status(version=4)['models'])
+
+    def test_metrics_heartbeat_age(self):
+        agent = self.make_agent()
+        status = self.make_status()
+        self.controller.apply_status(agent.make_status_message(status))
+        self.assertNotIn('gauges', self.controller.run_metrics()['data'])
+        status['publisher'] = {'epoch': 1.0, 'last_heartbeat': time.time() - 12.5}
+        self.controller.apply_status(agent.make_status_message(status))
+        self.assertEqual(self.controller.run_metrics()['data']['gauges'], {'zmq_heartbeat_age': 12})
+
+    def test_status_new_epoch_requests_resync(self):
+        requests = []
+        self.controller.queue_exec_syncer = lambda command: requests.append(command)
+        agent = self.make_agent()
+        agent.resync = False
+        self.controller.apply_status(agent.make_status_message(self.make_status()))
+        self.assertEqual(requests, [{'command': 'resync'}])
+        self.assertEqual(self.controller.status['models'], [])
+
+    def test_sync_status_does_not_block(self):
+        agent = self.make_agent()
+        start = time.time()
+        agent.sync_status(self.make_status())
+        self.assertLess(time.time() - start, 1)
+        self.assertTrue(agent.resync)
+
+    def test_sync_status_to_controller(self):
+        agent = self.make_agent()
+        controller = syncer.zeromq.ZMQController('ipc://test_ctl2', 'ipc://test_status', 'ipc://test_command')
+        deadline = time.time() + 5
+        agent.sync_status(self.make_status())
+        while agent.resync and time.time() < deadline:
+            time.sleep(0.05)
+            agent.sync_status(self.make_status())
+        agent.sync_status(self.make_status(version=2))
+        for index in range(2):
+            self.assertTrue(controller.pull.poll(5000))
+            controller.apply_status(controller.recv_status())
+        self.assertEqual(controller.status['models'], self.make_status(version=2)['models'])
+
 
 if __name__ == '__main__':
     unittest.main()
@@ -0,0 +1,184 @@
+"""
+WDB2TS cache warm-up.
+
+Right after a WDB2TS service has been switched to a new model run, its caches
+are cold, and the first user requests see large latency spikes. The cache
+warmer replays a list of representative queries against the updated services,
+either from a configured list or sampled from the most frequent requests in a
+WDB2TS access log.
+
+Queries are paths relative to the WDB2TS base URL, starting with the service
+name, e.g. `aromeecepsforecast?lat=59.91;lon=10.75`.
+"""
+
+import os
+import re
+import time
+import logging
+import requests
+import requests.adapters
+import multiprocessing.pool
+
+# Default number of simultaneous warm-up requests
+DEFAULT_CONCURRENCY = 4
+
+# Default number of seconds to wait for a response to a warm-up request
+DEFAULT_TIMEOUT = 60
+
+# Default number of queries sampled from an access log
+DEFAULT_SAMPLE_SIZE = 100
+
+# Only the end of the access log is read, this many bytes
+ACCESS_LOG_TAIL_BYTES = 10 * 1024 * 1024
+
+# Request path of a GET request in Common or Combined Log Format
+ACCESS_LOG_PATTERN = re.compile(r'"GET (\S+) HTTP/[\d.]+"')
+
+
+def read_queries_file(path):
+    """
+    Return the list of queries in a file, one per line. Blank lines and lines
+    starting with a hash are ignored.
+    """
+    with open(path) as f:
+        lines = [line.strip() for line in f]
+    return [line for line in lines if line and not line.startswith('#')]
+
+
+def sample_access_log(path, sample_size, tail_bytes=ACCESS_LOG_TAIL_BYTES):
+    """
+    Return the `sample_size` most frequent WDB2TS queries found at the end of
+    an access log. Status and update requests are skipped.
+    """
+    counts = {}
+    with open(path) as f:
+        f.seek(0, os.SEEK_END)
+        size = f.tell()
+        f.seek(max(0, size - tail_bytes))
+        if size > tail_bytes:
+            f.readline()
+        for line in f:
+            match = ACCESS_LOG_PATTERN.search(line)
+            if not match:
+                continue
+            query = match.group(1).rsplit('/', 1)[-1]
+            service = query.split('?', 1)[0]
+            if '?' not in query or query.endswith('?status') or service.endswith('update'):
+                continue
+            counts[query] = counts.get(query, 0) + 1
+
+    ranked = sorted(counts.iteritems(), key=lambda x: (-x[1], x[0]))
+    return [item[0] for item in ranked[:sample_size]]
+
+
+class WarmupResult(object):
+    """
+    Timing and outcome of a single warm-up request.
+    """
+
+    def __init__(self, url, duration, error=None):
+        self.url = url
+        self.duration = duration
+        self.error = error
+
+    def success(self):
+        return self.error is None
+
+    def __repr__(self):
+        if self.success():
+            return "%s completed in %.2fs" % (self.url, self.duration)
+        return "%s failed after %.2fs: %s" % (self.url, self.duration, self.error)
+
+
+class CacheWarmer(object):
+    """
+    Replays queries against updated WDB2TS services, with at most
+    `concurrency` requests at the same time. Queries are either a fixed list,
+    or sampled from an access log every time the cache is warmed.
+    """
+
+    def __init__(self, queries=None, access_log=None, sample_size=DEFAULT_SAMPLE_SIZE,
+                 concurrency=DEFAULT_CONCURRENCY, timeout=DEFAULT_TIMEOUT, metrics=None):
+        self.queries = queries or []
+        self.access_log = access_log
+        self.sample_size = sample_size
+        self.concurrency = max(1, concurrency)
+        self.timeout = timeout
+        self.metrics = metrics
+        self.session = requests.Session()
+        adapter = requests.adapters.HTTPAdapter(pool_maxsize=self.concurrency)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+
+    def get_queries(self):
+        """
+        Return the list of queries to replay.
+        """
+        if self.access_log is None:
+            return self.queries
+        try:
+            return sample_access_log(self.access_log, self.sample_size)
+        except IOError, e:
+            logging.error("Could not read WDB2TS access log: %s" % unicode(e))
+            return self.queries
+
+    def get_urls(self, targets):
+        """
+        Return the URLs to request for a list of (base URL, services) tuples.
+        Only queries against the given services are included.
+        """
+        queries = self.get_queries()
+        urls = []
+        for base_url, services in targets:
+            for query in queries:
+                if query.split('?', 1)[0] in services:
+                    urls += ["%s/%s" % (base_url, query)]
+        return urls
+
+    def request(self, url):
+        """
+        Request a single URL, and return a WarmupResult.
+        """
+        start = time.time()
+        error = None
+        try:
+            response = self.session.get(url, timeout=self.timeout)
+            if response.status_code >= 400:
+                error = "HTTP status code %d" % response.status_code
+        except requests.RequestException, e:
+            error = unicode(e)
+        result = WarmupResult(url, time.time() - start, error)
+        if self.metrics is not None:
+            self.metrics.add_timing('wdb2ts_warmup_request', result.duration)
+            if error is not None:
+                self.metrics.increment('wdb2ts_warmup_failures')
+        return result
+
+    def warm(self, targets):
+        """
+        Warm the caches of a list of (base URL, services) tuples. Returns a
+        list of WarmupResult objects.
+        """
+        urls = self.get_urls(targets)
+        if not urls:
+            return []
+
+        start = time.time()
+        pool = multiprocessing.pool.ThreadPool(min(self.concurrency, len(urls)))
+        try:
+            results = pool.map(self.request, urls)
+        finally:
+            pool.close()
+            pool.join()
+        elapsed = time.time() - start
+
+        failed = [result for result in results if not result.success()]
+        if self.metrics is not None:
+            self.metrics.add_timing('wdb2ts_warmup', elapsed)
+        logging.info("Warmed WDB2TS caches with %d requests in %.2fs, %d failed." % (len(results), elapsed, len(failed)))
+        for result in failed:
+            logging.warning("WDB2TS warm-up request failed: %s" % result)
+        return results
+
+    def __repr__(self):
+        return "CacheWarmer"
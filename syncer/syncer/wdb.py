@@ -2,9 +2,17 @@
 Functionality relating to WDB2.
 """
 
+import os
 import re
+import time
+import shutil
+import signal
+import tempfile
+import threading
 import subprocess
+import collections
 import logging
+import multiprocessing.pool
 
 import syncer.exceptions
 
@@ -41,59 +49,433 @@ EXIT_CONFIG = 31
 # One or more fields failed to load, but some may have loaded successfully
 EXIT_FIELDS = 100
 
+# The load program was killed by `timeout` on the WDB host
+EXIT_TIMEOUT = 124
+
+# Seconds between asking a timed out process to terminate and killing it
+KILL_GRACE_PERIOD = 10
+
+# Seconds added to the load timeout before the local SSH process is killed,
+# giving `timeout` on the WDB host a chance to kill the load program first
+LOCAL_TIMEOUT_MARGIN = KILL_GRACE_PERIOD + 5
+
+# How many of the most recent lines of STDOUT and STDERR output to keep from
+# each command, and the maximum length of a single line
+OUTPUT_LINES = 200
+OUTPUT_LINE_LENGTH = 4096
+
+# Summary lines printed by load programs, and the counters they are parsed into
+SUMMARY_PATTERNS = [
+    ('fields_loaded', re.compile(r'(?:(\d+) fields? (?:were )?loaded|loaded (\d+) fields?)', re.IGNORECASE)),
+    ('fields_duplicate', re.compile(r'(\d+) duplicates?', re.IGNORECASE)),
+]
+
+
+class OutputCapture(object):
+    """
+    Reads the output of a command line by line as it is produced, keeping
+    only the most recent lines and counters parsed from summary lines, so
+    that memory use is bounded regardless of how much output there is.
+    """
+
+    def __init__(self, max_lines=OUTPUT_LINES):
+        self.lines = collections.deque(maxlen=max_lines)
+        self.counters = {}
+        self.total_lines = 0
+
+    def feed(self, line):
+        """
+        Process a single line of output.
+        """
+        line = line.rstrip('\n')
+        self.lines.append(line)
+        self.total_lines += 1
+        for name, pattern in SUMMARY_PATTERNS:
+            match = pattern.search(line)
+            if match:
+                value = [x for x in match.groups() if x is not None][0]
+                self.counters[name] = self.counters.get(name, 0) + int(value)
+
+    def read(self, pipe):
+        """
+        Process all output from a pipe until it is closed.
+        """
+        for line in iter(lambda: pipe.readline(OUTPUT_LINE_LENGTH), ''):
+            self.feed(line)
+        pipe.close()
+
+    def text(self):
+        """
+        Return the kept lines of output.
+        """
+        return '\n'.join(self.lines)
+
+
+class CommandResult(object):
+    """
+    Exit code, most recent output, and summary counters of a command.
+    """
+
+    def __init__(self, exit_code, stderr, stdout, counters):
+        self.exit_code = exit_code
+        self.stderr = stderr
+        self.stdout = stdout
+        self.counters = counters
+
+
+class WDBLoadResult(object):
+    """
+    Outcome of loading a single model file into WDB.
+    """
+
+    def __init__(self, modelfile, duration, error=None, counters=None):
+        self.modelfile = modelfile
+        self.duration = duration
+        self.error = error
+        self.counters = counters or {}
+
+    def success(self):
+        return self.error is None
+
+    def __repr__(self):
+        if self.success():
+            return "%s loaded in %.2fs" % (self.modelfile, self.duration)
+        return "%s failed after %.2fs: %s" % (self.modelfile, self.duration, self.error)
+
+
+class SSHConnectionPool(object):
+    """
+    Maintains a small number of persistent, multiplexed OpenSSH master
+    connections to a host, and runs commands over them. This saves a full SSH
+    handshake for every command.
+
+    If a master connection dies, it is re-established the next time it is
+    used. If it can not be re-established, commands are run over a new SSH
+    connection, just as without the pool.
+
+    The control sockets are placed in `control_dir`, or else in a private
+    directory created for this pool, which is removed when the pool is closed.
+    """
+
+    # How long to wait before trying to re-establish a failed master connection, in seconds
+    RECONNECT_INTERVAL = 60
+
+    def __init__(self, host, user, size, control_dir=None, persist=600):
+        self.host = host
+        self.user = user
+        self.persist = persist
+        self.private_dir = None
+        if not control_dir:
+            control_dir = self.private_dir = tempfile.mkdtemp(prefix='syncer-ssh-')
+        self.control_paths = [os.path.join(control_dir, 'syncer-ssh-%d-%d' % (os.getpid(), n)) for n in range(size)]
+        self.locks = dict([(path, threading.Lock()) for path in self.control_paths])
+        self.failed = dict.fromkeys(self.control_paths, 0)
+        self.index = 0
+        self.index_lock = threading.Lock()
+
+    def get_target(self):
+        return "{0}@{1}".format(self.user, self.host)
+
+    def _run(self, cmd):
+        """
+        Run an SSH control command, and return True if it succeeded.
+        """
+        try:
+            with open(os.devnull, 'w') as devnull:
+                return subprocess.call(cmd, stdin=devnull, stdout=devnull, stderr=devnull) == 0
+        except OSError, e:
+            logging.error("Could not execute SSH: %s" % e)
+            return False
+
+    def is_alive(self, control_path):
+        """
+        Returns True if the master connection behind `control_path` is running.
+        """
+        if not os.path.exists(control_path):
+            return False
+        return self._run(['ssh', '-S', control_path, '-O', 'check', self.get_target()])
+
+    def connect(self, control_path):
+        """
+        Start a master connection in the background, listening on `control_path`.
+        Returns True if the connection was established.
+        """
+        logging.info("Establishing persistent SSH connection to %s on %s" % (self.get_target(), control_path))
+        return self._run(['ssh', '-M', '-S', control_path, '-f', '-N',
+                          '-o', 'BatchMode=yes',
+                          '-o', 'ControlPersist=%d' % self.persist,
+                          self.get_target()])
+
+    def next_control_path(self):
+        """
+        Return the next control path in round-robin order.
+        """
+        with self.index_lock:
+            control_path = self.control_paths[self.index]
+            self.index = (self.index + 1) % len(self.control_paths)
+        return control_path
+
+    def get_control_path(self):
+        """
+        Return the control path of a running master connection, or None if
+        no master connection could be established.
+        """
+        control_path = self.next_control_path()
+        with self.locks[control_path]:
+            if self.is_alive(control_path):
+                return control_path
+            if time.time() - self.failed[control_path] < self.RECONNECT_INTERVAL:
+                return None
+            if self.connect(control_path):
+                self.failed[control_path] = 0
+                return control_path
+            logging.warning("Could not establish persistent SSH connection to %s, falling back to one connection per command." % self.get_target())
+            self.failed[control_path] = time.time()
+        return None
+
+    def create_ssh_command(self, cmd):
+        """
+        Return an SSH command that runs `cmd` over a master connection, or
+        over a new connection if no master connection is available.
+        """
+        control_path = self.get_control_path()
+        if control_path is None:
+            return ["ssh", self.get_target()] + cmd
+        return ["ssh", "-S", control_path, "-o", "ControlMaster=no", self.get_target()] + cmd
+
+    def close(self):
+        """
+        Shut down all master connections.
+        """
+        for control_path in self.control_paths:
+            if os.path.exists(control_path):
+                self._run(['ssh', '-S', control_path, '-O', 'exit', self.get_target()])
+        if self.private_dir:
+            shutil.rmtree(self.private_dir, True)
+
 
 class WDB(object):
 
-    def __init__(self, host, user):
+    def __init__(self, host, user, ssh_pool=None, agent=None, database=None, load_timeout=0, metrics=None):
         self.host = host
         self.user = user
+        self.ssh_pool = ssh_pool
+        self.agent = agent
+        self.database = database
+        self.load_timeout = load_timeout
+        self.metrics = metrics
+
+    def get_load_timeout(self, model):
+        """
+        Return the maximum number of seconds a single load program may run for
+        the specified model, as configured by the model's `load_timeout`
+        option, or the global one if unset. Zero means no limit.
+        """
+        return int(getattr(model, 'load_timeout', self.load_timeout))
+
+    def count(self, name, value=1):
+        """
+        Increment a counter in the daemon metrics, if available.
+        """
+        if self.metrics is not None:
+            self.metrics.increment(name, value)
+
+    @staticmethod
+    def get_load_concurrency(model):
+        """
+        Return the number of files that may be loaded simultaneously for the
+        specified model, as configured by the `load_concurrency` option.
+        """
+        return max(1, int(getattr(model, 'load_concurrency', 1)))
 
     def load_model_run(self, model, model_run):
         """Load into wdb all relevant data from a model_run."""
 
-        loaded = 0
         logging.info("Starting loading to WDB: %s" % model_run)
 
+        modelfiles = []
         dataset = model.get_matching_data(model_run.data)
 
         for data in dataset:
             logging.info("Data URI '%s' matches regular expression '%s'" % (data.href, model.data_uri_pattern))
-            modelfile = WDB.convert_opdata_uri_to_file(data.href)
-            self.load_modelfile(model, model_run, modelfile)
-            loaded += 1
+            modelfiles += [WDB.convert_opdata_uri_to_file(data.href)]
 
-        if loaded:
-            logging.info("Successfully finished loading %d files to WDB." % loaded)
-        else:
+        if not modelfiles:
             logging.warn("No files were loaded into WDB.")
+            return []
+
+        loaded = model.get_loaded_files(model_run)
+        if loaded:
+            modelfiles = [modelfile for modelfile in modelfiles if modelfile not in loaded]
+            logging.info("Skipping %d files that were already loaded into WDB, %d files remaining." % (len(loaded), len(modelfiles)))
+            if not modelfiles:
+                return []
+
+        concurrency = min(WDB.get_load_concurrency(model), len(modelfiles))
+        start = time.time()
+        results = []
+
+        # The place definition is loaded under a known place name together
+        # with the first file only, before any other files are loaded using
+        # that name. If this fails, the remaining files are loaded exactly as
+        # without a known place name.
+        if model.needs_place_definition():
+            logging.info("Loading place definition '%s' from %s" % (model.get_place_name(), modelfiles[0]))
+            results = self.load_modelfiles(model, model_run, modelfiles[:1], 1, True)
+            if results[0].success():
+                model.set_place_definition_loaded()
+
+        results += self.load_modelfiles(model, model_run, modelfiles[len(results):], concurrency)
+        elapsed = time.time() - start
+        model.set_load_results(model_run, results)
+
+        failed = [result for result in results if not result.success()]
+
+        # Files may have failed because the place definition is missing, for
+        # instance if WDB was rebuilt, so it is loaded again on the next try.
+        if failed:
+            model.reset_place_definition()
+
+        timeouts = [result for result in failed if isinstance(result.error, syncer.exceptions.WDBLoadTimeout)]
+        self.count('wdb_files_loaded', len(results) - len(failed))
+        self.count('wdb_files_failed', len(failed))
+        self.count('wdb_load_timeouts', len(timeouts))
+
+        counters = {}
+        for result in results:
+            for name, value in result.counters.iteritems():
+                counters[name] = counters.get(name, 0) + value
+        for name, value in sorted(counters.iteritems()):
+            logging.info("Load programs reported %s=%d" % (name, value))
+            self.count('wdb_' + name, value)
+        total = sum([result.duration for result in results])
+        logging.info("Loaded %d of %d files to WDB in %.2fs wall clock time, %.2fs total load time, concurrency=%d." %
+                     (len(results) - len(failed), len(results), elapsed, total, concurrency))
+
+        if failed:
+            for result in failed:
+                logging.error("WDB load failed: %s" % result)
+            exception = syncer.exceptions.WDBLoadTimeout if timeouts else syncer.exceptions.WDBLoadFailed
+            raise exception("%d of %d files failed to load into WDB, %d timed out, first error: %s" %
+                            (len(failed), len(results), len(timeouts), failed[0].error))
+
+        logging.info("Successfully finished loading %d files to WDB." % len(results))
+        return results
+
+    def load_modelfiles(self, model, model_run, modelfiles, concurrency, load_place_definition=False):
+        """
+        Load a list of model files into WDB, running at most `concurrency`
+        load programs at the same time. If `load_place_definition` is True,
+        the place definition is loaded under the model's place name. Returns
+        a list of WDBLoadResult objects in the same order as `modelfiles`.
+        """
+        if not modelfiles:
+            return []
+
+        if self.agent is not None:
+            return self.load_modelfiles_agent(model, model_run, modelfiles, concurrency, load_place_definition)
+
+        def func(modelfile):
+            return self.load_modelfile_result(model, model_run, modelfile, load_place_definition)
+
+        if concurrency <= 1:
+            return [func(modelfile) for modelfile in modelfiles]
+
+        # Load programs run as subprocesses, so threads are sufficient here
+        pool = multiprocessing.pool.ThreadPool(concurrency)
+        try:
+            return pool.map(func, modelfiles)
+        finally:
+            pool.close()
+            pool.join()
+
+    def load_modelfiles_agent(self, model, model_run, modelfiles, concurrency, load_place_definition=False):
+        """
+        Load a list of model files into WDB through the load agent running on
+        the WDB host. Returns a list of WDBLoadResult objects in the same order
+        as `modelfiles`. The load timeout is enforced by the agent itself, so
+        that it sees the load program rather than `timeout`.
+        """
+        timeout = self.get_load_timeout(model)
+        commands = [WDB.create_load_command(model, model_run, modelfile, load_place_definition) for modelfile in modelfiles]
+
+        def progress(message):
+            logging.info("Load agent reports: %s" % self.load_result_from_agent(message))
+
+        reply = self.agent.load(zip(modelfiles, commands), concurrency, progress, timeout)
+        results = dict([(x['file'], self.load_result_from_agent(x)) for x in reply['results']])
+        return [results[modelfile] for modelfile in modelfiles]
 
-    def load_modelfile(self, model, model_run, modelfile):
-        """Load a modelfile into wdb."""
+    def load_result_from_agent(self, message):
+        """
+        Convert a per-file result from the load agent into a WDBLoadResult.
+        """
+        try:
+            self.check_load_exit_code(message['exit_code'], message['stderr'])
+            error = None
+        except syncer.exceptions.WDBLoadFailed, e:
+            error = e
+        return WDBLoadResult(message['file'], message['duration'], error, message.get('counters'))
+
+    def load_modelfile_result(self, model, model_run, modelfile, load_place_definition=False):
+        """
+        Load a model file into WDB, and return a WDBLoadResult instead of
+        raising an exception if the load fails.
+        """
+        start = time.time()
+        counters = None
+        try:
+            counters = self.load_modelfile(model, model_run, modelfile, load_place_definition)
+            error = None
+        except syncer.exceptions.WDBLoadFailed, e:
+            error = e
+        return WDBLoadResult(modelfile, time.time() - start, error, counters)
+
+    def load_modelfile(self, model, model_run, modelfile, load_place_definition=False):
+        """
+        Load a modelfile into wdb. Returns a dictionary of counters parsed
+        from the summary output of the load program.
+        """
 
         logging.info("Loading file %s" % modelfile)
 
-        load_cmd = WDB.create_load_command(model, model_run, modelfile)
+        timeout = self.get_load_timeout(model)
+        load_cmd = WDB.create_timeout_command(WDB.create_load_command(model, model_run, modelfile, load_place_definition), timeout)
         cmd = self.create_ssh_command(load_cmd)
 
         try:
-            exit_code, stderr, stdout = WDB.execute_command(cmd)
+            result = WDB.run_command(cmd, timeout + LOCAL_TIMEOUT_MARGIN if timeout else None)
         except TypeError, e:
             raise syncer.exceptions.WDBLoadFailed("WDB load failed due to malformed command %s" % e)
 
-        if exit_code != EXIT_SUCCESS:
-            if exit_code == EXIT_FIELDS or exit_code == EXIT_LOAD:
-                logging.error("Failed to load some fields into WDB. This is likely due to duplicate field errors, i.e. loading the same data twice.")
-                logging.warn("STDERR output from WDB suppressed because exit code equals %d" % exit_code)
-            else:
-                lines = self.get_std_lines(stderr)
-                if lines:
-                    logging.warning("WDB load failed with exit code %d, STDERR output follows" % exit_code)
-                    for line in lines:
-                        logging.warning("WDB load error: " + line)
+        self.check_load_exit_code(result.exit_code, result.stderr)
 
-                raise syncer.exceptions.WDBLoadFailed("WDB load failed with exit code %d" % exit_code)
+        logging.info("Loading of %s completed." % modelfile)
+        return result.counters
 
-        logging.info("Loading completed.")
+    def check_load_exit_code(self, exit_code, stderr):
+        """
+        Raise WDBLoadFailed if the exit code of a load program signals an
+        error. Duplicate field errors are logged, but otherwise ignored.
+        """
+        if exit_code == EXIT_SUCCESS:
+            return
+
+        if exit_code == EXIT_TIMEOUT:
+            raise syncer.exceptions.WDBLoadTimeout("WDB load was killed after exceeding the load timeout")
+
+        if exit_code == EXIT_FIELDS or exit_code == EXIT_LOAD:
+            logging.error("Failed to load some fields into WDB. This is likely due to duplicate field errors, i.e. loading the same data twice.")
+            logging.warn("STDERR output from WDB suppressed because exit code equals %d" % exit_code)
+            return
+
+        lines = self.get_std_lines(stderr)
+        if lines:
+            logging.warning("WDB load failed with exit code %d, STDERR output follows" % exit_code)
+            for line in lines:
+                logging.warning("WDB load error: " + line)
+
+        raise syncer.exceptions.WDBLoadFailed("WDB load failed with exit code %d" % exit_code)
 
     def get_std_lines(self, std):
         """
@@ -102,23 +484,108 @@ class WDB(object):
         return std.splitlines() if std is not None else []
 
     @staticmethod
-    def execute_command(cmd):
+    def execute_command(cmd, timeout=None):
         """Executes a shell command.
 
         cmd: A command represented by a list of arguments.
+        timeout: If set, the command and all its child processes are killed
+        after this many seconds, and WDBLoadTimeout is raised.
         Returns three values: exit_code(int), stderr(string) and stdout(string).
+        Only the last OUTPUT_LINES lines of output are returned.
+        """
+        result = WDB.run_command(cmd, timeout)
+        return result.exit_code, result.stderr, result.stdout
+
+    @staticmethod
+    def run_command(cmd, timeout=None):
+        """
+        Executes a shell command like execute_command, but returns a
+        CommandResult which also contains counters parsed from summary lines.
+        Output is read from both pipes while the command is running.
         """
+        if isinstance(cmd, basestring):
+            cmd = [cmd]
         logging.debug("Executing: %s" % ' '.join(cmd))
-        process = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
 
-        stdout, stderr = process.communicate()
-        exit_code = process.returncode
+        # The command runs in its own process group, so that it can be killed
+        # together with any processes it has started. setsid(1) is used
+        # instead of preexec_fn, which is not safe in threaded programs.
+        process = subprocess.Popen(['setsid', '--wait'] + cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+
+        timer = None
+        expired = threading.Event()
+        if timeout:
+            def kill():
+                expired.set()
+                logging.warning("Killing process group of %s after %d seconds" % (cmd[0], timeout))
+                WDB.kill_process_group(process)
+            timer = threading.Timer(timeout, kill)
+            timer.daemon = True
+            timer.start()
+
+        stdout = OutputCapture()
+        stderr = OutputCapture()
+        reader = threading.Thread(target=stderr.read, args=(process.stderr,))
+        reader.daemon = True
+        reader.start()
+
+        try:
+            stdout.read(process.stdout)
+            reader.join()
+            exit_code = process.wait()
+        finally:
+            if timer is not None:
+                timer.cancel()
+
+        if expired.is_set():
+            raise syncer.exceptions.WDBLoadTimeout("Command killed after exceeding timeout of %d seconds" % timeout)
+
+        counters = dict(stdout.counters)
+        for name, value in stderr.counters.iteritems():
+            counters[name] = counters.get(name, 0) + value
+
+        return CommandResult(exit_code, stderr.text(), stdout.text(), counters)
+
+    @staticmethod
+    def kill_process_group(process):
+        """
+        Terminate the process group of a running process, and kill it if it
+        has not exited within KILL_GRACE_PERIOD seconds.
+        """
+        for sig in [signal.SIGTERM, signal.SIGKILL]:
+            if process.returncode is not None:
+                return
+            try:
+                os.killpg(process.pid, sig)
+            except OSError:
+                return
+            # The process is reaped by the thread waiting for it to exit
+            deadline = time.time() + KILL_GRACE_PERIOD
+            while process.returncode is None and time.time() < deadline:
+                time.sleep(0.1)
 
-        return exit_code, stderr, stdout
+    @staticmethod
+    def create_timeout_command(cmd, timeout):
+        """
+        Wrap a command in `timeout`, which kills it together with all its
+        child processes if it runs for more than `timeout` seconds. Returns
+        the command unchanged if `timeout` is zero.
+        """
+        if not timeout:
+            return cmd
+        return ['timeout', '--kill-after=%d' % KILL_GRACE_PERIOD, '%d' % timeout] + cmd
 
     @staticmethod
-    def create_load_command(model, model_run, model_file):
-        """Generate a wdb load command for a specific model configuration and model run, based on info from config."""
+    def create_load_command(model, model_run, model_file, load_place_definition=False):
+        """
+        Generate a wdb load command for a specific model configuration and
+        model run, based on info from config. If `load_place_definition` is
+        True, the place definition of the model's grid is loaded under the
+        model's place name. Otherwise, the place name is only used once its
+        place definition is known to be loaded; until then, the place
+        definition is loaded with every file, under the name chosen by the
+        load program.
+        """
 
         cmd = [model.load_program, '--dataprovider', "'%s'" % model.data_provider]
 
@@ -127,8 +594,12 @@ class WDB(object):
 
         if hasattr(model, 'place_name'):
             cmd.extend(["--placename", model.place_name])
-        else:
+        elif load_place_definition:
+            cmd.extend(["--loadPlaceDefinition", "--placename", "'%s'" % model.get_place_name()])
+        elif model.needs_place_definition():
             cmd.extend(["--loadPlaceDefinition"])
+        else:
+            cmd.extend(["--placename", "'%s'" % model.get_place_name()])
 
         version = model.get_model_run_version(model_run)
         cmd.extend(["--dataversion", unicode(version)])
@@ -138,6 +609,8 @@ class WDB(object):
         return cmd
 
     def create_ssh_command(self, cmd):
+        if self.ssh_pool is not None:
+            return self.ssh_pool.create_ssh_command(cmd)
         return ["ssh", "{0}@{1}".format(self.user, self.host)] + cmd
 
     @staticmethod
@@ -154,50 +627,140 @@ class WDB(object):
         return data_file_path
 
     @staticmethod
-    def create_cache_query(model_run):
+    def create_begin_query():
+        return "SELECT wci.begin('wdb')"
+
+    @staticmethod
+    def create_cache_only_query(model_run):
         """
-        Generate a SQL/WCI query that caches a specific model run.
+        Generate a WCI query that caches a specific model run, without
+        initializing the WCI session.
         """
         # SQL injection attacks would have to be configured in the
         # configuration file, as data_provider to the model in question.
         # Modelstatus would likely not contain information about such a model,
         # making it extremely unlikely that any malicious code could run here.
-        return "SELECT wci.begin('wdb'); SELECT wci.cacheQuery(array['%(data_provider)s'], NULL, 'exact %(reference_time)s', NULL, NULL, NULL, array[-1])" % {
+        return "SELECT wci.cacheQuery(array['%(data_provider)s'], NULL, 'exact %(reference_time)s', NULL, NULL, NULL, array[-1])" % {
             'data_provider': model_run.data_provider,
             'reference_time': model_run.serialize_reference_time(model_run.reference_time),
         }
 
+    @staticmethod
+    def create_cache_query(model_run):
+        """
+        Generate a SQL/WCI query that caches a specific model run.
+        """
+        return "%s; %s" % (WDB.create_begin_query(), WDB.create_cache_only_query(model_run))
+
     @staticmethod
     def create_analyze_query():
         return 'ANALYZE'
 
-    def create_cache_model_run_command(self, model_run):
+    @staticmethod
+    def create_analyze_statements(tables):
+        """
+        Return a list of SQL statements that analyzes the specified tables, or
+        the entire database if no tables are specified.
+        """
+        if not tables:
+            return [WDB.create_analyze_query()]
+        return ["%s %s" % (WDB.create_analyze_query(), table) for table in tables]
+
+    @staticmethod
+    def create_psql_command(statements):
         """
-        Create an SSH command that runs cacheQuery and ANALYZE against the WDB
-        server for the specified model run.
+        Create a psql command that runs a list of SQL statements. The command
+        is meant to be run by a shell.
         """
-        cache_query = WDB.create_cache_query(model_run)
-        analyze_query = WDB.create_analyze_query()
-        return self.create_ssh_command(['psql', '-c', "\"%s; %s;\"" % (cache_query, analyze_query)])
+        return ['psql', '-c', "\"%s;\"" % '; '.join(statements)]
 
-    def cache_model_run(self, model_run):
+    @staticmethod
+    def create_cache_statements(model_run, analyze=True):
         """
-        Run cacheQuery and ANALYZE against the WDB server for the specified model run.
+        Return the list of SQL statements that caches the specified model run,
+        optionally followed by a database-wide ANALYZE.
         """
-        logging.info("Updating WDB cache for %s" % model_run)
+        statements = [WDB.create_begin_query(), WDB.create_cache_only_query(model_run)]
+        if analyze:
+            statements += [WDB.create_analyze_query()]
+        return statements
+
+    @staticmethod
+    def create_cache_command(model_run, analyze=True):
+        """
+        Create a psql command that runs cacheQuery and optionally ANALYZE for
+        the specified model run. The command is meant to be run by a shell.
+        """
+        return WDB.create_psql_command(WDB.create_cache_statements(model_run, analyze))
+
+    def create_cache_model_run_command(self, model_run, analyze=True):
+        """
+        Create an SSH command that runs cacheQuery and optionally ANALYZE
+        against the WDB server for the specified model run.
+        """
+        return self.create_ssh_command(WDB.create_cache_command(model_run, analyze))
+
+    def execute_statements_database(self, statements, description, exception):
+        """
+        Run SQL statements directly against the WDB database. Returns a list of
+        StatementResult objects.
+        """
+        try:
+            results = self.database.execute(statements)
+        except syncer.exceptions.WDBDatabaseConnectionFailed, e:
+            raise exception("Could not connect to WDB database: %s" % unicode(e))
+
+        for result in results:
+            logging.info("%s statement %s" % (description, result))
+
+        if results and not results[-1].success():
+            raise exception("%s failed: %s" % (description, results[-1]))
+
+        logging.info("%s completed successfully in %.2fs." % (description, sum([result.duration for result in results])))
+        return results
+
+    def execute_statements(self, statements, description, exception):
+        """
+        Run SQL statements against the WDB server, either directly against the
+        database, through the load agent, or with psql over SSH. Raises
+        `exception` if any of the statements fail.
+        """
+        if self.database is not None:
+            return self.execute_statements_database(statements, description, exception)
 
-        cmd = self.create_cache_model_run_command(model_run)
-        exit_code, stderr, stdout = WDB.execute_command(cmd)
+        cmd = WDB.create_psql_command(statements)
+        if self.agent is not None:
+            exit_code, stderr, stdout = self.agent.cache(cmd)
+        else:
+            exit_code, stderr, stdout = WDB.execute_command(self.create_ssh_command(cmd))
 
         if exit_code == 0:
-            logging.info("Cache updated successfully.")
+            logging.info("%s completed successfully." % description)
             return
 
-        logging.error("Cache update failed with exit status %d" % exit_code)
+        logging.error("%s failed with exit status %d" % (description, exit_code))
 
         for output in stdout, stderr:
-            lines = self.get_std_lines(stdout)
+            lines = self.get_std_lines(output)
             if lines:
                 [logging.debug(line) for line in lines]
 
-        raise syncer.exceptions.WDBCacheFailed("Cache update failed with exit status %d" % exit_code)
+        raise exception("%s failed with exit status %d" % (description, exit_code))
+
+    def cache_model_run(self, model_run, analyze=True):
+        """
+        Run cacheQuery and optionally ANALYZE against the WDB server for the
+        specified model run.
+        """
+        logging.info("Updating WDB cache for %s" % model_run)
+        statements = WDB.create_cache_statements(model_run, analyze)
+        return self.execute_statements(statements, "Cache update", syncer.exceptions.WDBCacheFailed)
+
+    def analyze(self, tables):
+        """
+        Run ANALYZE on the specified tables, or on the entire database if no
+        tables are specified.
+        """
+        logging.info("Running ANALYZE on %s" % (', '.join(tables) if tables else 'the entire WDB database'))
+        statements = WDB.create_analyze_statements(tables)
+        return self.execute_statements(statements, "ANALYZE", syncer.exceptions.WDBAnalyzeFailed)
@@ -2,23 +2,90 @@
 Functionality relating to WDB2TS.
 """
 
+import time
 import lxml.etree
 import requests
+import requests.adapters
 import logging
+import multiprocessing.pool
 
 import syncer.exceptions
 
+# Default number of simultaneous requests to WDB2TS
+DEFAULT_CONCURRENCY = 4
+
+# Default number of seconds to wait for a response from WDB2TS
+DEFAULT_TIMEOUT = 60
+
+# Default number of seconds to reuse status information from WDB2TS
+DEFAULT_STATUS_TTL = 300
+
+# Default number of seconds to wait before requesting status information again
+# from a WDB2TS host after a failed attempt
+DEFAULT_STATUS_BACKOFF = 60
+
+# HTTP status codes of a combined update request which may mean that the
+# service does not accept combined requests
+BATCH_UNSUPPORTED_STATUS_CODES = (400, 404)
+
+# Replies from WDB2TS to an update request
+UPDATE_UPDATED = 'Updated'
+UPDATE_UP_TO_DATE = 'NoNewDataRefTime'
+
 
 class WDB2TS(object):
 
-    def __init__(self, base_url, services):
+    def __init__(self, base_url, services, concurrency=DEFAULT_CONCURRENCY, timeout=DEFAULT_TIMEOUT, status_ttl=DEFAULT_STATUS_TTL, status_backoff=DEFAULT_STATUS_BACKOFF):
         self.base_url = base_url
+        self.concurrency = max(1, concurrency)
+        self.timeout = timeout
+        self.status_ttl = status_ttl
+        self.status_backoff = status_backoff
+        self.status_updated = None
+        self.status_failed = None
+        self.status_error = None
+        self.services_by_provider = {}
+        self.batch_unsupported = set()
+        self.batch_supported = set()
         self.session = requests.Session()
+        adapter = requests.adapters.HTTPAdapter(pool_maxsize=self.concurrency)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
         self.status = dict.fromkeys(services, {})
 
+    def map(self, func, items):
+        """
+        Call `func` for each item in `items`, running at most
+        `self.concurrency` requests at the same time. Returns a list of return
+        values in the same order as `items`. If any of the calls raises a
+        WDB2TSException, the exception of the first failing item is raised
+        after all calls have finished.
+        """
+        if self.concurrency <= 1 or len(items) <= 1:
+            return [func(item) for item in items]
+
+        def call(item):
+            try:
+                return func(item), None
+            except syncer.exceptions.WDB2TSException, e:
+                return None, e
+
+        pool = multiprocessing.pool.ThreadPool(min(self.concurrency, len(items)))
+        try:
+            outcomes = pool.map(call, items)
+        finally:
+            pool.close()
+            pool.join()
+
+        for value, error in outcomes:
+            if error is not None:
+                raise error
+        return [value for value, error in outcomes]
+
     def request_status(self, service):
         """
-        Request WDB2TS host for status for specified service and return xml.
+        Request WDB2TS host for status for specified service, and return the
+        parsed XML document.
         """
         status_url = "%s/%s?status" % (self.base_url, service)
         logging.info("Load status information from WDB2TS service %s: %s" % (service, status_url))
@@ -36,81 +103,299 @@ class WDB2TS(object):
                 raise syncer.exceptions.WDB2TSMissingContentException(
                     "Content from status request %s is missing its /status element." % status_url)
 
-        return status_xml
+        return tree
 
     def _get_request(self, url):
         """
         Wrapper for self.session.get with exception handling. Returns body of response.
         """
         try:
-            response = self.session.get(url)
+            response = self.session.get(url, timeout=self.timeout)
         except requests.ConnectionError, e:
             raise syncer.exceptions.WDB2TSConnectionFailure("Connection to WDB2TS failed: %s" % unicode(e))
+        except requests.Timeout, e:
+            raise syncer.exceptions.WDB2TSConnectionFailure("WDB2TS did not respond within %s seconds: %s" % (self.timeout, unicode(e)))
 
+        message = "WDB2TS returned error code %d for request URI %s" % (response.status_code, response.request.url)
         if response.status_code >= 500:
-            exc = syncer.exceptions.WDB2TSServiceUnavailableException
+            raise syncer.exceptions.WDB2TSServiceUnavailableException(message)
         elif response.status_code >= 400:
-            exc = syncer.exceptions.WDB2TSServiceClientErrorException
-        else:
-            return response.content
+            raise syncer.exceptions.WDB2TSServiceClientErrorException(message, response.status_code)
+
+        return response.content
 
-        raise exc("WDB2TS returned error code %d for request URI %s" % (response.status_code, response.request.url))
+    def status_is_fresh(self):
+        """
+        Returns True if the status information is younger than the status TTL.
+        """
+        if self.status_updated is None:
+            return False
+        return time.time() - self.status_updated < self.status_ttl
+
+    def invalidate_status(self):
+        """
+        Make the next call to load_status fetch new status information.
+        """
+        self.status_updated = None
+        self.status_failed = None
 
-    def load_status(self):
+    def load_status(self, data_providers=()):
         """
-        Set status dict for all defined services.
+        Set status dict for all defined services. Status is requested from
+        all services concurrently. Status information is reused for
+        `status_ttl` seconds, unless any of `data_providers` is not defined in
+        any service. After a failed request, the error is raised again without
+        contacting the host for `status_backoff` seconds. The previous status
+        information is kept until new status information has been loaded.
         """
-        for service in self.status.keys():
-            self.status[service] = {}
-            status_xml = self.request_status(service)
-            self.set_status_for_service(service, status_xml)
+        missing = [x for x in data_providers if x not in self.services_by_provider]
+        if self.status_is_fresh() and not missing:
+            logging.debug("Using WDB2TS status information from %.0f seconds ago" % (time.time() - self.status_updated))
+            return self.status
+        if self.status_failed is not None and time.time() - self.status_failed < self.status_backoff:
+            logging.debug("Not requesting WDB2TS status from %s, the last request failed %.0f seconds ago" % (self.base_url, time.time() - self.status_failed))
+            raise self.status_error
+        if missing and self.status_updated is not None:
+            logging.info("Data providers %s not found in WDB2TS status, refreshing." % ', '.join(missing))
+
+        services = sorted(self.status.keys())
+        try:
+            trees = self.map(self.request_status, services)
+        except syncer.exceptions.WDB2TSException, e:
+            self.status_failed = time.time()
+            self.status_error = e
+            raise
+        self.status_failed = None
+
+        # Replaced instead of updated, since update jobs read the status concurrently
+        status = {}
+        for service, tree in zip(services, trees):
+            status[service] = WDB2TS.make_service_status(service, tree)
+        self.status = status
+        self.services_by_provider = WDB2TS.index_data_providers(status)
+        self.status_updated = time.time()
 
         return self.status
 
     def set_status_for_service(self, service, status_xml):
         """
-        Set status dict based on values from status_xml. Return status for the service.
+        Set status dict based on values from status_xml, which may be an XML
+        string or a parsed document. Return status for the service.
+        """
+        if isinstance(status_xml, basestring):
+            status_xml = lxml.etree.fromstring(status_xml)
+        status = dict(self.status)
+        status[service] = WDB2TS.make_service_status(service, status_xml)
+        self.status = status
+        self.services_by_provider = WDB2TS.index_data_providers(status)
+        return self.status[service]
+
+    @staticmethod
+    def make_service_status(service, tree):
+        """
+        Return the status dict of a service from its parsed status document.
         """
-        self.status[service]['data_providers'] = WDB2TS.data_providers_from_status_response(status_xml)
-        logging.debug("Data providers for service %s: %s" % (service, ', '.join(self.status[service]['data_providers'])))
+        data_providers = WDB2TS.data_providers_from_status_tree(tree)
+        logging.debug("Data providers for service %s: %s" % (service, ', '.join(data_providers)))
 
-        if len(self.status[service]['data_providers']) == 0:
+        if len(data_providers) == 0:
             logging.warn("WDB2TS data providers for service %s set to empty list." % service)
 
-        return self.status[service]
+        return {'data_providers': data_providers}
+
+    @staticmethod
+    def index_data_providers(status):
+        """
+        Return a dictionary mapping each data provider to the sorted list of
+        services it is defined in.
+        """
+        index = {}
+        for service in sorted(status):
+            for data_provider in status[service].get('data_providers', []):
+                index.setdefault(data_provider, []).append(service)
+        return index
+
+    def get_services(self, data_provider):
+        """
+        Return the list of services in which a data provider is defined.
+        """
+        return self.services_by_provider.get(data_provider, [])
 
     @staticmethod
     def data_providers_from_status_response(status_xml):
         """
         Get all defined data_providers from status_xml.
         """
-        tree = lxml.etree.fromstring(status_xml)
+        return WDB2TS.data_providers_from_status_tree(lxml.etree.fromstring(status_xml))
+
+    @staticmethod
+    def data_providers_from_status_tree(tree):
+        """
+        Get all defined data_providers from a parsed status document.
+        """
         provider_elements = tree.xpath('/status/defined_dataproviders/dataprovider/name')
 
         return [e.text for e in provider_elements]
 
-    def update_wdb2ts(self, model, model_run):
+    def update_wdb2ts_batch(self, updates):
         """
-        Update all relevant wdb2ts services for the specified model and model_run
+        Update all relevant wdb2ts services for several models at once.
+        `updates` is a list of (model, model_run) tuples. Each service
+        receives a single update request covering all of its data providers.
+        Returns a list containing a WDB2TSException or None for each update.
         """
-        data_provider = model.get_data_provider_or_group()
+        updates_by_service = {}
+        for index, (model, model_run) in enumerate(updates):
+            data_provider = model.get_data_provider_or_group()
+            services = self.get_services(data_provider)
+            if not services:
+                logging.warning("Data provider %s is not defined in any WDB2TS service" % data_provider)
+            for service in services:
+                updates_by_service.setdefault(service, []).append(index)
 
-        for service in self.status:
-            if data_provider in self.status[service]['data_providers']:
-                self.update_wdb2ts_service(service, model, model_run)
+        services = sorted(updates_by_service)
 
-    def update_wdb2ts_service(self, service, model, model_run):
+        def func(service):
+            return self.update_wdb2ts_service_batch(service, [updates[index] for index in updates_by_service[service]])
+
+        errors = [None] * len(updates)
+        for service, service_errors in zip(services, self.map(func, services)):
+            for index, error in zip(updates_by_service[service], service_errors):
+                if errors[index] is None:
+                    errors[index] = error
+        return errors
+
+    def update_wdb2ts_host(self, updates):
         """
-        Update a wdb2ts service for a given model and model_run
+        Load status information if needed, and update all relevant wdb2ts
+        services for several models. `updates` is a list of (model,
+        model_run) tuples. Returns a list containing a WDB2TSException or None
+        for each update; if status information could not be loaded, its error
+        is returned for all updates.
+        """
+        try:
+            self.load_status([model.get_data_provider_or_group() for model, model_run in updates])
+            return self.update_wdb2ts_batch(updates)
+        except syncer.exceptions.WDB2TSException, e:
+            return [e] * len(updates)
+
+    def update_wdb2ts_service_batch(self, service, updates):
+        """
+        Update a wdb2ts service for several models with combined update
+        requests. If a combined request fails with a client error, or is not
+        recognized, each model is updated with a separate request, so that
+        errors are reported against the models they belong to. The service is
+        remembered as not supporting combined requests only if a combined
+        request was rejected as such, while the separate requests succeeded.
+        Until a combined request has been verified, see verify_batch_update,
+        its results are not trusted. Returns a list containing a
+        WDB2TSException or None for each update.
+        """
+        def update_each():
+            errors = []
+            for model, model_run in updates:
+                try:
+                    self.update_wdb2ts_service(service, model, model_run)
+                    errors += [None]
+                except syncer.exceptions.WDB2TSException, e:
+                    errors += [e]
+            return errors
+
+        if len(updates) == 1 or service in self.batch_unsupported:
+            return update_each()
+
+        unsupported = False
+        combined = False
+        try:
+            params = [self.get_update_params(model, model_run) for model, model_run in updates]
+            for batch in WDB2TS.split_update_params(params):
+                if len(batch) == 1:
+                    self.request_update(self.get_update_url(service, *batch[0]))
+                else:
+                    combined = True
+                    if not self.request_update(self.get_batch_update_url(service, batch)):
+                        unsupported = True
+        except syncer.exceptions.WDB2TSClientUpdateFailure, e:
+            logging.info("Combined update request to WDB2TS service %s failed, sending one request per data provider: %s" % (service, e))
+            unsupported = e.status_code in BATCH_UNSUPPORTED_STATUS_CODES
+        except syncer.exceptions.WDB2TSServerUpdateFailure, e:
+            return [e] * len(updates)
+        else:
+            if not unsupported:
+                if combined and service not in self.batch_supported:
+                    return self.verify_batch_update(service, params)
+                return [None] * len(updates)
+
+        errors = update_each()
+        if unsupported and not any(errors):
+            logging.warning("WDB2TS service %s does not accept combined update requests, sending one request per data provider from now on." % service)
+            self.batch_unsupported.add(service)
+        return errors
+
+    def verify_batch_update(self, service, params):
+        """
+        Check that a combined update request has been applied to every data
+        provider in it, by sending the update of each data provider again on
+        its own. WDB2TS replies that it is already up to date if the combined
+        request was applied, and applies the update otherwise. If any data
+        provider was not applied, the service is remembered as not supporting
+        combined requests. `params` is the list of (data provider, reference
+        time, version) tuples of the combined requests. Returns a list
+        containing a WDB2TSException or None for each tuple.
+        """
+        latest = dict([(param[0], param) for param in params])
+        errors = {}
+        replies = []
+        for data_provider, param in sorted(latest.iteritems()):
+            try:
+                replies += [self.request_update(self.get_update_url(service, *param))]
+            except syncer.exceptions.WDB2TSException, e:
+                errors[data_provider] = e
+
+        if UPDATE_UPDATED in replies:
+            logging.warning("WDB2TS service %s did not apply all data providers of a combined update request, sending one request per data provider from now on." % service)
+            self.batch_unsupported.add(service)
+        elif not errors and all([reply == UPDATE_UP_TO_DATE for reply in replies]):
+            logging.info("WDB2TS service %s applies combined update requests." % service)
+            self.batch_supported.add(service)
+        return [errors.get(param[0]) for param in params]
+
+    @staticmethod
+    def split_update_params(params):
+        """
+        Split a list of (data provider, reference time, version) tuples into
+        batches where each data provider occurs only once, removing duplicates.
+        """
+        batches = []
+        for param in params:
+            for batch in batches:
+                if param in batch:
+                    break
+                if param[0] not in [x[0] for x in batch]:
+                    batch.append(param)
+                    break
+            else:
+                batches.append([param])
+        return batches
+
+    def get_update_params(self, model, model_run):
+        """
+        Return the data provider, reference time and version used to update
+        WDB2TS with a model run.
         """
         try:
             reference_time = model_run.serialize_reference_time(model_run.reference_time)  # wdb2ts is very picky about this
             version = model.get_model_run_version(model_run)
-            update_url = self.get_update_url(service, model.get_data_provider_or_group(), reference_time, version)
+            return model.get_data_provider_or_group(), reference_time, int(version)
         except TypeError, e:
             raise syncer.exceptions.WDB2TSClientUpdateFailure("Could not generate a correct update URL for WDB2TS: %s" % e)
 
-        self.request_update(update_url)
+    def update_wdb2ts_service(self, service, model, model_run):
+        """
+        Update a wdb2ts service for a given model and model_run
+        """
+        data_provider, reference_time, version = self.get_update_params(model, model_run)
+        self.request_update(self.get_update_url(service, data_provider, reference_time, version))
 
     def get_update_url(self, service, data_provider, reference_time, version):
         """
@@ -118,9 +403,20 @@ class WDB2TS(object):
         """
         return "%s/%supdate?%s=%s,%d" % (self.base_url, service, data_provider, reference_time, version)
 
+    def get_batch_update_url(self, service, params):
+        """
+        Generate an update url for a wdb2ts service which updates several
+        data providers. `params` is a list of (data provider, reference time,
+        version) tuples.
+        """
+        query = '&'.join(["%s=%s,%d" % param for param in params])
+        return "%s/%supdate?%s" % (self.base_url, service, query)
+
     def request_update(self, update_url):
         """
-        Send update request to wdb2ts and check if the update went through
+        Send update request to wdb2ts and check if the update went through.
+        Returns UPDATE_UPDATED or UPDATE_UP_TO_DATE, or None if the response
+        from WDB2TS was not recognized.
         """
 
         # Raise separate exceptions for client update failures and server update failures.
@@ -130,14 +426,33 @@ class WDB2TS(object):
                 syncer.exceptions.WDB2TSConnectionFailure), e:
             raise syncer.exceptions.WDB2TSServerUpdateFailure("WDB2TS update failed because of some server error: %s" % e)
         except syncer.exceptions.WDB2TSServiceClientErrorException, e:
-            raise syncer.exceptions.WDB2TSClientUpdateFailure("WDB2TS update failed because the URL is not correct: %s" % e)
+            raise syncer.exceptions.WDB2TSClientUpdateFailure("WDB2TS update failed because the URL is not correct: %s" % e, e.status_code)
         else:
-            if 'NoNewDataRefTime' in response:
+            if UPDATE_UP_TO_DATE in response:
                 logging.info("WDB2TS already up to date: %s" % update_url)
-            elif 'Updated' in response:
+                return UPDATE_UP_TO_DATE
+            elif UPDATE_UPDATED in response:
                 logging.info("WDB2TS updated successfully: %s" % update_url)
-            else:
-                logging.info("Unknown response from WDB2TS on request %s: %s" % (update_url, response))
+                return UPDATE_UPDATED
+            logging.info("Unknown response from WDB2TS on request %s: %s" % (update_url, response))
+            return None
 
     def __repr__(self):
         return "WDB2TS(%s, %s)" % (self.base_url, ",".join(self.status.keys()))
+
+
+class WDB2TSCluster(object):
+    """
+    The set of WDB2TS hosts kept up to date by Syncer. Each host is
+    represented by a WDB2TS object, keeps its own status cache, and is updated
+    by its own job. Hosts are identified by their base URL.
+    """
+
+    def __init__(self, hosts):
+        self.hosts = hosts
+
+    def get_base_urls(self):
+        """
+        Return the base URLs of all hosts.
+        """
+        return [host.base_url for host in self.hosts]
@@ -0,0 +1,100 @@
+"""
+Worker pool for running blocking jobs, such as WDB loads and WDB2TS updates,
+outside of the Syncer main loop.
+
+Jobs are bound to a model, and only one job per model can be in flight at any
+given time. The main loop collects finished jobs and applies their results.
+"""
+
+import time
+import logging
+import multiprocessing.pool
+
+
+class Job(object):
+    """
+    A unit of work submitted to the worker pool on behalf of a model.
+    """
+
+    def __init__(self, model, kind, model_run, async_result):
+        self.model = model
+        self.kind = kind
+        self.model_run = model_run
+        self.async_result = async_result
+        self.started = time.time()
+
+    def ready(self):
+        """
+        Returns True if the job has finished, either successfully or not.
+        """
+        return self.async_result.ready()
+
+    def get(self):
+        """
+        Return the return value of the job function. If the job function
+        raised an exception, that exception is raised here.
+        """
+        return self.async_result.get()
+
+    def duration(self):
+        """
+        Return the number of seconds elapsed since the job was submitted.
+        """
+        return time.time() - self.started
+
+    def __repr__(self):
+        return "Job kind=%s model=%s model_run=%s" % (self.kind, self.model, self.model_run)
+
+
+class WorkerPool(object):
+    """
+    Runs jobs in a pool of worker threads, with at most one job per model.
+    """
+
+    def __init__(self, num_workers):
+        self.num_workers = num_workers
+        self.pool = multiprocessing.pool.ThreadPool(num_workers)
+        self.jobs = {}
+
+    def busy(self, model):
+        """
+        Returns True if a job is in flight for the specified model.
+        """
+        return model in self.jobs
+
+    def pending(self):
+        """
+        Return the number of jobs in flight.
+        """
+        return len(self.jobs)
+
+    def submit(self, model, kind, model_run, func, *args):
+        """
+        Run `func(*args)` in a worker thread. Returns the Job object, or None
+        if another job is already in flight for this model.
+        """
+        if self.busy(model):
+            logging.debug("Not submitting %s job for model %s, another job is already running." % (kind, model))
+            return None
+        job = Job(model, kind, model_run, self.pool.apply_async(func, args))
+        self.jobs[model] = job
+        logging.debug("Submitted %s" % job)
+        return job
+
+    def collect(self):
+        """
+        Remove all finished jobs from the pool, and return them.
+        """
+        finished = [job for job in self.jobs.values() if job.ready()]
+        for job in finished:
+            del self.jobs[job.model]
+            logging.debug("Finished %s in %.2fs" % (job, job.duration()))
+        return finished
+
+    def terminate(self):
+        """
+        Stop all worker threads without waiting for jobs to finish.
+        """
+        if self.jobs:
+            logging.warning("Abandoning %d running jobs: %s" % (len(self.jobs), ', '.join([unicode(job) for job in self.jobs.values()])))
+        self.pool.terminate()
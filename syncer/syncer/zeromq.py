@@ -2,13 +2,80 @@
 Syncer ZMQ module.
 
 Syncer runs a ZMQ subscriber that listens to events from Modelstatus.
+
+Modelstatus publishes each event as JSON, and once more for each binary codec
+it supports, under topics prefixed with the codec name. Publisher heartbeats
+list these codecs, and the subscriber switches its subscriptions to the
+preferred codec supported by both sides.
+
+Model status is sent from the daemon's ZMQAgent to the ZMQController process
+over a PUSH/PULL socket pair that never blocks the daemon. Each status message
+contains only the model attributes that changed, together with a per-model
+version number. The controller rebuilds the complete status from these deltas,
+and asks the agent for a full snapshot when it detects a missing version.
 """
 
+import time
 import zmq
+import Queue
 import logging
+import threading
+
+import modelstatus
 
+import syncer.codec
 import syncer.exceptions
 
+# Socket used for status updates from ZMQAgent to ZMQController
+STATUS_ADDR = 'tcp://127.0.0.1:59900'
+
+# Socket used for commands from ZMQController to ZMQAgent
+COMMAND_ADDR = 'tcp://127.0.0.1:59901'
+
+# Maximum number of status messages queued for the controller
+STATUS_HWM = 100
+
+# Minimum number of seconds between repeated resync requests
+RESYNC_INTERVAL = 5
+
+# Topic frame preceding each Modelstatus event: resource type and data provider
+TOPIC_FORMAT = u'%s %s\0'
+
+# Prefix of topics of Modelstatus events encoded with a binary codec
+CODEC_TOPIC_FORMAT = u'%s:'
+
+# Resource types published by Modelstatus
+RESOURCE_TYPES = ['model_run', 'data']
+
+# Modelstatus publishers older than protocol version 1.3 send JSON objects
+# without a topic frame
+LEGACY_TOPIC = u'{'
+
+# First protocol version in which Modelstatus events have a topic frame
+TOPIC_PROTOCOL_VERSION = [1, 3, 0]
+
+# Topic of heartbeat messages, published since protocol version 1.5
+HEARTBEAT_TOPIC = b'heartbeat\0'
+
+# Default number of seconds without a heartbeat before the connection to the
+# Modelstatus publisher is considered dead
+DEFAULT_HEARTBEAT_TIMEOUT = 30
+
+STATUS_SNAPSHOT = 'snapshot'
+STATUS_DELTA = 'delta'
+
+# Default number of messages buffered by ZMQIngress
+DEFAULT_INGRESS_QUEUE_SIZE = 10000
+
+# Maximum number of messages handed to the main loop at once
+INGRESS_BATCH_SIZE = 100
+
+# How often the ingress thread checks if it should stop, in seconds
+INGRESS_POLL_INTERVAL = 1
+
+INGRESS_EVENT = 'event'
+INGRESS_COMMAND = 'command'
+
 
 class ZMQBase(object):
 
@@ -54,6 +121,8 @@ class ZMQEvent(ZMQBase):
             raise syncer.exceptions.ZMQEventIncomplete("ZMQEvent has undefined type!")
         if kwargs['type'] == 'resource':
             return ZMQResourceEvent(**kwargs)
+        if kwargs['type'] == 'heartbeat':
+            return ZMQHeartbeatEvent(**kwargs)
 
     def __repr__(self):
         return "ZeroMQ event type=%s version=%s %s" % (
@@ -80,25 +149,218 @@ class ZMQResourceEvent(ZMQEvent):
         except:
             raise syncer.exceptions.ZMQEventBadResource("ZMQEvent has bad resource: %s" % str(self.resource))
 
+        # model run payload, available since protocol version 1.2
+        if not hasattr(self, 'model_run'):
+            self.model_run = None
+        if not hasattr(self, 'model_run_id'):
+            self.model_run_id = self.id if self.resource == 'model_run' else None
+
+        # sequence numbers, available since protocol version 1.4
+        if not hasattr(self, 'sequence'):
+            self.sequence = None
+        if not hasattr(self, 'previous_sequence'):
+            self.previous_sequence = None
+        self.data_provider = None
+        if isinstance(self.model_run, dict):
+            self.data_provider = self.model_run.get('data_provider')
+
+    def get_model_run(self):
+        """
+        Return the model run embedded in the event, or None if the event does
+        not contain a valid model run.
+        """
+        if self.model_run is None:
+            return None
+        try:
+            return modelstatus.ModelRun(self.model_run)
+        except Exception, e:
+            logging.warning("Ignoring invalid model run in %s: %s" % (self, unicode(e)))
+            return None
+
+
+class ZMQHeartbeatEvent(ZMQEvent):
+    required_fields = ['epoch']
+
+    def validate(self):
+        if not hasattr(self, 'sequence'):
+            self.sequence = None
+        if not hasattr(self, 'sequences'):
+            self.sequences = {}
+        if not isinstance(self.sequences, dict):
+            raise syncer.exceptions.ZMQEventIncomplete("ZMQEvent has bad sequences: %s" % unicode(self.sequences))
+
+
+def make_topic_prefix(codec=None):
+    """
+    Return the prefix of topics of Modelstatus events encoded with a codec.
+    """
+    if codec is None or codec.marker is None:
+        return u''
+    return CODEC_TOPIC_FORMAT % codec.name
+
+
+def make_topic(resource, data_provider, codec=None):
+    """
+    Return the topic frame of Modelstatus events about a resource belonging
+    to a specific data provider, encoded with a codec, or JSON by default.
+    """
+    return (make_topic_prefix(codec) + TOPIC_FORMAT % (resource, data_provider)).encode('utf-8')
+
+
+def has_expected_topic(frames, msg):
+    """
+    Returns False if a message was received without a topic frame, while its
+    protocol version says that it should have one.
+    """
+    if len(frames) > 1 or not isinstance(msg, dict):
+        return True
+    return list(msg.get('version', []))[:2] < TOPIC_PROTOCOL_VERSION[:2]
+
 
 class ZMQSubscriber(ZMQBase):
-    def __init__(self, addr, tcp_keepalive_interval, tcp_keepalive_count):
+    """
+    Receives events from the Modelstatus publisher. If a list of data
+    providers is given, only events about those data providers are received;
+    filtering takes place within ZeroMQ.
+
+    Once a heartbeat has been received from the publisher, the connection is
+    considered dead if no heartbeat arrives for `heartbeat_timeout` seconds,
+    and the socket is reconnected.
+
+    Events are received as JSON until a heartbeat announces that the
+    publisher supports one of the `codecs` preferred by the subscriber.
+    """
+    def __init__(self, addr, tcp_keepalive_interval, tcp_keepalive_count, data_providers=None, heartbeat_timeout=None, codecs=syncer.codec.DEFAULT_CODECS):
         self.context = zmq.Context()
+        self.addr = addr
+        self.tcp_keepalive_interval = tcp_keepalive_interval
+        self.tcp_keepalive_count = tcp_keepalive_count
+        self.data_providers = data_providers
+        self.heartbeat_timeout = heartbeat_timeout
+        self.codecs = codecs
+        self.codec = syncer.codec.CODECS['json']
+        self.init_sock()
+
+        # Sequence number of the last event received about each data provider
+        self.sequences = {}
+
+        # Publisher liveness, as seen by the last heartbeat
+        self.epoch = None
+        self.last_heartbeat = None
+        self.last_reconnect = None
+
+    def init_sock(self):
+        """
+        Create the subscriber socket, connect it, and set up subscriptions.
+        """
         self.sock = self.context.socket(zmq.SUB)
-        self.sock.setsockopt(zmq.TCP_KEEPALIVE, 1)                             # enable TCP keepalive
-        self.sock.setsockopt(zmq.TCP_KEEPALIVE_IDLE, tcp_keepalive_interval)   # keepalive packet sent each N seconds
-        self.sock.setsockopt(zmq.TCP_KEEPALIVE_INTVL, tcp_keepalive_interval)  # keepalive packet sent each N seconds
-        self.sock.setsockopt(zmq.TCP_KEEPALIVE_CNT, tcp_keepalive_count)       # number of missed packets to mark connection as dead
-        self.sock.connect(addr)
-        self.sock.setsockopt_string(zmq.SUBSCRIBE, u'')
+        self.sock.setsockopt(zmq.TCP_KEEPALIVE, 1)                                  # enable TCP keepalive
+        self.sock.setsockopt(zmq.TCP_KEEPALIVE_IDLE, self.tcp_keepalive_interval)   # keepalive packet sent each N seconds
+        self.sock.setsockopt(zmq.TCP_KEEPALIVE_INTVL, self.tcp_keepalive_interval)  # keepalive packet sent each N seconds
+        self.sock.setsockopt(zmq.TCP_KEEPALIVE_CNT, self.tcp_keepalive_count)       # number of missed packets to mark connection as dead
+        self.sock.connect(self.addr)
+        for topic in self.get_subscriptions():
+            self.sock.setsockopt(zmq.SUBSCRIBE, topic)
+
+    def reconnect(self):
+        """
+        Replace the subscriber socket with a freshly connected one.
+        """
+        self.sock.close(0)
+        self.init_sock()
+        self.last_reconnect = time.time()
+
+    def get_subscriptions(self):
+        """
+        Return the list of topics to subscribe to: events encoded with the
+        current codec about the configured data providers, or about all data
+        providers if `data_providers` is None, and heartbeats.
+        """
+        if self.data_providers is None:
+            prefix = make_topic_prefix(self.codec)
+            topics = [(prefix + u'%s ' % resource).encode('utf-8') for resource in RESOURCE_TYPES]
+        else:
+            topics = []
+            for data_provider in sorted(set(self.data_providers)):
+                topics += [make_topic(resource, data_provider, self.codec) for resource in RESOURCE_TYPES]
+        topics += [HEARTBEAT_TOPIC]
+        if self.codec.marker is None:
+            topics += [LEGACY_TOPIC.encode('utf-8')]
+        return topics
+
+    def negotiate(self, codecs):
+        """
+        Switch to the preferred codec among those supported by the publisher,
+        subscribing to the new topics before unsubscribing from the old ones,
+        so that no events are lost.
+        """
+        codec = syncer.codec.get_codec(self.codecs, codecs or ['json'])
+        if codec is self.codec:
+            return
+        logging.info("Receiving ZeroMQ events encoded with %s." % codec.name)
+        old = self.get_subscriptions()
+        self.codec = codec
+        new = self.get_subscriptions()
+        for topic in new:
+            if topic not in old:
+                self.sock.setsockopt(zmq.SUBSCRIBE, topic)
+        for topic in old:
+            if topic not in new:
+                self.sock.setsockopt(zmq.UNSUBSCRIBE, topic)
+
+    def recv_message(self, flags=0):
+        """
+        Receive a single message, with or without a topic frame, and return
+        the decoded data. Raises zmq.Again if no message is available in
+        non-blocking mode, and ValueError if the message cannot be decoded.
+        """
+        frames = self.sock.recv_multipart(flags)
+        msg = syncer.codec.decode(frames[-1])
+        if not has_expected_topic(frames, msg):
+            logging.warning("Received message of protocol version %s without a topic frame, which is required since version %s" % (msg['version'], '.'.join([str(x) for x in TOPIC_PROTOCOL_VERSION])))
+        if isinstance(msg, dict) and msg.get('type') == 'heartbeat':
+            self.last_heartbeat = time.time()
+            self.negotiate(msg.get('codecs'))
+        return msg
+
+    def heartbeat_age(self):
+        """
+        Return the number of seconds since the last heartbeat was received,
+        or None if the publisher has never sent one.
+        """
+        if self.last_heartbeat is None:
+            return None
+        return time.time() - self.last_heartbeat
+
+    def is_late(self):
+        """
+        Returns True if the publisher sends heartbeats, but the last one is
+        overdue.
+        """
+        if not self.heartbeat_timeout or self.last_heartbeat is None:
+            return False
+        return self.heartbeat_age() > self.heartbeat_timeout
+
+    def reconnect_if_late(self):
+        """
+        Reconnect if the heartbeat is overdue, at most once per heartbeat
+        timeout. Returns True if the socket was reconnected.
+        """
+        if not self.is_late():
+            return False
+        if self.last_reconnect is not None and time.time() < self.last_reconnect + self.heartbeat_timeout:
+            return False
+        logging.warning("No heartbeat from the Modelstatus publisher for %d seconds, reconnecting..." % self.heartbeat_age())
+        self.reconnect()
+        return True
 
     def recv(self):
         """
         Receive incoming messages, and return them.
         """
         try:
-            msg = self.sock.recv_json(zmq.NOBLOCK)
-        except zmq.ZMQError, e:
+            msg = self.recv_message(zmq.NOBLOCK)
+        except (zmq.ZMQError, ValueError), e:
             logging.debug("%s in ZMQSubscriber.recv(): %s" % (type(e), unicode(e)))
             msg = None
         return msg
@@ -108,7 +370,65 @@ class ZMQSubscriber(ZMQBase):
         Check if there are valid resource update events in the ZeroMQ pipeline.
         Returns a ZMQEvent object.
         """
-        msg = self.recv()
+        return self.parse_event(self.recv())
+
+    def check_sequence(self, event):
+        """
+        Track the sequence numbers of events about each data provider. Returns
+        the sequence number of the last event received before a gap, or None
+        if no events have been missed. Events without sequence numbers, from
+        publishers older than protocol version 1.4, are not tracked.
+        """
+        if event.sequence is None or event.data_provider is None:
+            return None
+        last = self.sequences.get(event.data_provider)
+        self.sequences[event.data_provider] = event.sequence
+        if last is None or event.sequence == last:
+            return None
+        if event.sequence < last:
+            logging.warning("Sequence number of events about %s went back from %d to %d, the Modelstatus database might have been reset." % (event.data_provider, last, event.sequence))
+            return None
+        if event.previous_sequence != last:
+            return last
+        return None
+
+    def check_heartbeat(self, heartbeat):
+        """
+        Compare the last sequence numbers announced by a heartbeat with those
+        of the events received. Returns a list of (data_provider, after,
+        before) tuples, giving the range of sequence numbers missed for each
+        data provider. Data providers not seen before start out from the
+        heartbeat.
+        """
+        if self.epoch is not None and heartbeat.epoch != self.epoch:
+            logging.warning("The Modelstatus publisher has been restarted, checking for missed events.")
+        self.epoch = heartbeat.epoch
+
+        gaps = []
+        for data_provider, sequence in sorted(heartbeat.sequences.iteritems()):
+            if self.data_providers is not None and data_provider not in self.data_providers:
+                continue
+            last = self.sequences.get(data_provider)
+            if last is not None and sequence > last:
+                gaps += [(data_provider, last, sequence + 1)]
+            elif last is not None and sequence < last:
+                logging.warning("Sequence number of events about %s went back from %d to %d, the Modelstatus database might have been reset." % (data_provider, last, sequence))
+            self.sequences[data_provider] = sequence
+        return gaps
+
+    def is_sequenced(self, data_provider):
+        """
+        Returns True if sequenced events have been received about a data
+        provider, and the publisher is alive, so that lost events will be
+        detected.
+        """
+        return data_provider in self.sequences and not self.is_late()
+
+    def parse_event(self, msg):
+        """
+        Return a ZMQEvent object from a received message, or None if the
+        message is not a valid event.
+        """
         try:
             event = ZMQEvent.factory(**msg)
             return event
@@ -121,22 +441,151 @@ class ZMQSubscriber(ZMQBase):
         return None
 
 
+class ZMQIngress(object):
+    """
+    Drains Modelstatus events from a ZMQSubscriber and commands from a
+    ZMQAgent in a background thread, and buffers them in a bounded queue
+    until the main loop is ready to process them. Once started, the ingress
+    thread is the only user of these two sockets.
+
+    If the queue is full, messages are dropped and counted, and the main loop
+    is told that it has missed events.
+    """
+    def __init__(self, zmq_subscriber, zmq_agent, queue_size=DEFAULT_INGRESS_QUEUE_SIZE, metrics=None):
+        self.zmq_subscriber = zmq_subscriber
+        self.zmq_agent = zmq_agent
+        self.queue = Queue.Queue(queue_size)
+        self.metrics = metrics
+        self.dropped = 0
+        self.overflowed = threading.Event()
+        self.stopped = threading.Event()
+        self.thread = None
+
+    def start(self):
+        """
+        Start draining the sockets in a background thread.
+        """
+        self.thread = threading.Thread(target=self.run, name='ZMQIngress')
+        self.thread.daemon = True
+        self.thread.start()
+
+    def stop(self):
+        """
+        Stop the background thread, and wait for it to finish.
+        """
+        self.stopped.set()
+        if self.thread is not None:
+            self.thread.join()
+
+    def count(self, name, value=1):
+        if self.metrics is not None:
+            self.metrics.increment(name, value)
+
+    def put(self, kind, msg):
+        """
+        Add a message to the queue, or drop it if the queue is full.
+        """
+        try:
+            self.queue.put_nowait((kind, msg))
+            self.count('zmq_ingress_received')
+        except Queue.Full:
+            self.dropped += 1
+            self.count('zmq_ingress_dropped')
+            self.overflowed.set()
+            logging.error("ZeroMQ ingress queue is full, dropping %s: %s" % (kind, msg))
+
+    def drain(self, recv, kind):
+        """
+        Receive all messages waiting on a socket, using the function `recv`.
+        """
+        while True:
+            try:
+                msg = recv(zmq.NOBLOCK)
+            except zmq.Again:
+                return
+            except ValueError:
+                logging.warning("Discarding non-JSON %s from ZeroMQ." % kind)
+                continue
+            self.put(kind, msg)
+
+    def run(self):
+        """
+        Main loop of the ingress thread.
+        """
+        poller = zmq.Poller()
+        sock = self.zmq_subscriber.sock
+        poller.register(sock, zmq.POLLIN)
+        poller.register(self.zmq_agent.sub, zmq.POLLIN)
+        while not self.stopped.is_set():
+            events = dict(poller.poll(INGRESS_POLL_INTERVAL * 1000))
+            if sock in events:
+                self.drain(self.zmq_subscriber.recv_message, INGRESS_EVENT)
+            if self.zmq_agent.sub in events:
+                self.drain(self.zmq_agent.recv_command, INGRESS_COMMAND)
+            if self.zmq_subscriber.reconnect_if_late():
+                poller.unregister(sock)
+                sock = self.zmq_subscriber.sock
+                poller.register(sock, zmq.POLLIN)
+                self.count('zmq_reconnects')
+
+    def depth(self):
+        """
+        Return the number of messages waiting in the queue.
+        """
+        return self.queue.qsize()
+
+    def get_batch(self, timeout, size=INGRESS_BATCH_SIZE):
+        """
+        Wait at most `timeout` seconds for a message, and return a list of up
+        to `size` (kind, message) tuples.
+        """
+        batch = []
+        try:
+            batch += [self.queue.get(True, timeout)]
+            while len(batch) < size:
+                batch += [self.queue.get_nowait()]
+        except Queue.Empty:
+            pass
+        if self.metrics is not None:
+            self.metrics.set_gauge('zmq_ingress_depth', self.depth())
+        return batch
+
+    def take_overflow(self):
+        """
+        Returns True if messages have been dropped since the last call.
+        """
+        if not self.overflowed.is_set():
+            return False
+        self.overflowed.clear()
+        return True
+
+
 class ZMQAgent(ZMQBase):
     """
-    Receives commands from a ZMQController.
+    Receives commands from a ZMQController, and sends status updates to it,
+    encoded with the preferred available codec among `codecs`.
     """
-    def __init__(self):
+    def __init__(self, status_addr=STATUS_ADDR, command_addr=COMMAND_ADDR, codecs=syncer.codec.DEFAULT_CODECS):
         self.context = zmq.Context()
-        self.init_req('tcp://127.0.0.1:59900')
-        self.init_rep('tcp://127.0.0.1:59901')
-
-    def init_req(self, addr):
+        self.codec = syncer.codec.get_codec(codecs)
+        self.init_push(status_addr)
+        self.init_rep(command_addr)
+
+        # Identifies this agent instance, so that the controller can tell
+        # when version numbers start over
+        self.epoch = time.time()
+        self.models = {}
+        self.versions = {}
+        self.resync = True
+
+    def init_push(self, addr):
         """
         Initialize a ZMQ IPC socket which sends status updates to ZMQController.
         """
-        self.req = self.context.socket(zmq.REQ)
-        self.req.setsockopt(zmq.SNDTIMEO, 2000)
-        self.req.bind(addr)
+        self.push = self.context.socket(zmq.PUSH)
+        self.push.setsockopt(zmq.SNDHWM, STATUS_HWM)
+        self.push.setsockopt(zmq.LINGER, 0)
+        self.push.bind(addr)
 
     def init_rep(self, addr):
         """
@@ -146,32 +595,90 @@ class ZMQAgent(ZMQBase):
         self.sub.setsockopt_string(zmq.SUBSCRIBE, u'')
         self.sub.bind(addr)
 
+    def request_resync(self):
+        """
+        Send the complete status with the next status update.
+        """
+        self.resync = True
+
+    def make_status_message(self, data):
+        """
+        Return the next status message, given the complete status `data`,
+        which contains a list of serialized models. Models are identified by
+        their data provider, and their version is incremented every time one
+        of their attributes change.
+        """
+        models = dict([(model['data_provider'], model) for model in data['models']])
+        changes = {}
+        for key, model in models.iteritems():
+            previous = self.models.get(key, {})
+            changed = dict([(k, v) for k, v in model.iteritems() if k not in previous or previous[k] != v])
+            if changed:
+                self.versions[key] = self.versions.get(key, 0) + 1
+                changes[key] = {'version': self.versions[key], 'changes': changed}
+        self.models = models
+
+        message = {
+            'epoch': self.epoch,
+            'metrics': data.get('metrics', {}),
+            'publisher': data.get('publisher', {}),
+        }
+        if self.resync:
+            message['type'] = STATUS_SNAPSHOT
+            message['models'] = dict([(key, {'version': self.versions[key], 'changes': model}) for key, model in models.iteritems()])
+        else:
+            message['type'] = STATUS_DELTA
+            message['models'] = changes
+        return message
+
     def sync_status(self, data):
         """
-        Synchronize status with ZMQController.
+        Synchronize status with ZMQController. If the controller is not
+        keeping up, the update is dropped, and a snapshot is sent next time.
+        """
+        message = self.make_status_message(data)
+        try:
+            self.push.send(self.codec.encode(message), zmq.NOBLOCK)
+            self.resync = False
+        except zmq.Again:
+            logging.debug("ZeroMQ controller is not receiving status updates, will resynchronize later.")
+            self.resync = True
+
+    def recv_command(self, flags=0):
+        """
+        Receive and decode a command. Raises ValueError if the command cannot
+        be decoded.
         """
-        self.req.send_json(data)
-        self.req.recv()
+        return syncer.codec.decode(self.sub.recv(flags))
 
     def get_command(self):
-        return self.sub.recv_json()
+        return self.recv_command()
 
 
 class ZMQController(ZMQBase):
     """
-    API to Syncer providing status queries and command issuing.
+    API to Syncer providing status queries and command issuing. Commands to
+    ZMQAgent are encoded with the preferred available codec among `codecs`;
+    the admin socket always speaks JSON.
     """
-    def __init__(self, addr):
+    def __init__(self, addr, status_addr=STATUS_ADDR, command_addr=COMMAND_ADDR, codecs=syncer.codec.DEFAULT_CODECS):
         self.context = zmq.Context()
-        self.init_rep('tcp://127.0.0.1:59900')
-        self.init_pub('tcp://127.0.0.1:59901')
+        self.codec = syncer.codec.get_codec(codecs)
+        self.init_pull(status_addr)
+        self.init_pub(command_addr)
         self.init_sock(addr)
         self.poller = zmq.Poller()
         self.poller.register(self.sock, zmq.POLLIN)
-        self.poller.register(self.rep, zmq.POLLIN)
+        self.poller.register(self.pull, zmq.POLLIN)
         self.status = {
-            'models': []
+            'models': [],
+            'metrics': {},
+            'publisher': {},
         }
+        self.epoch = None
+        self.models = {}
+        self.versions = {}
+        self.resync_requested = None
 
     def init_pub(self, addr):
         """
@@ -180,12 +687,12 @@ class ZMQController(ZMQBase):
         self.pub = self.context.socket(zmq.PUB)
         self.pub.connect(addr)
 
-    def init_rep(self, addr):
+    def init_pull(self, addr):
         """
         Initialize a ZMQ IPC socket which receives status updates from ZMQAgent.
         """
-        self.rep = self.context.socket(zmq.REP)
-        self.rep.connect(addr)
+        self.pull = self.context.socket(zmq.PULL)
+        self.pull.connect(addr)
 
     def init_sock(self, addr):
         """
@@ -206,6 +713,18 @@ class ZMQController(ZMQBase):
         """
         return self.make_reply(self.STATUS_OK, self.status['models'])
 
+    def run_metrics(self):
+        """
+        Return operational metrics of the Syncer daemon. The age of the last
+        heartbeat from the Modelstatus publisher is calculated at query time.
+        """
+        metrics = dict(self.status.get('metrics', {}))
+        last_heartbeat = self.status.get('publisher', {}).get('last_heartbeat')
+        if last_heartbeat is not None:
+            metrics['gauges'] = dict(metrics.get('gauges', {}))
+            metrics['gauges']['zmq_heartbeat_age'] = int(time.time() - last_heartbeat)
+        return self.make_reply(self.STATUS_OK, metrics)
+
     def run_load(self, model_run_id, force):
         """
         (Re)-load a model run into WDB.
@@ -218,12 +737,62 @@ class ZMQController(ZMQBase):
         })
         return self.make_reply(self.STATUS_OK, ['Request has been queued'])
 
+    def request_resync(self):
+        """
+        Ask ZMQAgent for a complete status snapshot, unless one has been
+        requested recently.
+        """
+        now = time.time()
+        if self.resync_requested is not None and now < self.resync_requested + RESYNC_INTERVAL:
+            return
+        self.resync_requested = now
+        self.queue_exec_syncer({'command': 'resync'})
+
+    def apply_status(self, message):
+        """
+        Update the cached status with a status message from ZMQAgent. Deltas
+        are only applied if they continue the version sequence of every model
+        they contain; otherwise, a resync is requested.
+        """
+        if message['type'] == STATUS_SNAPSHOT:
+            self.epoch = message['epoch']
+            self.models = dict([(key, model['changes']) for key, model in message['models'].iteritems()])
+            self.versions = dict([(key, model['version']) for key, model in message['models'].iteritems()])
+            self.resync_requested = None
+        elif message['epoch'] != self.epoch:
+            logging.info("Status update from a new Syncer instance, requesting resync.")
+            return self.request_resync()
+        else:
+            for key, model in message['models'].iteritems():
+                if model['version'] != self.versions.get(key, 0) + 1:
+                    logging.warning("Missed status update for model %s, requesting resync." % key)
+                    return self.request_resync()
+            models = dict(self.models)
+            for key, model in message['models'].iteritems():
+                models[key] = dict(models.get(key, {}))
+                models[key].update(model['changes'])
+                self.versions[key] = model['version']
+            self.models = models
+
+        self.status = {
+            'models': [self.models[key] for key in sorted(self.models)],
+            'metrics': message['metrics'],
+            'publisher': message.get('publisher', {}),
+        }
+
+    def recv_status(self):
+        """
+        Receive and decode a status message from ZMQAgent. Raises ValueError
+        if the message cannot be decoded.
+        """
+        return syncer.codec.decode(self.pull.recv())
+
     def queue_exec_syncer(self, command):
         """
         Queue a command to Syncer.
         """
         logging.debug("Queueing command from Syncerctl: %s" % command)
-        self.pub.send_json(command)
+        self.pub.send(self.codec.encode(command))
 
     def exec_command(self, tokens):
         try:
@@ -233,6 +802,8 @@ class ZMQController(ZMQBase):
                 return self.run_hello()
             if tokens['command'] == 'status':
                 return self.run_status()
+            if tokens['command'] == 'metrics':
+                return self.run_metrics()
             if tokens['command'] == 'load':
                 return self.run_load(tokens['model_run_id'], tokens['force'])
             raise Exception("Invalid command '%s'" % tokens['command'])
@@ -254,6 +825,9 @@ class ZMQController(ZMQBase):
                 except ValueError:
                     logging.warning("Some perpetrator is sending non-JSON data to the ZeroMQ control socket, message ignored.")
                     self.sock.send_string(u'go away')
-            if self.rep in events:
-                self.status = self.rep.recv_json()
-                self.rep.send(b'')
+            if self.pull in events:
+                try:
+                    self.apply_status(self.recv_status())
+                except ValueError, e:
+                    logging.warning("Discarding undecodable status update: %s" % unicode(e))
+                    self.request_resync()